@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""
+Rough benchmarks for txWS internals.
+
+Run with ``python bench.py``, or name some groups of benchmarks to run only
+those: ``python bench.py mask parse``. Numbers are wall-clock and only
+meaningful relative to each other on the same machine.
+
+To check a change for regressions, save the results from before it, and
+compare against them after:
+
+    $ python bench.py --save before.json
+    $ python bench.py --compare before.json
+
+Comparing exits with status 1 if anything got slower by more than the
+threshold, 10% by default.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+from twisted.internet.protocol import Factory, Protocol
+from twisted.test.proto_helpers import StringTransport
+
+import txws
+
+# Seconds per call of everything benchmarked so far, by label.
+results = {}
+
+# How many times to repeat each measurement; the best one counts.
+repeat = 3
+
+def bench(label, func, number, size=None):
+    elapsed = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    line = "%-56s %10.2f us/call" % (label, elapsed * 1e6)
+    if size:
+        line += " %10.1f MB/s" % (size / elapsed / 1e6)
+    print(line)
+    results[label] = elapsed
+    return elapsed
+
+def iterations(size):
+    """
+    Pick a number of calls for a benchmark working through size bytes a
+    call, which keeps each measurement in the same ballpark of total work.
+    """
+
+    return max(1, min(20000, (1 << 22) // (size * 16)))
+
+def bench_mask():
+    key = os.urandom(4)
+
+    engines = [("loop", txws._mask_loop), ("int", txws._mask_int)]
+    if txws.numpy is not None:
+        engines.append(("numpy", txws._mask_numpy))
+    engines.append(("mask() (selected)", txws.mask))
+
+    for size in (16, 4096, 1 << 20):
+        data = os.urandom(size)
+        number = iterations(size)
+        for name, engine in engines:
+            if engine is txws._mask_loop and size > 65536:
+                # The reference loop is far too slow to repeat at this size.
+                bench("mask %s, %d bytes" % (name, size),
+                      lambda: engine(data, key), 1, size)
+            else:
+                bench("mask %s, %d bytes" % (name, size),
+                      lambda: engine(data, key), number, size)
+
+def make_json(size):
+    """
+    Make a JSON document of exactly size bytes, like an application might
+    send.
+    """
+
+    items = []
+    while True:
+        items.append({"id": len(items), "user": "user%d" % len(items),
+                      "text": "Hello, world!", "tags": ["a", "b"]})
+        if len(json.dumps(items + [{"pad": ""}])) > size:
+            items.pop()
+            break
+    # Pad out the last item to get the size just right.
+    items.append({"pad": ""})
+    items[-1]["pad"] = "x" * (size - len(json.dumps(items)))
+    return json.dumps(items).encode("ascii")
+
+# Payloads which real applications send: small chat messages, JSON
+# documents, and big binary blobs. Each is sent as text or binary.
+PAYLOADS = [
+    ("chat", json.dumps({"type": "message", "room": "lobby",
+                         "text": "hi there!"}).encode("ascii"), 0x1),
+    ("4 KiB JSON", make_json(4096), 0x1),
+    ("1 MiB binary", os.urandom(1 << 20), 0x2),
+]
+
+KEY = b"\x37\xfa\x21\x3d"
+
+def masked_frame(payload, opcode):
+    """
+    Make a masked frame, the way a browser would send it.
+    """
+
+    frame = txws.make_hybi07_frame(payload, opcode)
+    header = bytearray(frame[:len(frame) - len(payload)])
+    header[1] |= 0x80
+    return bytes(header) + KEY + txws.mask(payload, KEY)
+
+def bench_frames():
+    for name, payload, opcode in PAYLOADS:
+        bench("make_hybi07_frame, %s" % name,
+              lambda: txws.make_hybi07_frame(payload, opcode),
+              iterations(len(payload)), len(payload))
+
+def decode_pieces(decoder, pieces):
+    """
+    Feed pieces of data to a fresh incremental decoder, as separate reads.
+    """
+
+    buf = txws.ReceiveBuffer()
+    for piece in pieces:
+        buf.feed(piece)
+        decoder.decode(buf)
+
+def bench_parse():
+    for name, payload, opcode in PAYLOADS:
+        size = len(payload)
+        number = iterations(size)
+        # Enough frames per read to make up at least 64 KiB, or four.
+        count = max(4, 65536 // size)
+
+        for masking, frame in (("masked", masked_frame(payload, opcode)),
+                               ("unmasked",
+                                txws.make_hybi07_frame(payload, opcode))):
+            label = "parse_hybi07_frames, %s, %s" % (name, masking)
+            bench(label + ", whole",
+                  lambda: txws.parse_hybi07_frames(frame), number, size)
+
+            frames = frame * count
+            bench(label + ", %d per read" % count,
+                  lambda: txws.parse_hybi07_frames(frames),
+                  max(1, number // count), size * count)
+
+            # A byte at a time is the worst case for incremental parsing,
+            # and too slow to bother with for big frames.
+            if size <= 4096:
+                pieces = [frame[i:i + 1] for i in range(len(frame))]
+                bench("HyBi07Decoder, %s, %s, byte by byte" % (name, masking),
+                      lambda: decode_pieces(txws.HyBi07Decoder(), pieces),
+                      max(1, number // 16), size)
+
+        # HyBi-00 frames can only carry text, without 0xff bytes.
+        payload = payload.replace(b"\xff", b"\xfe")
+        frame = txws.make_hybi00_frame(payload)
+        label = "parse_hybi00_frames, %s" % name
+        bench(label + ", whole",
+              lambda: txws.parse_hybi00_frames(frame), number, size)
+
+        frames = frame * count
+        bench(label + ", %d per read" % count,
+              lambda: txws.parse_hybi00_frames(frames),
+              max(1, number // count), size * count)
+
+        if size <= 4096:
+            pieces = [frame[i:i + 1] for i in range(len(frame))]
+            bench("HyBi00Decoder, %s, byte by byte" % name,
+                  lambda: decode_pieces(txws.HyBi00Decoder(), pieces),
+                  max(1, number // 16), size)
+
+RFC6455_REQUEST = (b"GET /chat HTTP/1.1\r\n"
+                   b"Host: server.example.com\r\n"
+                   b"Upgrade: websocket\r\n"
+                   b"Connection: Upgrade\r\n"
+                   b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+                   b"Origin: http://example.com\r\n"
+                   b"Sec-WebSocket-Version: 13\r\n"
+                   b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:60.0)\r\n"
+                   b"Accept-Language: en-US,en;q=0.5\r\n"
+                   b"\r\n")
+
+def bench_handshake():
+    """
+    Measure the handshake helpers, and how many RFC 6455 handshakes a single
+    process can complete per second, from a fresh connection to the 101
+    response.
+    """
+
+    bench("make_accept", lambda: txws.make_accept("dGhlIHNhbXBsZSBub25jZQ=="),
+          20000)
+    head = RFC6455_REQUEST.decode("ascii").split("\r\n", 1)[1]
+    bench("http_headers", lambda: txws.http_headers(head), 20000)
+
+    factory = txws.WebSocketFactory(Factory.forProtocol(Protocol))
+
+    def handshake(pieces):
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        for piece in pieces:
+            protocol.dataReceived(piece)
+
+    whole = [RFC6455_REQUEST]
+    split = [RFC6455_REQUEST[i:i + 16]
+             for i in range(0, len(RFC6455_REQUEST), 16)]
+
+    for label, pieces in (("whole", whole), ("in 16-byte reads", split)):
+        elapsed = bench("handshake, %s" % label,
+                        lambda: handshake(pieces), 2000)
+        print("%-56s %10.0f /s" % ("", 1 / elapsed))
+
+benchmarks = [
+    ("mask", bench_mask),
+    ("frames", bench_frames),
+    ("parse", bench_parse),
+    ("handshake", bench_handshake),
+]
+
+def environment():
+    """
+    Describe what the benchmarks ran on, to be saved along with them.
+    """
+
+    return {
+        "txws": txws.__version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "numpy": getattr(txws.numpy, "__version__", None),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+def compare(baseline, threshold):
+    """
+    Compare the results against a baseline, printing the change in each
+    benchmark which both have, and return the labels of those which got
+    slower by more than the threshold.
+    """
+
+    print()
+    print("%-56s %10s %10s %8s" % ("Compared to baseline", "before",
+                                   "after", "change"))
+    regressions = []
+    for label in sorted(set(results) & set(baseline)):
+        before, after = baseline[label], results[label]
+        change = after / before - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(label)
+            flag = "  SLOWER"
+        print("%-56s %10.2f %10.2f %+7.1f%%%s" % (label, before * 1e6,
+                                                   after * 1e6, change * 100,
+                                                   flag))
+    return regressions
+
+def main(argv=None):
+    global repeat
+
+    parser = argparse.ArgumentParser(description="Benchmark txWS internals.")
+    parser.add_argument("groups", nargs="*",
+                        help="groups of benchmarks to run: %s (all by default)"
+                        % ", ".join(name for name, f in benchmarks))
+    parser.add_argument("--repeat", type=int, default=repeat,
+                        help="times to repeat each measurement")
+    parser.add_argument("--save", metavar="FILE",
+                        help="save the results as JSON")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare the results with a baseline saved "
+                        "with --save")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="slowdown, as a fraction, which counts as a "
+                        "regression when comparing")
+    options = parser.parse_args(argv)
+
+    names = [name for name, f in benchmarks]
+    for group in options.groups:
+        if group not in names:
+            parser.error("no such group of benchmarks: %s" % group)
+    repeat = options.repeat
+
+    for name, f in benchmarks:
+        if not options.groups or name in options.groups:
+            f()
+
+    if options.save:
+        with open(options.save, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f,
+                      indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(baseline, options.threshold)
+        if regressions:
+            print()
+            print("%d regressions over %d%%" % (len(regressions),
+                                                options.threshold * 100))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
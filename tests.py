@@ -12,11 +12,166 @@
 # License for the specific language governing permissions and limitations under
 # the License.
 
+import os
+import signal
+import zlib
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from struct import pack
+
+from twisted.internet.defer import Deferred
+from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.interfaces import IPushProducer, ITransport
+from twisted.internet.task import Clock
+from twisted.logger import LogLevel, formatEvent, globalLogPublisher
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+from twisted.test.proto_helpers import StringTransport
 from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+from zope.interface import implementer
 
+import txws
 from txws import (is_hybi00, complete_hybi00, make_hybi00_frame,
                   parse_hybi00_frames, http_headers, make_accept, mask, CLOSE,
-                  NORMAL, PING, PONG, parse_hybi07_frames)
+                  NORMAL, PING, PONG, parse_hybi07_frames, ReceiveBuffer,
+                  WebSocketFactory, FRAMES)
+
+RFC6455_REQUEST = (b"GET /chat HTTP/1.1\r\n"
+                   b"Host: server.example.com\r\n"
+                   b"Upgrade: websocket\r\n"
+                   b"Connection: Upgrade\r\n"
+                   b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+                   b"Origin: http://example.com\r\n"
+                   b"Sec-WebSocket-Version: 13\r\n"
+                   b"\r\n")
+
+HYBI00_REQUEST = (b"GET /demo HTTP/1.1\r\n"
+                  b"Host: example.com\r\n"
+                  b"Connection: Upgrade\r\n"
+                  b"Sec-WebSocket-Key2: 12998 5 Y3 1  .P00\r\n"
+                  b"Upgrade: WebSocket\r\n"
+                  b"Sec-WebSocket-Key1: 4 @1  46546xW%0l 1 5\r\n"
+                  b"Origin: http://example.com\r\n"
+                  b"\r\n"
+                  b"^n:ds[4U")
+
+def make_frame(payload, opcode=0x1, fin=True, key=b"\x37\xfa\x21\x3d",
+               rsv1=False):
+    """
+    Build a masked client frame, the way a browser would.
+    """
+
+    header = (0x80 if fin else 0x00) | (0x40 if rsv1 else 0x00) | opcode
+    length = len(payload)
+    if length > 0xffff:
+        header = pack(">BBQ", header, 0xff, length)
+    elif length > 0x7d:
+        header = pack(">BBH", header, 0xfe, length)
+    else:
+        header = pack(">BB", header, 0x80 | length)
+    return header + key + mask(payload, key)
+
+class SequenceTransport(StringTransport):
+    """
+    A transport which remembers how it was written to.
+    """
+
+    def __init__(self):
+        StringTransport.__init__(self)
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append([data])
+        StringTransport.write(self, data)
+
+    def writeSequence(self, seq):
+        self.writes.append(list(seq))
+        StringTransport.write(self, b"".join(seq))
+
+class ClosingTransport(SequenceTransport):
+    """
+    A transport which, like real ones, only finishes closing once its
+    buffer has drained and no producer is registered.
+    """
+
+    closed = False
+
+    def drain(self):
+        if self.producer is not None:
+            self.producer.resumeProducing()
+        elif self.disconnecting:
+            self.closed = True
+
+class RecordingProtocol(Protocol):
+
+    def __init__(self):
+        self.received = []
+
+    def dataReceived(self, data):
+        self.received.append(data)
+
+class PausingProtocol(RecordingProtocol):
+    """
+    A protocol which pauses its transport after every message.
+    """
+
+    def dataReceived(self, data):
+        RecordingProtocol.dataReceived(self, data)
+        self.transport.pauseProducing()
+
+class MessageProtocol(RecordingProtocol):
+    """
+    A protocol which takes whole messages.
+    """
+
+    def messageReceived(self, data, binary):
+        self.received.append((data, binary))
+
+class BatchProtocol(RecordingProtocol):
+    """
+    A protocol which takes batches of whole messages.
+    """
+
+    def messagesReceived(self, messages):
+        self.received.append(messages)
+
+@implementer(IPushProducer)
+class FakeProducer(object):
+
+    paused = False
+    stopped = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+class RecordingFactory(Factory):
+    protocol = RecordingProtocol
+
+def connect(request=RFC6455_REQUEST, factory=None):
+    """
+    Build a wrapped protocol on a fake transport, and send it a handshake.
+    """
+
+    if factory is None:
+        factory = WebSocketFactory(RecordingFactory())
+    protocol = factory.buildProtocol(None)
+    transport = SequenceTransport()
+    protocol.makeConnection(transport)
+    if request:
+        protocol.dataReceived(request)
+    return protocol, transport
 
 class TestHTTPHeaders(unittest.TestCase):
 
@@ -179,6 +334,75 @@ class TestHyBi07Helpers(unittest.TestCase):
         key = b"\x00\x00\x00\x00"
         self.assertEqual(mask(b"LongTest", key), b"LongTest")
 
+    def test_mask_rfc(self):
+        """
+        The masked "Hello" from HyBi-10, 4.7.
+        """
+
+        key = b"7\xfa!="
+        self.assertEqual(mask(b"\x7f\x9fMQX", key), b"Hello")
+
+    def test_mask_phase(self):
+        """
+        Unmasking a payload in pieces, with each piece's phase, is the same as
+        unmasking it all at once.
+        """
+
+        key = b"\x12\x34\x56\x78"
+        data = os.urandom(37)
+        whole = mask(data, key)
+
+        pieces = b"".join(mask(data[i:i + 5], key, i)
+                          for i in range(0, len(data), 5))
+        self.assertEqual(pieces, whole)
+
+    def test_mask_engines(self):
+        """
+        Every available masking engine agrees with the reference loop.
+        """
+
+        engines = [txws._mask_int]
+        if txws.numpy is not None:
+            engines.append(txws._mask_numpy)
+
+        key = b"\xde\xad\xbe\xef"
+        for length in (0, 1, 3, 4, 5, 125, 4096, 4099):
+            data = os.urandom(length)
+            expected = txws._mask_loop(data, key)
+            for engine in engines:
+                self.assertEqual(engine(data, key), expected)
+
+    def test_make_hybi07_small(self):
+        self.assertEqual(txws.make_hybi07_frame(b"Hello"), b"\x81\x05Hello")
+        self.assertEqual(txws.make_hybi07_frame(b"", opcode=0x9), b"\x89\x00")
+
+    def test_make_hybi07_medium(self):
+        frame = txws.make_hybi07_frame(b"x" * 200, opcode=0x2)
+        self.assertEqual(frame[:4], b"\x82\x7e\x00\xc8")
+        self.assertEqual(len(frame), 204)
+
+    def test_make_hybi07_large(self):
+        frame = txws.make_hybi07_frame(b"x" * 70000, opcode=0x2)
+        self.assertEqual(frame[:10],
+                         b"\x82\x7f\x00\x00\x00\x00\x00\x01\x11\x70")
+        self.assertEqual(len(frame), 70010)
+
+    def test_make_hybi07_text_length(self):
+        """
+        Text frames are measured after encoding.
+        """
+
+        frame = txws.make_hybi07_frame(u"\u2603")
+        self.assertEqual(frame, b"\x81\x03\xe2\x98\x83")
+
+    def test_make_hybi07_roundtrip(self):
+        for length in (0, 125, 126, 0xffff, 0x10000):
+            payload = os.urandom(length)
+            frames, buf = parse_hybi07_frames(
+                txws.make_hybi07_frame(payload, opcode=0x2))
+            self.assertEqual(frames, [(NORMAL, payload)])
+            self.assertEqual(buf, b"")
+
     def test_parse_hybi07_unmasked_text(self):
         """
         From HyBi-10, 4.7.
@@ -291,3 +515,1689 @@ class TestHyBi07Helpers(unittest.TestCase):
         frames, buf = parse_hybi07_frames(frame)
         self.assertFalse(frames)
         self.assertEqual(buf, b"\x81\x05Hel")
+
+class TestHyBi07Decoder(unittest.TestCase):
+
+    def test_header_parsed_once(self):
+        """
+        Once a frame header has been seen, later reads don't parse it again.
+        """
+
+        calls = []
+
+        class CountingDecoder(txws.HyBi07Decoder):
+            def parseHeader(self, buf):
+                parsed = txws.HyBi07Decoder.parseHeader(self, buf)
+                if parsed:
+                    calls.append(buf.getvalue())
+                return parsed
+
+        decoder = CountingDecoder()
+
+        frame = make_frame(b"x" * 1000)
+        buf = ReceiveBuffer()
+        for i in range(0, len(frame), 100):
+            buf.feed(frame[i:i + 100])
+            frames = decoder.decode(buf)
+
+        self.assertEqual(frames, [(NORMAL, b"x" * 1000, True, True, 0x1)])
+        self.assertEqual(len(calls), 1)
+        self.assertFalse(buf)
+
+    def test_partial_header_kept(self):
+        decoder = txws.HyBi07Decoder()
+        buf = ReceiveBuffer(b"\x81\x85\x37\xfa")
+        self.assertEqual(decoder.decode(buf), [])
+        self.assertEqual(decoder.opcode, None)
+        self.assertEqual(buf.getvalue(), b"\x81\x85\x37\xfa")
+
+    def test_streaming_pieces(self):
+        """
+        In streaming mode, a data frame's payload is handed out as it
+        arrives, unmasked across piece boundaries.
+        """
+
+        decoder = txws.HyBi07Decoder(streaming=True)
+        payload = os.urandom(300)
+        frame = make_frame(payload, opcode=0x2)
+        buf = ReceiveBuffer()
+        pieces = []
+        for i in range(0, len(frame), 7):
+            buf.feed(frame[i:i + 7])
+            pieces.extend(decoder.decode(buf))
+            # Nothing but, at most, a partial header is ever kept around.
+            self.assertTrue(len(buf) < 8)
+
+        self.assertEqual(b"".join(piece[1] for piece in pieces), payload)
+        self.assertEqual([piece[2] for piece in pieces].count(True), 1)
+        self.assertTrue(pieces[-1][2])
+
+    def test_streaming_control_whole(self):
+        decoder = txws.HyBi07Decoder(streaming=True)
+        buf = ReceiveBuffer(make_frame(b"Hello", opcode=0x9)[:8])
+        self.assertEqual(decoder.decode(buf), [])
+        buf.feed(make_frame(b"Hello", opcode=0x9)[8:])
+        self.assertEqual(decoder.decode(buf),
+                         [(PING, b"Hello", True, True, 0x9)])
+
+    def test_oversized_length(self):
+        """
+        64-bit lengths with the top bit set are rejected.
+        """
+
+        buf = ReceiveBuffer(b"\x82\xff\x80" + b"\x00" * 7)
+        self.assertRaises(txws.WSException, txws.HyBi07Decoder().decode, buf)
+
+    def test_unexpected_continuation(self):
+        buf = ReceiveBuffer(make_frame(b"lo", opcode=0x0))
+        self.assertRaises(txws.WSException, txws.HyBi07Decoder().decode, buf)
+
+    def test_expected_continuation(self):
+        buf = ReceiveBuffer(make_frame(b"Hel", fin=False) + make_frame(b"lo"))
+        self.assertRaises(txws.WSException, txws.HyBi07Decoder().decode, buf)
+
+    def test_fragmented_control(self):
+        buf = ReceiveBuffer(make_frame(b"", opcode=0x9, fin=False))
+        self.assertRaises(txws.WSException, txws.HyBi07Decoder().decode, buf)
+
+    def test_max_frame_size(self):
+        """
+        Oversized frames are refused as soon as their header arrives.
+        """
+
+        decoder = txws.HyBi07Decoder(max_frame_size=100)
+        buf = ReceiveBuffer(make_frame(b"x" * 101)[:8])
+        try:
+            decoder.decode(buf)
+        except txws.WSException as wse:
+            self.assertEqual(wse.code, 1009)
+        else:
+            self.fail("Oversized frame accepted")
+
+    def test_max_message_size(self):
+        decoder = txws.HyBi07Decoder(max_message_size=100)
+        buf = ReceiveBuffer(make_frame(b"x" * 60, fin=False))
+        decoder.decode(buf)
+        buf.feed(make_frame(b"x" * 60, opcode=0x0)[:8])
+        self.assertRaises(txws.WSException, decoder.decode, buf)
+
+class TestReceiveBuffer(unittest.TestCase):
+
+    def test_feed_read(self):
+        buf = ReceiveBuffer()
+        buf.feed(b"Hello, ")
+        buf.feed(b"world")
+        self.assertEqual(len(buf), 12)
+        self.assertEqual(buf.read(5), b"Hello")
+        self.assertEqual(buf.getvalue(), b", world")
+
+    def test_find_relative(self):
+        buf = ReceiveBuffer(b"xx\r\nabc\r\n")
+        buf.skip(4)
+        self.assertEqual(buf.find(b"\r\n"), 3)
+        self.assertEqual(buf.find(b"zz"), -1)
+
+    def test_compaction(self):
+        """
+        Consumed data is dropped once it makes up half of the buffer, and the
+        buffer is emptied entirely once everything has been consumed.
+        """
+
+        buf = ReceiveBuffer(b"a" * 10)
+        buf.skip(4)
+        self.assertEqual(buf._pos, 4)
+        buf.skip(1)
+        self.assertEqual(buf._pos, 0)
+        self.assertEqual(buf.getvalue(), b"aaaaa")
+        buf.skip(5)
+        self.assertFalse(buf)
+        self.assertEqual(len(buf._data), 0)
+
+class TestWebSocketProtocol(unittest.TestCase):
+
+    def test_handshake(self):
+        protocol, transport = connect()
+        self.assertEqual(protocol.state, FRAMES)
+        self.assertTrue(b"s3pPLMBiTxaQ9kYGzzhZRbK+xOo=" in transport.value())
+
+    def test_handshake_one_write(self):
+        protocol, transport = connect()
+        self.assertEqual(len(transport.writes), 1)
+        response = transport.value()
+        self.assertTrue(response.startswith(b"HTTP/1.1 101 "))
+        self.assertTrue(response.endswith(b"\r\n\r\n"))
+
+    def test_handshake_hybi00_one_write(self):
+        protocol, transport = connect(HYBI00_REQUEST)
+        self.assertEqual(len(transport.writes), 1)
+        self.assertTrue(transport.value().endswith(b"8jKS'y:G*Co,Wxa-"))
+
+    def test_http_date(self):
+        self.assertEqual(txws.http_date(0), b"Thu, 01 Jan 1970 00:00:00 GMT")
+        self.assertTrue(txws.http_date(0.5) is txws.http_date(0))
+
+    def test_handshake_in_pieces(self):
+        protocol, transport = connect(request=None)
+        for i in range(len(RFC6455_REQUEST)):
+            protocol.dataReceived(RFC6455_REQUEST[i:i + 1])
+        self.assertEqual(protocol.state, FRAMES)
+
+    def test_handshake_headers(self):
+        """
+        Header names are matched without regard to case, and only the
+        headers which are needed, or asked for, are kept.
+        """
+
+        request = RFC6455_REQUEST.replace(b"Origin", b"oRIGIN").replace(
+            b"\r\n\r\n", b"\r\nCookie: a=b\r\nX-Junk: \xff\r\n\r\n")
+        factory = WebSocketFactory(RecordingFactory(),
+                                   extra_headers=["Cookie"],
+                                   keep_handshake=True)
+        protocol, transport = connect(request, factory=factory)
+        self.assertEqual(protocol.state, FRAMES)
+        self.assertEqual(protocol.origin, "http://example.com")
+        self.assertEqual(protocol.headers["Cookie"], "a=b")
+        self.assertFalse("X-Junk" in protocol.headers)
+
+    def test_handshake_forgotten(self):
+        protocol, transport = connect()
+        self.assertEqual(protocol.state, FRAMES)
+        self.assertEqual(protocol.headers, None)
+        self.assertEqual(protocol.location, "/chat")
+        self.assertEqual(protocol.host, None)
+        self.assertEqual(protocol.origin, None)
+
+    def test_keep_handshake(self):
+        factory = WebSocketFactory(RecordingFactory(), keep_handshake=True)
+        protocol, transport = connect(factory=factory)
+        self.assertEqual(protocol.host, "server.example.com")
+        self.assertEqual(protocol.headers["Sec-WebSocket-Version"], "13")
+
+    def test_queues_released(self):
+        """
+        Fragments and outgoing frames are only held in lists until they're
+        dealt with.
+        """
+
+        factory = WebSocketFactory(RecordingFactory(), coalesce_writes=True,
+                                   clock=Clock())
+        protocol, transport = connect(factory=factory)
+        protocol.dataReceived(make_frame(b"Hel", fin=False))
+        self.assertEqual(protocol.fragments, [b"Hel"])
+        protocol.dataReceived(make_frame(b"lo", opcode=0x0))
+        self.assertEqual(protocol.wrappedProtocol.received, [b"Hello"])
+        protocol.write(b"Hello")
+        self.assertFalse("pending_frames" in vars(protocol))
+        self.assertTrue(protocol.outgoing)
+        protocol.flushWrites()
+        for name in ("fragments", "pending_frames", "outgoing"):
+            self.assertFalse(name in vars(protocol), name)
+
+    def test_handshake_too_big(self):
+        factory = WebSocketFactory(RecordingFactory(), max_header_size=100)
+        protocol, transport = connect(request=None, factory=factory)
+        protocol.dataReceived(RFC6455_REQUEST[:50])
+        self.assertFalse(transport.disconnecting)
+        protocol.dataReceived(RFC6455_REQUEST[50:])
+        self.assertTrue(transport.value().startswith(b"HTTP/1.1 431 "))
+        self.assertTrue(transport.disconnecting)
+
+    def test_handshake_no_line_end(self):
+        factory = WebSocketFactory(RecordingFactory(), max_header_size=100)
+        protocol, transport = connect(b"G" * 101, factory=factory)
+        self.assertTrue(transport.value().startswith(b"HTTP/1.1 431 "))
+
+    def test_handshake_too_many_headers(self):
+        factory = WebSocketFactory(RecordingFactory(), max_headers=5)
+        protocol, transport = connect(factory=factory)
+        self.assertTrue(transport.value().startswith(b"HTTP/1.1 431 "))
+        self.assertNotEqual(protocol.state, FRAMES)
+
+    def test_bad_request_line(self):
+        protocol, transport = connect(b"GET /chat\r\n")
+        self.assertTrue(transport.value().startswith(b"HTTP/1.1 400 "))
+        self.assertTrue(transport.disconnecting)
+
+    def test_frames_in_pieces(self):
+        protocol, transport = connect()
+        data = make_frame(b"Hello") + make_frame(b"x" * 300)
+        for i in range(len(data)):
+            protocol.dataReceived(data[i:i + 1])
+        self.assertEqual(protocol.wrappedProtocol.received,
+                         [b"Hello", b"x" * 300])
+        self.assertFalse(protocol.buf)
+
+    def test_streaming(self):
+        factory = WebSocketFactory(RecordingFactory(), streaming=True)
+        protocol, transport = connect(factory=factory)
+        frame = make_frame(b"x" * 300, opcode=0x2)
+        protocol.dataReceived(frame[:100])
+        protocol.dataReceived(frame[100:])
+        self.assertEqual(protocol.wrappedProtocol.received,
+                         [b"x" * 92, b"x" * 208])
+
+    def test_fragments(self):
+        """
+        Fragmented messages are reassembled, even with control frames in the
+        middle of them.
+        """
+
+        protocol, transport = connect()
+        protocol.dataReceived(make_frame(b"Hel", fin=False) +
+                              make_frame(b"", opcode=0xa) +
+                              make_frame(b"lo", opcode=0x0))
+        self.assertEqual(protocol.wrappedProtocol.received, [b"Hello"])
+
+    def test_frame_too_large(self):
+        factory = WebSocketFactory(RecordingFactory(), max_frame_size=100)
+        protocol, transport = connect(factory=factory)
+        transport.clear()
+        protocol.dataReceived(make_frame(b"x" * 1000)[:8])
+        sent = transport.value()
+        self.assertEqual(sent[:1], b"\x88")
+        self.assertEqual(sent[2:4], b"\x03\xf1")
+        self.assertTrue(transport.disconnecting)
+        self.assertEqual(protocol.wrappedProtocol.received, [])
+
+    def test_ping_pong(self):
+        protocol, transport = connect()
+        transport.clear()
+        protocol.dataReceived(make_frame(b"Hello", opcode=0x9))
+        self.assertEqual(transport.value(), b"\x8a\x05Hello")
+        self.assertEqual(protocol.wrappedProtocol.received, [])
+
+    def test_keepalive_rtt(self):
+        clock = Clock()
+        factory = WebSocketFactory(RecordingFactory(), ping_interval=30,
+                                   clock=clock)
+        protocol, transport = connect(factory=factory)
+        transport.clear()
+
+        clock.advance(30)
+        ping = transport.value()
+        self.assertEqual(ping[:2], b"\x89\x08")
+
+        # A stale pong doesn't count.
+        clock.advance(0.5)
+        protocol.dataReceived(make_frame(b"stale", opcode=0xa))
+        self.assertEqual(protocol.rtt, None)
+
+        protocol.dataReceived(make_frame(ping[2:], opcode=0xa))
+        self.assertEqual(protocol.rtt, 0.5)
+
+        # And the pings keep coming, until the connection goes away.
+        transport.clear()
+        clock.advance(30)
+        self.assertEqual(transport.value()[:2], b"\x89\x08")
+        protocol.connectionLost(None)
+        self.assertFalse(clock.getDelayedCalls())
+
+    def test_handshake_timeout(self):
+        clock = Clock()
+        factory = WebSocketFactory(RecordingFactory(), handshake_timeout=10,
+                                   clock=clock)
+        protocol, transport = connect(request=RFC6455_REQUEST[:20],
+                                      factory=factory)
+        clock.advance(9)
+        self.assertFalse(transport.disconnecting)
+        clock.advance(1)
+        self.assertTrue(transport.disconnecting)
+
+    def test_handshake_timeout_finished(self):
+        clock = Clock()
+        factory = WebSocketFactory(RecordingFactory(), handshake_timeout=10,
+                                   clock=clock)
+        protocol, transport = connect(factory=factory)
+        clock.advance(10)
+        self.assertFalse(transport.disconnecting)
+        self.assertFalse(clock.getDelayedCalls())
+
+    def test_idle_timeout(self):
+        clock = Clock()
+        factory = WebSocketFactory(RecordingFactory(), idle_timeout=10,
+                                   clock=clock)
+        protocol, transport = connect(factory=factory)
+
+        # Chatty connections stay open.
+        for i in range(5):
+            clock.advance(5)
+            protocol.dataReceived(make_frame(b"Hello"))
+        self.assertFalse(transport.disconnecting)
+
+        transport.clear()
+        clock.pump([1] * 10)
+        self.assertTrue(transport.disconnecting)
+        self.assertEqual(transport.value()[2:4], b"\x03\xe9")
+
+    def test_timeouts_after_idle_wheel(self):
+        """
+        Timeouts count from when the connection was made, even if the wheel
+        has been sitting idle for a long time before it.
+        """
+
+        clock = Clock()
+        factory = WebSocketFactory(RecordingFactory(), handshake_timeout=10,
+                                   idle_timeout=60, clock=clock)
+        protocol, transport = connect(factory=factory)
+        protocol.connectionLost(None)
+        self.assertFalse(clock.getDelayedCalls())
+
+        clock.advance(3600)
+        protocol, transport = connect(request=RFC6455_REQUEST[:20],
+                                      factory=factory)
+        clock.advance(9)
+        self.assertFalse(transport.disconnecting)
+        clock.advance(1)
+        self.assertTrue(transport.disconnecting)
+
+        clock.advance(3600)
+        protocol, transport = connect(factory=factory)
+        clock.advance(59)
+        self.assertFalse(transport.disconnecting)
+        clock.advance(1)
+        self.assertTrue(transport.disconnecting)
+
+    def test_timer_wheel_shared(self):
+        """
+        However many connections there are, there's only one reactor call.
+        """
+
+        clock = Clock()
+        factory = WebSocketFactory(RecordingFactory(), handshake_timeout=10,
+                                   clock=clock)
+        for i in range(10):
+            connect(request=None, factory=factory)
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+
+    def test_write_large(self):
+        """
+        Large frames are written as a header and the untouched payload.
+        """
+
+        protocol, transport = connect()
+        transport.clear()
+        transport.writes = []
+        payload = b"x" * 70000
+        protocol.write(payload)
+        self.assertEqual(transport.writes,
+                         [[b"\x81\x7f\x00\x00\x00\x00\x00\x01\x11\x70",
+                           payload]])
+        self.assertTrue(transport.writes[0][1] is payload)
+
+    def test_write_binary(self):
+        protocol, transport = connect()
+        protocol.setBinaryMode(True)
+        transport.clear()
+        protocol.write(b"\x00\x01")
+        protocol.write(u"Hello")
+        self.assertEqual(transport.value(), b"\x82\x02\x00\x01\x81\x05Hello")
+
+    def test_coalesce(self):
+        clock = Clock()
+        factory = WebSocketFactory(RecordingFactory(), coalesce_writes=True,
+                                   clock=clock)
+        protocol, transport = connect(factory=factory)
+        transport.clear()
+        transport.writes = []
+
+        for i in range(3):
+            protocol.write(b"Hi")
+        self.assertEqual(transport.value(), b"")
+
+        clock.advance(0)
+        self.assertEqual(transport.value(), b"\x81\x02Hi" * 3)
+        self.assertEqual(len(transport.writes), 1)
+
+    def test_coalesce_max_bytes(self):
+        clock = Clock()
+        factory = WebSocketFactory(RecordingFactory(), coalesce_writes=True,
+                                   coalesce_max_bytes=10, clock=clock)
+        protocol, transport = connect(factory=factory)
+        transport.clear()
+        protocol.write(b"Hi")
+        protocol.write(b"Hello")
+        self.assertEqual(transport.value(), b"\x81\x02Hi\x81\x05Hello")
+        self.assertFalse(clock.getDelayedCalls())
+
+    def test_coalesce_close(self):
+        """
+        Closing the connection flushes coalesced frames before the close
+        frame.
+        """
+
+        clock = Clock()
+        factory = WebSocketFactory(RecordingFactory(), coalesce_writes=True,
+                                   clock=clock)
+        protocol, transport = connect(factory=factory)
+        transport.clear()
+        protocol.write(b"Hi")
+        protocol.close()
+        self.assertEqual(transport.value()[:4], b"\x81\x02Hi")
+        self.assertEqual(transport.value()[4:5], b"\x88")
+
+    def test_producer_transport_full(self):
+        """
+        The wrapped protocol's producer is paused while the transport is
+        full.
+        """
+
+        protocol, transport = connect()
+        producer = FakeProducer()
+        protocol.registerProducer(producer, True)
+        self.assertFalse(producer.paused)
+
+        transport.producer.pauseProducing()
+        self.assertTrue(producer.paused)
+        transport.producer.resumeProducing()
+        self.assertFalse(producer.paused)
+
+        protocol.unregisterProducer()
+        transport.producer.pauseProducing()
+        self.assertFalse(producer.paused)
+
+    def test_producer_watermarks(self):
+        """
+        Frames piling up before the handshake is done pause the producer,
+        until they've been sent.
+        """
+
+        factory = WebSocketFactory(RecordingFactory(),
+                                   write_high_watermark=10,
+                                   write_low_watermark=5)
+        protocol, transport = connect(request=None, factory=factory)
+        producer = FakeProducer()
+        protocol.registerProducer(producer, True)
+
+        protocol.write(b"x" * 6)
+        self.assertFalse(producer.paused)
+        protocol.write(b"x" * 6)
+        self.assertTrue(producer.paused)
+
+        protocol.dataReceived(RFC6455_REQUEST)
+        self.assertFalse(producer.paused)
+
+    def test_close_unregisters_monitor(self):
+        """
+        Closing a connection whose transport was full lets the transport
+        finish closing once it drains.
+        """
+
+        protocol = WebSocketFactory(RecordingFactory()).buildProtocol(None)
+        transport = ClosingTransport()
+        protocol.makeConnection(transport)
+        protocol.dataReceived(RFC6455_REQUEST)
+
+        transport.producer.pauseProducing()
+        protocol.write(b"x" * 1000)
+        protocol.close()
+        transport.drain()
+        self.assertTrue(transport.closed)
+
+    def test_close_pull_producer(self):
+        """
+        A pull producer unregistered while closing doesn't put the monitor
+        back.
+        """
+
+        protocol, transport = connect()
+        producer = FakeProducer()
+        protocol.registerProducer(producer, False)
+        protocol.close()
+        protocol.unregisterProducer()
+        self.assertEqual(transport.producer, None)
+
+    def test_pull_producer(self):
+        protocol, transport = connect()
+        producer = FakeProducer()
+        protocol.registerProducer(producer, False)
+        self.assertTrue(transport.producer is producer)
+        protocol.unregisterProducer()
+        self.assertTrue(transport.producer is protocol.monitor)
+
+    def test_pause_reading(self):
+        """
+        When the wrapped protocol pauses us, we stop reading, and frames
+        which were already read wait until we're resumed.
+        """
+
+        factory = WebSocketFactory(Factory.forProtocol(PausingProtocol))
+        protocol, transport = connect(factory=factory)
+        protocol.dataReceived(make_frame(b"one") + make_frame(b"two"))
+        protocol.dataReceived(make_frame(b"three"))
+
+        self.assertEqual(protocol.wrappedProtocol.received, [b"one"])
+        self.assertEqual(transport.producerState, "paused")
+
+        protocol.resumeProducing()
+        self.assertEqual(protocol.wrappedProtocol.received, [b"one", b"two"])
+        protocol.resumeProducing()
+        self.assertEqual(protocol.wrappedProtocol.received,
+                         [b"one", b"two", b"three"])
+
+    def test_unknown_option(self):
+        self.assertRaises(TypeError, WebSocketFactory, RecordingFactory(),
+                          bogus=True)
+        self.assertRaises(TypeError, WebSocketFactory, RecordingFactory(),
+                          buildProtocol=None)
+
+    def test_hybi00_frames(self):
+        protocol, transport = connect(HYBI00_REQUEST)
+        self.assertEqual(protocol.state, FRAMES)
+        self.assertTrue(transport.value().endswith(b"8jKS'y:G*Co,Wxa-"))
+        protocol.dataReceived(b"\x00Hel")
+        protocol.dataReceived(b"lo\xff\x00")
+        self.assertEqual(protocol.wrappedProtocol.received, [b"Hello"])
+
+class TestBroadcast(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = WebSocketFactory(RecordingFactory())
+        self.members = [connect(factory=self.factory) for i in range(3)]
+        self.members.append(connect(HYBI00_REQUEST, factory=self.factory))
+        for protocol, transport in self.members:
+            protocol.join("ticker")
+            transport.clear()
+            transport.writes = []
+
+    def test_publish(self):
+        """
+        Each wire variant is framed once, and shared by its members.
+        """
+
+        sent = self.factory.publish("ticker", b"tick")
+        self.assertEqual(sent, 4)
+
+        writes = [transport.writes for protocol, transport in self.members]
+        self.assertEqual(writes[0], [[b"\x81\x04", b"tick"]])
+        self.assertTrue(writes[0][0][0] is writes[1][0][0])
+        self.assertTrue(writes[0][0][0] is writes[2][0][0])
+        self.assertEqual(self.members[3][1].value(), b"\x00tick\xff")
+
+    def test_leave(self):
+        protocol, transport = self.members[0]
+        protocol.leave("ticker")
+        self.assertEqual(self.factory.publish("ticker", b"tick"), 3)
+        self.assertEqual(transport.value(), b"")
+
+    def test_connection_lost(self):
+        for protocol, transport in self.members:
+            protocol.connectionLost(None)
+        self.assertEqual(self.factory.groups, {})
+
+    def test_before_handshake(self):
+        protocol, transport = connect(request=None, factory=self.factory)
+        protocol.join("ticker")
+        self.factory.publish("ticker", b"tick")
+        protocol.dataReceived(RFC6455_REQUEST)
+        self.assertTrue(transport.value().endswith(b"\x81\x04tick"))
+
+    def test_slow_drop(self):
+        protocol, transport = self.members[0]
+        transport.producer.pauseProducing()
+        self.assertEqual(self.factory.publish("ticker", b"tick"), 3)
+        self.assertEqual(transport.value(), b"")
+        self.assertFalse(transport.disconnecting)
+
+    def test_slow_disconnect(self):
+        self.factory.slow_consumer_policy = "disconnect"
+        protocol, transport = self.members[0]
+        transport.producer.pauseProducing()
+        self.assertEqual(self.factory.publish("ticker", b"tick"), 3)
+        self.assertTrue(transport.disconnecting)
+        self.assertEqual(len(self.factory.groups["ticker"]), 3)
+
+DEFLATE_REQUEST = RFC6455_REQUEST.replace(
+    b"\r\n\r\n",
+    b"\r\nSec-WebSocket-Extensions: permessage-deflate; "
+    b"client_max_window_bits\r\n\r\n")
+
+def deflate(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return (compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+def inflate(data):
+    return zlib.decompressobj(-15).decompress(data + b"\x00\x00\xff\xff")
+
+class TestPerMessageDeflate(unittest.TestCase):
+
+    def negotiate(self, header, **options):
+        factory = WebSocketFactory(RecordingFactory(), permessage_deflate=True,
+                                   **options)
+        deflate = txws.negotiate_deflate(txws.parse_extensions(header),
+                                         factory)
+        return deflate and deflate.response()
+
+    def test_parse_extensions(self):
+        self.assertEqual(
+            txws.parse_extensions("permessage-deflate; client_max_window_bits"
+                                  "; server_max_window_bits=10, x-foo"),
+            [("permessage-deflate", {"client_max_window_bits": None,
+                                     "server_max_window_bits": "10"}),
+             ("x-foo", {})])
+
+    def test_negotiate_plain(self):
+        self.assertEqual(self.negotiate("permessage-deflate"),
+                         "permessage-deflate")
+
+    def test_negotiate_params(self):
+        self.assertEqual(
+            self.negotiate("permessage-deflate; server_no_context_takeover; "
+                           "server_max_window_bits=10; "
+                           "client_max_window_bits",
+                           deflate_client_window_bits=12),
+            "permessage-deflate; server_no_context_takeover; "
+            "server_max_window_bits=10; client_max_window_bits=12")
+
+    def test_negotiate_client_no_context_takeover(self):
+        self.assertEqual(
+            self.negotiate("permessage-deflate",
+                           deflate_client_no_context_takeover=True),
+            "permessage-deflate; client_no_context_takeover")
+
+    def test_negotiate_fallback(self):
+        """
+        Offers with bad parameters are skipped in favor of later ones.
+        """
+
+        self.assertEqual(
+            self.negotiate("permessage-deflate; bogus, "
+                           "permessage-deflate; server_max_window_bits=16, "
+                           "permessage-deflate; server_max_window_bits=8, "
+                           "permessage-deflate; client_max_window_bits=9"),
+            "permessage-deflate; client_max_window_bits=9")
+        self.assertEqual(self.negotiate("x-webkit-deflate-frame"), None)
+
+    def test_not_offered(self):
+        factory = WebSocketFactory(RecordingFactory(), permessage_deflate=True)
+        protocol, transport = connect(factory=factory)
+        self.assertFalse(b"Extensions" in transport.value())
+        self.assertEqual(protocol.deflate, None)
+
+    def test_not_enabled(self):
+        protocol, transport = connect(DEFLATE_REQUEST)
+        self.assertFalse(b"Extensions" in transport.value())
+        protocol.dataReceived(make_frame(deflate(b"Hello"), rsv1=True))
+        self.assertTrue(transport.disconnecting)
+
+    def connect(self, **options):
+        factory = WebSocketFactory(RecordingFactory(), permessage_deflate=True,
+                                   **options)
+        protocol, transport = connect(DEFLATE_REQUEST, factory=factory)
+        self.assertTrue(b"Sec-WebSocket-Extensions: permessage-deflate; "
+                        b"client_max_window_bits=15\r\n" in transport.value())
+        transport.clear()
+        return protocol, transport
+
+    def test_receive(self):
+        protocol, transport = self.connect()
+        protocol.dataReceived(make_frame(deflate(b"Hello"), rsv1=True))
+        protocol.dataReceived(make_frame(b"plain"))
+        self.assertEqual(protocol.wrappedProtocol.received,
+                         [b"Hello", b"plain"])
+
+    def test_receive_fragmented(self):
+        protocol, transport = self.connect()
+        data = deflate(b"Hello, world")
+        protocol.dataReceived(make_frame(data[:4], fin=False, rsv1=True))
+        protocol.dataReceived(make_frame(data[4:], opcode=0x0))
+        self.assertEqual(protocol.wrappedProtocol.received,
+                         [b"Hello, world"])
+
+    def test_receive_streaming(self):
+        protocol, transport = self.connect(streaming=True)
+        payload = os.urandom(1000)
+        frame = make_frame(deflate(payload), rsv1=True)
+        for i in range(0, len(frame), 100):
+            protocol.dataReceived(frame[i:i + 100])
+        self.assertEqual(b"".join(protocol.wrappedProtocol.received), payload)
+
+    def test_receive_bomb(self):
+        protocol, transport = self.connect(deflate_max_size=1000)
+        protocol.dataReceived(make_frame(deflate(b"\x00" * 1000000),
+                                         rsv1=True))
+        self.assertEqual(protocol.wrappedProtocol.received, [])
+        self.assertEqual(transport.value()[2:4], b"\x03\xf1")
+
+    def test_rsv1_on_continuation(self):
+        protocol, transport = self.connect()
+        protocol.dataReceived(make_frame(deflate(b"Hel"), fin=False,
+                                         rsv1=True))
+        protocol.dataReceived(make_frame(b"lo", opcode=0x0, rsv1=True))
+        self.assertEqual(transport.value()[2:4], b"\x03\xea")
+
+    def test_send(self):
+        protocol, transport = self.connect()
+        protocol.write(b"x" * 100)
+        protocol.write(b"x" * 100)
+        protocol.write(b"tiny")
+
+        frames, rest = txws.parse_hybi07_frames(
+            transport.value().replace(b"\xc1", b"\x81"))
+        self.assertEqual(transport.value()[:1], b"\xc1")
+        self.assertEqual(inflate(frames[0][1]), b"x" * 100)
+        # The second message reuses the first one's context.
+        decompressor = zlib.decompressobj(-15)
+        decompressor.decompress(frames[0][1] + b"\x00\x00\xff\xff")
+        self.assertEqual(
+            decompressor.decompress(frames[1][1] + b"\x00\x00\xff\xff"),
+            b"x" * 100)
+        self.assertTrue(len(frames[1][1]) < len(frames[0][1]))
+        self.assertEqual(frames[2][1], b"tiny")
+
+    def test_broadcast(self):
+        """
+        Connections with their own compression context are framed
+        individually; the others share.
+        """
+
+        factory = WebSocketFactory(RecordingFactory(), permessage_deflate=True)
+        takeover = connect(DEFLATE_REQUEST, factory=factory)
+        request = DEFLATE_REQUEST.replace(b"window_bits",
+                                          b"window_bits; "
+                                          b"server_no_context_takeover")
+        fresh = [connect(request, factory=factory) for i in range(2)]
+        for protocol, transport in [takeover] + fresh:
+            protocol.join("ticker")
+            transport.writes = []
+
+        factory.publish("ticker", b"x" * 100)
+        self.assertTrue(fresh[0][1].writes[0][1] is fresh[1][1].writes[0][1])
+        self.assertEqual(inflate(takeover[1].writes[0][1]), b"x" * 100)
+        self.assertEqual(inflate(fresh[0][1].writes[0][1]), b"x" * 100)
+
+class DeferringFactory(WebSocketFactory):
+    """
+    A factory which keeps hold of work meant for its thread pool, so that
+    tests can finish it whenever they like.
+    """
+
+    def __init__(self, *args, **kwargs):
+        WebSocketFactory.__init__(self, *args, **kwargs)
+        self.work = []
+
+    def deferToThread(self, f, *args, **kwargs):
+        d = Deferred()
+        self.work.append((d, f, args, kwargs))
+        return d
+
+    def finish(self):
+        d, f, args, kwargs = self.work.pop(0)
+        try:
+            result = f(*args, **kwargs)
+        except Exception:
+            d.errback()
+        else:
+            d.callback(result)
+
+class TestOffload(unittest.TestCase):
+
+    def test_small_inline(self):
+        factory = DeferringFactory(RecordingFactory(), offload_threshold=100)
+        protocol, transport = connect(factory=factory)
+        protocol.dataReceived(make_frame(b"x" * 99))
+        self.assertEqual(factory.work, [])
+        self.assertEqual(protocol.wrappedProtocol.received, [b"x" * 99])
+
+    def test_order(self):
+        """
+        Messages behind one in the thread pool wait for it, and reading
+        stops in the meantime.
+        """
+
+        factory = DeferringFactory(RecordingFactory(), offload_threshold=100)
+        protocol, transport = connect(factory=factory)
+        received = protocol.wrappedProtocol.received
+        protocol.dataReceived(make_frame(b"x" * 100, fin=False) +
+                              make_frame(b"y" * 100, opcode=0x0) +
+                              make_frame(b"small"))
+        protocol.dataReceived(make_frame(b"later"))
+        self.assertEqual(len(factory.work), 1)
+        self.assertEqual(received, [])
+        self.assertEqual(transport.producerState, "paused")
+
+        factory.finish()
+        self.assertEqual(received,
+                         [b"x" * 100 + b"y" * 100, b"small", b"later"])
+        self.assertEqual(transport.producerState, "producing")
+
+    def test_inflate(self):
+        factory = DeferringFactory(RecordingFactory(), offload_threshold=10,
+                                   permessage_deflate=True)
+        protocol, transport = connect(DEFLATE_REQUEST, factory=factory)
+        protocol.dataReceived(make_frame(deflate(b"x" * 1000), rsv1=True))
+        factory.finish()
+        self.assertEqual(protocol.wrappedProtocol.received, [b"x" * 1000])
+
+    def test_failure(self):
+        factory = DeferringFactory(RecordingFactory(), offload_threshold=10,
+                                   permessage_deflate=True)
+        protocol, transport = connect(DEFLATE_REQUEST, factory=factory)
+        protocol.dataReceived(make_frame(b"\xff" * 100, rsv1=True))
+        factory.finish()
+        self.assertTrue(transport.disconnecting)
+        close = transport.value().split(b"\r\n\r\n", 1)[1]
+        self.assertEqual(close[2:4], b"\x03\xef")
+
+    def test_codec_error(self):
+        """
+        Unexpected errors from a codec close the connection with 1011,
+        rather than leaving it hanging.
+        """
+
+        def decoder(data):
+            raise ValueError("Broken codec")
+
+        txws.register_codec("broken", lambda data: data, decoder)
+        self.addCleanup(txws.encoders.pop, "broken")
+        self.addCleanup(txws.decoders.pop, "broken")
+
+        request = RFC6455_REQUEST.replace(
+            b"\r\n\r\n", b"\r\nSec-WebSocket-Protocol: broken\r\n\r\n")
+        factory = DeferringFactory(RecordingFactory(), offload_threshold=10)
+        protocol, transport = connect(request, factory=factory)
+        transport.clear()
+        protocol.dataReceived(make_frame(b"x" * 100))
+        self.assertEqual(transport.producerState, "paused")
+
+        factory.finish()
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertTrue(transport.disconnecting)
+        self.assertEqual(transport.value()[2:4], b"\x03\xf3")
+        self.assertEqual(transport.producerState, "producing")
+        self.assertEqual(protocol.wrappedProtocol.received, [])
+
+    def test_lost(self):
+        factory = DeferringFactory(RecordingFactory(), offload_threshold=10)
+        protocol, transport = connect(factory=factory)
+        received = protocol.wrappedProtocol.received
+        protocol.dataReceived(make_frame(b"x" * 100))
+        protocol.connectionLost(None)
+        factory.finish()
+        self.assertEqual(received, [])
+
+    def test_threadpool(self):
+        pool = ThreadPool(0, 1)
+        pool.start()
+        self.addCleanup(pool.stop)
+        factory = WebSocketFactory(RecordingFactory(), offload_threshold=10,
+                                   threadpool=pool)
+        protocol, transport = connect(factory=factory)
+        received = protocol.wrappedProtocol.received
+
+        results = []
+        deferToThread = factory.deferToThread
+        def recordingDeferToThread(*args):
+            d = deferToThread(*args)
+            results.append(d)
+            return d
+        factory.deferToThread = recordingDeferToThread
+
+        protocol.dataReceived(make_frame(b"x" * 100) + make_frame(b"y"))
+        d = results[0]
+        d.addCallback(lambda ignored: self.assertEqual(received,
+                                                       [b"x" * 100, b"y"]))
+        return d
+
+class TestCodecs(unittest.TestCase):
+
+    def test_negotiate(self):
+        self.assertEqual(txws.negotiate_codec("base64, binary"), "binary")
+        self.assertEqual(txws.negotiate_codec("base64, binary", False),
+                         "base64")
+        self.assertEqual(txws.negotiate_codec("chat, base64"), "base64")
+        self.assertEqual(txws.negotiate_codec("chat"), None)
+
+    def test_base64_decoder(self):
+        decoder = txws.Base64Decoder()
+        data = b"".join(decoder.decode(piece, False)
+                        for piece in (b"SGVsbG", b"8sIHd", b"vcmxk"))
+        data += decoder.decode(b"IQ==")
+        self.assertEqual(data, b"Hello, world!")
+        self.assertEqual(decoder.pending, b"")
+
+    def test_binary(self):
+        request = RFC6455_REQUEST.replace(
+            b"\r\n\r\n", b"\r\nSec-WebSocket-Protocol: base64, binary\r\n\r\n")
+        protocol, transport = connect(request)
+        self.assertTrue(b"Sec-WebSocket-Protocol: binary\r\n"
+                        in transport.value())
+
+        protocol.dataReceived(make_frame(b"\x00\xff", opcode=0x2))
+        self.assertEqual(protocol.wrappedProtocol.received, [b"\x00\xff"])
+
+        transport.clear()
+        protocol.write(b"\x00\xff")
+        self.assertEqual(transport.value(), b"\x82\x02\x00\xff")
+
+    def test_base64(self):
+        request = RFC6455_REQUEST.replace(
+            b"\r\n\r\n", b"\r\nSec-WebSocket-Protocol: base64\r\n\r\n")
+        protocol, transport = connect(request)
+        protocol.dataReceived(make_frame(b"AP8="))
+        self.assertEqual(protocol.wrappedProtocol.received, [b"\x00\xff"])
+
+        transport.clear()
+        protocol.write(b"\x00\xff")
+        self.assertEqual(transport.value(), b"\x81\x04AP8=")
+
+    def test_base64_streaming(self):
+        """
+        With streaming, base64 is decoded as it arrives, even when groups of
+        characters are split across frames.
+        """
+
+        request = RFC6455_REQUEST.replace(
+            b"\r\n\r\n", b"\r\nSec-WebSocket-Protocol: base64\r\n\r\n")
+        factory = WebSocketFactory(RecordingFactory(), streaming=True)
+        protocol, transport = connect(request, factory=factory)
+        protocol.dataReceived(make_frame(b"SGVsbG", fin=False))
+        protocol.dataReceived(make_frame(b"8sIHdvcmxkIQ==", opcode=0x0))
+        received = protocol.wrappedProtocol.received
+        self.assertEqual(received[0], b"Hel")
+        self.assertEqual(b"".join(received), b"Hello, world!")
+
+    def test_base64_fragments(self):
+        """
+        Without streaming, fragments of base64 messages are still decoded
+        as they arrive, and only the decoded message is put together.
+        """
+
+        request = RFC6455_REQUEST.replace(
+            b"\r\n\r\n", b"\r\nSec-WebSocket-Protocol: base64\r\n\r\n")
+        protocol, transport = connect(request)
+        protocol.dataReceived(make_frame(b"SGVsbG", fin=False))
+        self.assertEqual(protocol.fragments, [b"Hel"])
+        protocol.dataReceived(make_frame(b"8sIHdvcmxkIQ==", opcode=0x0))
+        self.assertEqual(protocol.wrappedProtocol.received, [b"Hello, world!"])
+
+    def test_bad_base64(self):
+        request = RFC6455_REQUEST.replace(
+            b"\r\n\r\n", b"\r\nSec-WebSocket-Protocol: base64\r\n\r\n")
+        protocol, transport = connect(request)
+        protocol.dataReceived(make_frame(b"A"))
+        self.assertTrue(transport.disconnecting)
+
+class TestMessages(unittest.TestCase):
+
+    def connect(self, protocol, request=RFC6455_REQUEST, **options):
+        factory = WebSocketFactory(RecordingFactory(), **options)
+        factory.wrappedFactory.protocol = protocol
+        return connect(request, factory=factory)
+
+    def test_message(self):
+        protocol, transport = self.connect(MessageProtocol)
+        protocol.dataReceived(make_frame(b"Hello"))
+        protocol.dataReceived(make_frame(b"\x00\x01", opcode=0x2, fin=False) +
+                              make_frame(b"\x02", opcode=0x0))
+        self.assertEqual(protocol.wrappedProtocol.received,
+                         [(b"Hello", False), (b"\x00\x01\x02", True)])
+
+    def test_batch(self):
+        protocol, transport = self.connect(BatchProtocol)
+        protocol.dataReceived(make_frame(b"Hello") +
+                              make_frame(b"\x00", opcode=0x2))
+        protocol.dataReceived(make_frame(b"there"))
+        self.assertEqual(protocol.wrappedProtocol.received,
+                         [[(b"Hello", False), (b"\x00", True)],
+                          [(b"there", False)]])
+
+    def test_no_streaming(self):
+        """
+        Protocols which take whole messages get whole messages, even when
+        streaming.
+        """
+
+        protocol, transport = self.connect(MessageProtocol, streaming=True)
+        frame = make_frame(b"x" * 1000)
+        protocol.dataReceived(frame[:500])
+        protocol.dataReceived(frame[500:])
+        self.assertEqual(protocol.wrappedProtocol.received,
+                         [(b"x" * 1000, False)])
+
+    def test_hybi00(self):
+        protocol, transport = self.connect(MessageProtocol, HYBI00_REQUEST)
+        protocol.dataReceived(b"\x00Hello\xff\x00there\xff")
+        self.assertEqual(protocol.wrappedProtocol.received,
+                         [(b"Hello", False), (b"there", False)])
+
+class TestRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.chat = RecordingFactory()
+        self.feeds = RecordingFactory()
+        self.news = RecordingFactory()
+        self.factory = txws.RoutingWebSocketFactory({
+            "/chat": self.chat,
+            "/feeds/": self.feeds,
+            "/feeds/news/": self.news,
+        })
+
+    def test_route(self):
+        route = self.factory.route
+        self.assertTrue(route("/chat") is self.chat)
+        self.assertTrue(route("/chat?room=1") is self.chat)
+        self.assertTrue(route("/feeds/") is self.feeds)
+        self.assertTrue(route("/feeds/weather") is self.feeds)
+        self.assertTrue(route("/feeds/news/today") is self.news)
+        self.assertEqual(route("/chat/room"), None)
+        self.assertEqual(route("/feeds"), None)
+
+    def test_default(self):
+        default = RecordingFactory()
+        factory = txws.RoutingWebSocketFactory({"/chat": self.chat}, default)
+        self.assertTrue(factory.route("/other") is default)
+
+    def test_connect(self):
+        protocol, transport = connect(request=None, factory=self.factory)
+        self.assertEqual(protocol.wrappedProtocol, None)
+        protocol.dataReceived(RFC6455_REQUEST + make_frame(b"Hello"))
+        self.assertTrue(protocol.wrappedProtocol.factory is self.chat)
+        self.assertEqual(protocol.wrappedProtocol.received, [b"Hello"])
+
+    def test_refused(self):
+        """
+        If the routed factory won't build a protocol, the connection is
+        closed, and any frames which came along with the handshake are
+        dropped.
+        """
+
+        self.chat.buildProtocol = lambda addr: None
+        protocol, transport = connect(request=None, factory=self.factory)
+        protocol.dataReceived(RFC6455_REQUEST + make_frame(b"Hello"))
+        self.assertEqual(protocol.wrappedProtocol, None)
+        self.assertTrue(transport.disconnecting)
+        close = transport.value().split(b"\r\n\r\n", 1)[1]
+        self.assertEqual(close[2:4], b"\x03\xf3")
+
+    def test_hybi00(self):
+        request = HYBI00_REQUEST.replace(b"/demo", b"/feeds/news/")
+        protocol, transport = connect(request, factory=self.factory)
+        self.assertEqual(protocol.state, FRAMES)
+        self.assertTrue(protocol.wrappedProtocol.factory is self.news)
+
+    def test_not_found(self):
+        request = RFC6455_REQUEST.replace(b"/chat", b"/nowhere")
+        protocol, transport = connect(request, factory=self.factory)
+        self.assertTrue(transport.value().startswith(b"HTTP/1.1 404 "))
+        self.assertTrue(transport.disconnecting)
+        protocol.connectionLost(None)
+        self.assertEqual(self.factory.protocols, {})
+
+class FakeProcess(object):
+
+    def __init__(self):
+        self.signals = []
+
+    def signalProcess(self, signum):
+        self.signals.append(signum)
+
+class ProcessClock(Clock):
+    """
+    A clock which pretends to start processes, too.
+    """
+
+    def __init__(self):
+        Clock.__init__(self)
+        self.spawned = []
+
+    def spawnProcess(self, protocol, executable, args, env=None,
+                     childFDs=None):
+        process = FakeProcess()
+        self.spawned.append((protocol, args, process))
+        return process
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        # Don't let supervisors take over the test runner's signals.
+        self.patch(txws, "forwarded_signals", [])
+
+    def test_counters(self):
+        protocol, transport = connect()
+        factory = protocol.factory
+        protocol.dataReceived(make_frame(b"Hello"))
+        protocol.write(b"Hi")
+        snapshot = factory.snapshot()
+        self.assertEqual(dict((name, snapshot[name]) for name in
+                              ("connections", "connections_total",
+                               "bytes_received", "bytes_sent")), {
+            "connections": 1,
+            "connections_total": 1,
+            "bytes_received": len(RFC6455_REQUEST) + 11,
+            "bytes_sent": len(transport.value()),
+        })
+        protocol.connectionLost(None)
+        self.assertEqual(factory.connections, 0)
+
+    def test_listen_reuseport(self):
+        factory = WebSocketFactory(RecordingFactory())
+        first = txws.listen_reuseport(0, factory, "127.0.0.1")
+        self.addCleanup(first.stopListening)
+        port = first.getHost().port
+        second = txws.listen_reuseport(port, factory, "127.0.0.1")
+        self.addCleanup(second.stopListening)
+        self.assertEqual(second.getHost().port, port)
+
+    def test_supervisor(self):
+        clock = ProcessClock()
+        supervisor = txws.WorkerSupervisor("echo.factory", 8080, workers=2,
+                                           reactor=clock)
+        supervisor.start()
+        self.assertEqual(len(clock.spawned), 2)
+        self.assertEqual(clock.spawned[0][1][-1], "echo.factory")
+
+        first, second = [spawned[0] for spawned in clock.spawned]
+        first.childDataReceived(3, b'{"bytes_sent": 10, "connec')
+        first.childDataReceived(3, b'tions": 2}\n')
+        second.childDataReceived(3, b'{"bytes_sent": 5, "connections": 1}\n')
+        self.assertEqual(supervisor.totals(), {"bytes_sent": 15,
+                                               "connections": 3,
+                                               "workers": 2, "restarts": 0})
+
+        # Dead workers' totals are kept, and they come back after a while.
+        first.processEnded(Failure(ProcessTerminated(signal=9)))
+        self.assertEqual(supervisor.totals(), {"bytes_sent": 15,
+                                               "connections": 1,
+                                               "workers": 1, "restarts": 1})
+        clock.advance(supervisor.restart_delay)
+        self.assertEqual(len(clock.spawned), 3)
+
+        supervisor.forwardSignal(signal.SIGHUP)
+        self.assertEqual(clock.spawned[1][2].signals, [signal.SIGHUP])
+
+    def test_supervisor_stop(self):
+        clock = ProcessClock()
+        supervisor = txws.WorkerSupervisor("echo.factory", 8080, workers=2,
+                                           reactor=clock)
+        supervisor.start()
+        d = supervisor.stop()
+        stopped = []
+        d.addCallback(stopped.append)
+        for protocol, args, process in clock.spawned:
+            self.assertEqual(process.signals, [signal.SIGTERM])
+            protocol.processEnded(Failure(ProcessDone(0)))
+        self.assertEqual(stopped, [None])
+        clock.advance(supervisor.restart_delay)
+        self.assertEqual(len(clock.spawned), 2)
+
+class UNIXClock(Clock):
+    """
+    A clock which pretends to make Unix socket connections, too.
+    """
+
+    def __init__(self):
+        Clock.__init__(self)
+        self.connections = []
+
+    def connectUNIX(self, address, factory):
+        self.connections.append((address, factory))
+
+class TestMessageBus(unittest.TestCase):
+
+    def bus(self, name):
+        factory = WebSocketFactory(RecordingFactory())
+        clock = UNIXClock()
+        return txws.MessageBus(factory, "bus", name, reactor=clock), clock
+
+    def link(self, sender, receiver):
+        """
+        Connect one bus to another, over fake transports, returning both ends
+        of the connection.
+        """
+
+        outgoing = txws.BusPeer(sender, receiver.name)
+        outgoing.makeConnection(SequenceTransport())
+        incoming = txws.BusPeer(receiver)
+        incoming.makeConnection(StringTransport())
+        return outgoing, incoming
+
+    def pump(self, clock, outgoing, incoming):
+        clock.advance(0)
+        incoming.dataReceived(outgoing.transport.value())
+        outgoing.transport.clear()
+
+    def test_publish(self):
+        a, a_clock = self.bus("a")
+        b, b_clock = self.bus("b")
+        outgoing, incoming = self.link(a, b)
+        self.pump(a_clock, outgoing, incoming)
+        # B heard hello, and wants to talk back.
+        self.assertEqual(b_clock.connections[0][0], os.path.join("bus",
+                                                                 "a.sock"))
+        self.assertEqual(b.incoming, set([incoming]))
+
+        protocol, transport = connect(factory=b.factory)
+        protocol.join("ticker")
+        transport.clear()
+
+        a.factory.publish("ticker", b"Hello")
+        self.pump(a_clock, outgoing, incoming)
+        self.assertEqual(transport.value(), b"\x81\x05Hello")
+        self.assertEqual(b.variants, set([(False, None, False)]))
+
+        # Once A knows what B needs, messages arrive already framed.
+        back, back_incoming = self.link(b, a)
+        self.pump(b_clock, back, back_incoming)
+        self.assertEqual(a.peer_variants, {"b": set([(False, None, False)])})
+
+        calls = []
+        self.patch(txws, "frame_parts",
+                   lambda *args: calls.append(args) or [b"\x81\x01", b"x"])
+        transport.clear()
+        a.factory.publish("ticker", b"Hello")
+        self.pump(a_clock, outgoing, incoming)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(transport.value(), b"\x81\x01x")
+
+    def test_batching(self):
+        a, a_clock = self.bus("a")
+        b, b_clock = self.bus("b")
+        outgoing, incoming = self.link(a, b)
+        a.send("ticker", b"one", {})
+        a.send("ticker", b"two", {})
+        a_clock.advance(0)
+        # The hello and both messages go out together.
+        self.assertEqual(len(outgoing.transport.writes), 1)
+        incoming.dataReceived(outgoing.transport.value())
+        self.assertEqual(b.received, 2)
+
+    def test_slow_peer(self):
+        a, a_clock = self.bus("a")
+        b, b_clock = self.bus("b")
+        outgoing, incoming = self.link(a, b)
+        outgoing.pauseProducing()
+        a.send("ticker", b"one", {})
+        self.assertEqual(a.snapshot()["bus_dropped"], 1)
+        self.assertEqual(a.factory.snapshot()["bus_slow_peers"], 1)
+        outgoing.resumeProducing()
+        a.send("ticker", b"two", {})
+        self.assertEqual(a.sent, 1)
+
+    def test_oversized(self):
+        a, a_clock = self.bus("a")
+        peer = txws.BusPeer(a)
+        peer.makeConnection(StringTransport())
+        peer.dataReceived(pack(">IH", a.max_message_size + 1, 0))
+        self.assertTrue(peer.transport.disconnecting)
+
+    def test_sockets(self):
+        """
+        Buses find each other through their directory, and carry broadcasts
+        over real sockets.
+        """
+
+        from twisted.internet import reactor, task
+
+        directory = self.mktemp()
+        os.mkdir(directory)
+        buses = []
+        for name in ("a", "b"):
+            bus = txws.MessageBus(WebSocketFactory(RecordingFactory()),
+                                  directory, name)
+            bus.start()
+            self.addCleanup(bus.stop)
+            buses.append(bus)
+        a, b = buses
+        protocol, transport = connect(factory=b.factory)
+        protocol.join("ticker")
+        transport.clear()
+
+        def wait(condition, tries=500):
+            if condition():
+                return
+            if not tries:
+                self.fail("Gave up waiting")
+            return task.deferLater(reactor, 0.01, wait, condition, tries - 1)
+
+        d = wait(lambda: "b" in a.peers and "a" in b.peers)
+        d.addCallback(lambda ignored: a.factory.publish("ticker", b"Hello"))
+        d.addCallback(lambda ignored: wait(lambda: transport.value()))
+        d.addCallback(lambda ignored: self.assertEqual(transport.value(),
+                                                       b"\x81\x05Hello"))
+        return d
+
+@implementer(ITransport)
+class NullTransport(object):
+    """
+    A transport which is as small as can be, and forgets everything.
+    """
+
+    __slots__ = ()
+
+    disconnecting = False
+
+    def write(self, data):
+        pass
+
+    def writeSequence(self, seq):
+        pass
+
+    def loseConnection(self):
+        pass
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+class TestMemory(unittest.TestCase):
+
+    if tracemalloc is None:
+        skip = "tracemalloc is not available"
+
+    # Generous, so that this only fails if something big gets left behind on
+    # every connection.
+    budget = 1200
+
+    def test_idle_connection_size(self):
+        """
+        Idle connections, handshake done and a message read, take up no more
+        than a budgeted number of bytes each.
+        """
+
+        # CPython shares attribute layouts between instances of a class, and
+        # gives up on that once enough different attributes have been set
+        # on them, as the rest of these tests do; start with a fresh class.
+        factory = WebSocketFactory(Factory.forProtocol(Protocol))
+        factory.protocol = type("IdleProtocol", (factory.protocol,), {})
+        transport = NullTransport()
+        request = RFC6455_REQUEST + make_frame(b"Hello")
+
+        def idle(count):
+            protocols = []
+            for i in range(count):
+                protocol = factory.buildProtocol(None)
+                protocol.makeConnection(transport)
+                protocol.dataReceived(request)
+                protocols.append(protocol)
+            return protocols
+
+        # Warm up whatever gets cached on the first connections.
+        warm = idle(10)
+        count = 1000
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        before = tracemalloc.get_traced_memory()[0]
+        protocols = idle(count)
+        size = (tracemalloc.get_traced_memory()[0] - before) // count
+        self.assertEqual(protocols[-1].state, FRAMES)
+        self.assertTrue(size <= self.budget,
+                        "%d bytes per idle connection" % size)
+
+class TestLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        globalLogPublisher.addObserver(self.events.append)
+        self.addCleanup(globalLogPublisher.removeObserver,
+                        self.events.append)
+
+    def namespaced(self, prefix="txws."):
+        return [event for event in self.events
+                if event.get("log_namespace", "").startswith(prefix)]
+
+    def test_quiet_by_default(self):
+        protocol, transport = connect()
+        protocol.dataReceived(make_frame(b"", opcode=0x8))
+        self.assertEqual(self.namespaced(), [])
+
+    def test_log_connections(self):
+        factory = WebSocketFactory(RecordingFactory(), log_connections=True)
+        protocol, transport = connect(factory=factory)
+        events = self.namespaced()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["log_level"], LogLevel.debug)
+        self.assertEqual(formatEvent(events[0]),
+                         "Starting RFC 6455 conversation")
+
+    def test_errors_limited(self):
+        clock = Clock()
+        factory = WebSocketFactory(RecordingFactory(), clock=clock,
+                                   log_burst=2, log_interval=10)
+        request = RFC6455_REQUEST.replace(b"Version: 13", b"Version: 99")
+        for i in range(5):
+            connect(request, factory=factory)
+        events = self.namespaced("txws.handshake")
+        self.assertEqual([formatEvent(event) for event in events],
+                         ["Can't support protocol version 99"] * 2)
+        self.assertEqual(events[0]["log_level"], LogLevel.warn)
+        self.assertEqual(events[0]["version"], "99")
+
+        clock.advance(10)
+        connect(request, factory=factory)
+        events = self.namespaced("txws.handshake")
+        self.assertEqual(len(events), 4)
+        self.assertEqual(events[2]["suppressed"], 3)
+        self.assertEqual(formatEvent(events[3]),
+                         "Can't support protocol version 99")
+
+    def test_protocol_error(self):
+        protocol, transport = connect()
+        protocol.dataReceived(make_frame(b"", opcode=0x3))
+        events = self.namespaced("txws.protocol")
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["code"], 1002)
+
+class TestMetrics(unittest.TestCase):
+
+    def test_frames(self):
+        protocol, transport = connect()
+        protocol.dataReceived(make_frame(b"Hello") +
+                              make_frame(b"\x00\x01", opcode=0x2) +
+                              make_frame(b"ping", opcode=0x9))
+        protocol.write(b"Hi")
+        snapshot = protocol.factory.snapshot()
+        self.assertEqual(snapshot["connections_open.rfc6455.frames"], 1)
+        self.assertEqual(snapshot["handshakes_accepted.rfc6455"], 1)
+        self.assertEqual(snapshot["frames_received.text"], 1)
+        self.assertEqual(snapshot["frame_bytes_received.text"], 5)
+        self.assertEqual(snapshot["frames_received.binary"], 1)
+        self.assertEqual(snapshot["frames_received.ping"], 1)
+        self.assertEqual(snapshot["frames_sent.pong"], 1)
+        self.assertEqual(snapshot["frame_bytes_sent.pong"], 4)
+        self.assertEqual(snapshot["frames_sent.text"], 1)
+        self.assertEqual(snapshot["frame_bytes_sent.text"], 2)
+
+    def test_connections_open(self):
+        """
+        Open connections are counted as they move through the handshake,
+        and stop counting when they're lost.
+        """
+
+        factory = WebSocketFactory(RecordingFactory())
+        protocol, transport = connect(HYBI00_REQUEST[:-8], factory=factory)
+        snapshot = factory.snapshot()
+        self.assertEqual(snapshot["connections_open.hybi00.challenge"], 1)
+        self.assertEqual(snapshot["connections_open.none.negotiating"], 0)
+
+        protocol.dataReceived(HYBI00_REQUEST[-8:])
+        snapshot = factory.snapshot()
+        self.assertEqual(snapshot["connections_open.hybi00.challenge"], 0)
+        self.assertEqual(snapshot["connections_open.hybi00.frames"], 1)
+
+        protocol.connectionLost(None)
+        self.assertEqual(sum(factory.connections_open.values()), 0)
+
+    def test_rejections(self):
+        factory = WebSocketFactory(RecordingFactory())
+        bad_version = RFC6455_REQUEST.replace(b"Version: 13", b"Version: 99")
+        for request in (bad_version, b"GET /chat\r\n"):
+            protocol, transport = connect(request, factory=factory)
+            self.assertTrue(transport.disconnecting)
+            protocol.connectionLost(None)
+        protocol, transport = connect(request=None, factory=factory)
+        protocol.dataReceived(RFC6455_REQUEST[:20])
+        snapshot = factory.snapshot()
+        self.assertEqual(snapshot["handshakes_rejected.bad_version"], 1)
+        self.assertEqual(snapshot["handshakes_rejected.bad_request"], 1)
+        self.assertEqual(snapshot["handshakes_accepted.rfc6455"], 0)
+        self.assertEqual(snapshot["connections_open.none.negotiating"], 1)
+
+    def test_errors_and_closes(self):
+        factory = WebSocketFactory(RecordingFactory())
+        protocol, transport = connect(factory=factory)
+        protocol.dataReceived(make_frame(b"", opcode=0x3))
+        for code in (4001, 2000):
+            protocol, transport = connect(factory=factory)
+            protocol.dataReceived(make_frame(pack(">H", code), opcode=0x8))
+        snapshot = factory.snapshot()
+        self.assertEqual(snapshot["parse_errors"], 1)
+        self.assertEqual(snapshot["closes_sent.1002"], 1)
+        self.assertEqual(snapshot["closes_sent.1000"], 2)
+        self.assertEqual(snapshot["closes_received.4001"], 1)
+        self.assertEqual(snapshot["closes_received.0"], 1)
+
+    def test_high_water(self):
+        protocol, transport = connect()
+        frame = make_frame(b"x" * 300)
+        protocol.dataReceived(frame[:200])
+        protocol.dataReceived(frame[200:])
+        self.assertEqual(protocol.factory.buf_high_water, len(frame))
+
+    def test_render(self):
+        self.assertEqual(txws.render_metrics({
+            "connections": 2,
+            "frames_received.text": 3,
+            "frames_received.binary": 1,
+        }), "# HELP txws_connections Open connections.\n"
+            "# TYPE txws_connections gauge\n"
+            "txws_connections 2\n"
+            "# HELP txws_frames_received Frames received, by opcode.\n"
+            "# TYPE txws_frames_received counter\n"
+            'txws_frames_received{opcode="binary"} 1\n'
+            'txws_frames_received{opcode="text"} 3\n')
+
+    def test_resource(self):
+        resource = txws.MetricsResource(lambda: {"parse_errors": 4})
+        request = DummyRequest([b""])
+        body = resource.render_GET(request)
+        self.assertTrue(b"txws_parse_errors 4\n" in body)
+        self.assertTrue(request.responseHeaders.getRawHeaders(
+            b"Content-Type")[0].startswith(b"text/plain"))
+
+    def test_totals(self):
+        supervisor = txws.WorkerSupervisor("echo.factory", 8080, workers=2,
+                                           reactor=ProcessClock())
+        supervisor.reports = {
+            0: {"buf_high_water": 10, "connections_open.rfc6455.frames": 2},
+            1: {"buf_high_water": 30, "connections_open.rfc6455.frames": 1},
+        }
+        totals = supervisor.totals()
+        self.assertEqual(totals["buf_high_water"], 30)
+        self.assertEqual(totals["connections_open.rfc6455.frames"], 3)
+
+        # Levels of dead workers don't count any more.
+        supervisor.workerEnded(0, Failure(ProcessDone(0)))
+        totals = supervisor.totals()
+        self.assertEqual(totals["connections_open.rfc6455.frames"], 1)
+
+class CallingReactor(object):
+    """
+    A reactor which calls things from threads straight away.
+    """
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = txws.LatencyHistogram([0.001, 0.01])
+        for seconds in (0.0005, 0.001, 0.005, 0.5):
+            histogram.record(seconds)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count(), 4)
+        self.assertAlmostEqual(histogram.sum, 0.5065)
+
+    def test_off_by_default(self):
+        protocol, transport = connect()
+        self.assertEqual(type(protocol), txws.WebSocketProtocol)
+        self.assertFalse("latency_seconds_count.parse" in
+                         protocol.factory.snapshot())
+
+    def test_stages(self):
+        factory = WebSocketFactory(RecordingFactory(), instrument=True)
+        protocol, transport = connect(factory=factory)
+        protocol.dataReceived(make_frame(b"Hello"))
+        protocol.write(b"Hi")
+        counts = dict((stage, histogram.count())
+                      for stage, histogram in factory.histograms.items())
+        # Frames are parsed once after the handshake, too, in case any came
+        # with it.
+        self.assertEqual(counts, {"handshake": 1, "parse": 2, "decode": 1,
+                                  "deliver": 1, "send": 1})
+        self.assertEqual(protocol.wrappedProtocol.received, [b"Hello"])
+        self.assertTrue(protocol.cpu_time > 0)
+
+        snapshot = factory.snapshot()
+        self.assertEqual(snapshot["latency_seconds_count.send"], 1)
+        self.assertEqual(snapshot["latency_seconds_bucket.send.+Inf"], 1)
+        rendered = txws.render_metrics(snapshot)
+        self.assertTrue("# TYPE txws_latency_seconds histogram\n" in rendered)
+        self.assertTrue('txws_latency_seconds_bucket{stage="send",le="+Inf"} 1'
+                        in rendered)
+
+    def test_subclass(self):
+        """
+        Instrumenting keeps the factory's own protocol.
+        """
+
+        class ExtraProtocol(txws.WebSocketProtocol):
+            extra = True
+
+        class ExtraFactory(WebSocketFactory):
+            protocol = ExtraProtocol
+
+        factory = ExtraFactory(RecordingFactory(), instrument=True)
+        protocol, transport = connect(factory=factory)
+        self.assertTrue(isinstance(protocol, ExtraProtocol))
+        self.assertTrue(isinstance(protocol, txws.InstrumentedMixin))
+        protocol.dataReceived(make_frame(b"Hello"))
+        self.assertEqual(factory.histograms["deliver"].count(), 1)
+        self.assertTrue(protocol.cpu_time > 0)
+
+    def test_cpu_time(self):
+        """
+        Connections are charged CPU time, not wall-clock time.
+        """
+
+        factory = WebSocketFactory(RecordingFactory(), instrument=True)
+        protocol, transport = connect(factory=factory)
+        cpu = iter([10.0, 10.25])
+        self.patch(txws, "_cpu_timer", lambda: next(cpu))
+        protocol.cpu_time = 0.0
+        protocol.dataReceived(make_frame(b"Hello"))
+        self.assertEqual(protocol.cpu_time, 0.25)
+
+    def test_busiest_connections(self):
+        factory = WebSocketFactory(RecordingFactory(), instrument=True)
+        quiet, transport = connect(factory=factory)
+        busy, transport = connect(factory=factory)
+        quiet.cpu_time, busy.cpu_time = 0.001, 0.5
+        self.assertEqual(factory.busiestConnections(1), [busy])
+
+    def test_profiler(self):
+        directory = self.mktemp()
+        os.mkdir(directory)
+        profiler = txws.Profiler(directory, CallingReactor())
+        self.addCleanup(signal.signal, signal.SIGUSR2,
+                        signal.getsignal(signal.SIGUSR2))
+        profiler.install()
+
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertNotEqual(profiler.profile, None)
+        connect()
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertEqual(profiler.profile, None)
+        self.assertEqual(os.listdir(directory),
+                         ["txws-%d-1.prof" % os.getpid()])
+
+    if not hasattr(signal, "SIGUSR2"):
+        test_profiler.skip = "SIGUSR2 is not available"
@@ -44,16 +44,58 @@ __version__ = "0.7.1"
 import six
 
 import array
+import binascii
+import cProfile
+import json
+import math
+import os
+import signal
+import socket
+import sys
+import time
+import zlib
 
 from base64 import b64encode, b64decode
+from bisect import bisect_left
 from hashlib import md5, sha1
+from heapq import nlargest
+from inspect import isroutine
 from string import digits
-from struct import pack, unpack
-
-from twisted.internet.interfaces import ISSLTransport
+from struct import Struct, pack
+
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.interfaces import (IProtocolFactory, IPushProducer,
+                                         ISSLTransport)
+from twisted.internet.protocol import ClientFactory, ProcessProtocol, Protocol
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThreadPool
+from twisted.logger import (FilteringLogObserver, LogLevel,
+                            LogLevelFilterPredicate, Logger,
+                            globalLogBeginner, textFileLogObserver)
 from twisted.protocols.policies import ProtocolWrapper, WrappingFactory
-from twisted.python import log
+from twisted.python.reflect import namedAny
+from twisted.python.threadpool import ThreadPool
 from twisted.web.http import datetimeToString
+from twisted.web.resource import Resource
+from zope.interface import directlyProvides, implementer, providedBy
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Loggers, by what their events are about. Events about single connections
+# going about their business are only emitted if the factory's
+# log_connections option is set, and errors which clients can provoke go
+# through the factory's LogLimiter, so that neither floods the logs when lots
+# of clients turn up at once.
+handshake_log = Logger(namespace="txws.handshake")
+protocol_log = Logger(namespace="txws.protocol")
+broadcast_log = Logger(namespace="txws.broadcast")
+worker_log = Logger(namespace="txws.worker")
+bus_log = Logger(namespace="txws.bus")
+profile_log = Logger(namespace="txws.profile")
 
 class WSException(Exception):
     """
@@ -61,8 +103,15 @@ class WSException(Exception):
 
     If this class escapes txWS, then something stupid happened in multiple
     places.
+
+    The code is the close code to send to the other side; by default, it's
+    1002, for a protocol error.
     """
 
+    def __init__(self, message, code=1002):
+        Exception.__init__(self, message)
+        self.code = code
+
 # Flavors of WS supported here.
 # HYBI00  - Hixie-76, HyBi-00. Challenge/response after headers, very minimal
 #           framing. Tricky to start up, but very smooth sailing afterwards.
@@ -75,6 +124,13 @@ class WSException(Exception):
 
 HYBI00, HYBI07, HYBI10, RFC6455 = range(4)
 
+flavor_names = {
+    HYBI00: "HyBi-00/Hixie-76",
+    HYBI07: "HyBi-07",
+    HYBI10: "HyBi-10",
+    RFC6455: "RFC 6455",
+}
+
 # States of the state machine. Because there are no reliable byte counts for
 # any of this, we don't use StatefulProtocol; instead, we use custom state
 # enumerations. Yay!
@@ -95,13 +151,93 @@ opcode_types = {
     0xa: PONG,
 }
 
-encoders = {
-    "base64": b64encode,
-}
+# Codecs, which WebSockets calls "protocols" and the client picks from, keyed
+# by name. Payloads are run through the encoder on the way out and the
+# decoder on the way in; codecs in stream_decoders can also decode payloads
+# which arrive in pieces, which makes them usable with streaming, and lets
+# fragmented messages be decoded a fragment at a time. Binary
+# codecs don't transcode anything at all, and send everything in binary
+# frames instead; clients which offer one get it in preference to the rest.
+# Use register_codec() to add more.
+
+encoders = {}
+decoders = {}
+stream_decoders = {}
+binary_codecs = set()
+
+class Base64Decoder(object):
+    """
+    Decoder for base64 payloads which arrive in pieces.
 
-decoders = {
-    "base64": b64decode,
-}
+    Whatever doesn't fill a whole four-character group is held over until
+    the next piece, so only the encoded remainder, rather than the whole
+    encoded payload, is kept around.
+    """
+
+    def __init__(self):
+        self.pending = b""
+
+    def decode(self, data, end=True):
+        """
+        Decode the next piece of a payload, and return as much of it as can
+        be decoded so far. At the end of the payload, everything must have
+        been decoded.
+        """
+
+        if self.pending:
+            data = self.pending + data
+
+        if end:
+            self.pending = b""
+            return b64decode(data)
+
+        cut = len(data) - len(data) % 4
+        self.pending = data[cut:]
+        return b64decode(data[:cut])
+
+def register_codec(name, encoder=None, decoder=None, stream_decoder=None,
+                   binary=False):
+    """
+    Make a codec available to clients.
+
+    Binary codecs take neither an encoder nor a decoder; other codecs need
+    both, and may also have a stream_decoder, a callable returning an object
+    like Base64Decoder.
+    """
+
+    if binary:
+        binary_codecs.add(name)
+        return
+
+    encoders[name] = encoder
+    decoders[name] = decoder
+    if stream_decoder is not None:
+        stream_decoders[name] = stream_decoder
+
+def negotiate_codec(protocols, binary=True):
+    """
+    Pick a codec from the comma-separated list a client offered, preferring
+    binary codecs when binary frames are available, and otherwise taking the
+    first known one.
+
+    Returns None if none of them are known.
+    """
+
+    protocols = [p.strip() for p in protocols.split(",")]
+
+    if binary:
+        for protocol in protocols:
+            if protocol in binary_codecs:
+                return protocol
+
+    for protocol in protocols:
+        if protocol in encoders or protocol in decoders:
+            return protocol
+
+    return None
+
+register_codec("base64", b64encode, b64decode, Base64Decoder)
+register_codec("binary", binary=True)
 
 # Fake HTTP stuff, and a couple convenience methods for examining fake HTTP
 # headers.
@@ -128,7 +264,57 @@ def is_websocket(headers):
     """
 
     return ("upgrade" in headers.get("Connection", "").lower()
-            and headers.get("Upgrade").lower() == "websocket")
+            and headers.get("Upgrade", "").lower() == "websocket")
+
+# The headers which the handshake looks at, keyed by their names in lower
+# case, as they're matched against incoming headers. Everything else is
+# skipped without being decoded.
+
+handshake_headers = dict((name.lower().encode("ascii"), name) for name in (
+    "Connection",
+    "Host",
+    "Origin",
+    "Sec-WebSocket-Extensions",
+    "Sec-WebSocket-Key",
+    "Sec-WebSocket-Key1",
+    "Sec-WebSocket-Key2",
+    "Sec-WebSocket-Protocol",
+    "Sec-WebSocket-Version",
+    "Upgrade",
+    "WebSocket-Protocol",
+))
+
+# Headers which may be sent more than once, with their values joined up.
+list_headers = set([
+    "Connection",
+    "Sec-WebSocket-Extensions",
+    "Sec-WebSocket-Protocol",
+    "WebSocket-Protocol",
+])
+
+# Canned responses for requests we won't upgrade.
+
+error_responses = dict((code, (
+    "HTTP/1.1 %d %s\r\n"
+    "Connection: close\r\n"
+    "Content-Length: 0\r\n"
+    "\r\n" % (code, message)).encode("ascii")) for code, message in (
+    (400, "Bad Request"),
+    (404, "Not Found"),
+    (431, "Request Header Fields Too Large"),
+))
+
+# Why handshakes get rejected, for counting them. The first few are refused
+# with the HTTP error above.
+
+refusal_reasons = {
+    400: "bad_request",
+    404: "not_found",
+    431: "too_large",
+}
+
+rejection_reasons = ("bad_request", "not_found", "too_large", "not_websocket",
+                     "bad_protocol", "bad_version", "timeout")
 
 def is_hybi00(headers):
     """
@@ -171,6 +357,196 @@ def make_accept(key):
 
     return b64encode(hashed_bytes).strip().decode('utf-8')
 
+# Handshake responses. The constant parts are encoded once, up front, and the
+# Date header is only formatted once a second, so that answering a storm of
+# reconnecting clients costs as little as possible.
+
+_response_head = (b"HTTP/1.1 101 FYI I am not a webserver\r\n"
+                  b"Server: TwistedWebSocketWrapper/1.0\r\n"
+                  b"Date: ")
+_response_upgrade = (b"\r\n"
+                     b"Upgrade: WebSocket\r\n"
+                     b"Connection: Upgrade\r\n")
+
+_date_cache = [None, b""]
+
+def http_date(now=None):
+    """
+    Get the value of the Date header for now, as bytes.
+    """
+
+    if now is None:
+        now = time.time()
+    now = int(now)
+
+    if _date_cache[0] != now:
+        _date_cache[:] = now, datetimeToString(now)
+    return _date_cache[1]
+
+_codec_lines = {}
+
+def codec_lines(codec, hybi00=False):
+    """
+    Get the headers which tell a client which codec we picked, as bytes.
+    """
+
+    key = codec, hybi00
+    lines = _codec_lines.get(key)
+    if lines is None:
+        if not codec:
+            lines = b""
+        elif hybi00:
+            lines = ("WebSocket-Protocol: %s\r\n"
+                     "Sec-WebSocket-Protocol: %s\r\n"
+                     % (codec, codec)).encode("utf-8")
+        else:
+            lines = ("Sec-WebSocket-Protocol: %s\r\n"
+                     % codec).encode("utf-8")
+        _codec_lines[key] = lines
+    return lines
+
+# Input buffering.
+
+class ReceiveBuffer(object):
+    """
+    A buffer of received bytes with a read cursor.
+
+    Incoming data is appended to a single bytearray, and reads just move the
+    cursor forward, so neither feeding nor consuming data copies what is
+    already buffered. Consumed bytes are discarded lazily, once they make up
+    at least half of the buffer, which keeps the cost of compaction amortized
+    constant per byte.
+    """
+
+    __slots__ = ("_data", "_pos")
+
+    def __init__(self, data=b""):
+        self._data = bytearray(data)
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._data) - self._pos
+
+    def __bool__(self):
+        return len(self._data) > self._pos
+
+    __nonzero__ = __bool__
+
+    def feed(self, data):
+        """
+        Append some data to the end of the buffer.
+        """
+
+        self._data += data
+
+    def find(self, sub, start=0):
+        """
+        Find a substring in the unconsumed data, starting from an offset
+        relative to the read cursor, like ``bytes.find()``.
+        """
+
+        index = self._data.find(sub, self._pos + start)
+        if index == -1:
+            return index
+        return index - self._pos
+
+    def peek(self, length=None, offset=0):
+        """
+        Copy out some of the unconsumed data without consuming it.
+        """
+
+        start = self._pos + offset
+        if length is None:
+            return _copy(self._data, start, len(self._data))
+        return _copy(self._data, start, start + length)
+
+    def unpack(self, struct, offset=0):
+        """
+        Unpack a struct from the unconsumed data without consuming it.
+        """
+
+        return struct.unpack_from(self._data, self._pos + offset)
+
+    def read(self, length):
+        """
+        Consume and return some data.
+        """
+
+        data = self.peek(length)
+        self.skip(len(data))
+        return data
+
+    def unmask(self, length, key, phase=0):
+        """
+        Consume some data and return it unmasked.
+        """
+
+        end = min(self._pos + length, len(self._data))
+        data = _unmask(self._data, self._pos, end, key, phase)
+        self.skip(len(data))
+        return data
+
+    def skip(self, length):
+        """
+        Consume some data without looking at it.
+        """
+
+        self._pos = min(self._pos + length, len(self._data))
+        self._compact()
+
+    def getvalue(self):
+        """
+        Copy out all unconsumed data.
+        """
+
+        return self.peek()
+
+    def parse(self, parser):
+        """
+        Run a frame parser over the unconsumed data, in place, and consume
+        whatever it used.
+
+        The parser is called with the underlying buffer and the offset of the
+        read cursor, and must return its results and the offset of the first
+        byte it didn't use.
+        """
+
+        results, end = parser(self._data, self._pos)
+        self.skip(end - self._pos)
+        return results
+
+    def _compact(self):
+        if self._pos == len(self._data):
+            del self._data[:]
+            self._pos = 0
+        elif self._pos * 2 >= len(self._data):
+            del self._data[:self._pos]
+            self._pos = 0
+
+def _copy(data, start, end):
+    """
+    Copy a slice of a buffer out as bytes, with exactly one copy.
+    """
+
+    view = memoryview(data)
+    try:
+        return view[start:end].tobytes()
+    finally:
+        if not six.PY2:
+            view.release()
+
+def _unmask(data, start, end, key, phase=0):
+    """
+    Unmask a slice of a buffer without copying it first.
+    """
+
+    view = memoryview(data)
+    try:
+        return mask(view[start:end], key, phase)
+    finally:
+        if not six.PY2:
+            view.release()
+
 # Frame helpers.
 # Separated out to make unit testing a lot easier.
 # Frames are bonghits in newer WS versions, so helpers are appreciated.
@@ -183,10 +559,18 @@ def make_hybi00_frame(buf):
     and valid text without any 0xff bytes.
     """
 
+    return b"".join(hybi00_frame_parts(buf))
+
+def hybi00_frame_parts(buf):
+    """
+    Make a HyBi-00 frame, as a sequence of byte strings to be written out in
+    order, without copying the data.
+    """
+
     if isinstance(buf, six.text_type):
         buf = buf.encode('utf-8')
 
-    return b"\x00" + buf + b"\xff"
+    return b"\x00", buf, b"\xff"
 
 def parse_hybi00_frames(buf):
     """
@@ -196,9 +580,54 @@ def parse_hybi00_frames(buf):
     and will actively ignore it.
     """
 
-    start = buf.find(b"\x00")
-    tail = 0
+    frames, tail = _parse_hybi00_frames(buf, 0)
+    frames = [frame[:2] for frame in frames]
+
+    # Adjust the buffer and return.
+    buf = buf[tail:]
+    return frames, buf
+
+class HyBi00Decoder(object):
+    """
+    Decoder for HyBi-00 frames.
+
+    HyBi-00 frames carry no header to remember, so this just runs the parser
+    over whatever is buffered. Frames come out in the same shape as those
+    from HyBi07Decoder.
+    """
+
+    __slots__ = ("max_frame_size",)
+
+    streaming = False
+
+    def __init__(self, max_frame_size=None):
+        self.max_frame_size = max_frame_size
+
+    def decode(self, buf):
+        """
+        Decode as many frames as possible from a ReceiveBuffer, consuming
+        them.
+        """
+
+        frames = buf.parse(_parse_hybi00_frames)
+
+        # There's no length to check up front, so the best we can do is to
+        # notice when the unfinished frame gets too big.
+        if self.max_frame_size is not None and len(buf) > self.max_frame_size:
+            raise WSException("Frame too large (%d)" % len(buf), 1009)
+
+        return frames
+
+def _parse_hybi00_frames(buf, start):
+    """
+    Parse HyBi-00 frames out of a buffer, beginning at an offset.
+
+    Returns the frames and the offset of the first byte not consumed.
+    """
+
+    tail = start
     frames = []
+    start = buf.find(b"\x00", start)
 
     while start != -1:
         end = buf.find(b"\xff", start + 1)
@@ -207,29 +636,139 @@ def parse_hybi00_frames(buf):
             break
         else:
             # Found a frame, put it in the list.
-            frame = buf[start + 1:end]
-            frames.append((NORMAL, frame))
+            frame = _copy(buf, start + 1, end)
+            frames.append((NORMAL, frame, True, True, 0x1))
             tail = end + 1
         start = buf.find(b"\x00", end + 1)
 
-    # Adjust the buffer and return.
-    buf = buf[tail:]
-    return frames, buf
+    return frames, tail
 
-def mask(buf, key):
+# Masking engines. Client frames are always masked, so unmasking sits right on
+# the inbound hot path; rather than walking the payload one byte at a time, we
+# XOR the whole buffer against a repeated key in one go. The fastest engine
+# available is picked at import time.
+
+# Payloads at least this long are handed to NumPy, if it is installed. Below
+# this, the setup cost of building arrays outweighs the savings.
+NUMPY_MASK_THRESHOLD = 4096
+
+def _mask_loop(buf, key):
     """
-    Mask or unmask a buffer of bytes with a masking key.
+    Mask a buffer one byte at a time.
 
-    The key must be exactly four bytes long.
+    This is the original, portable engine, and the fallback for everything
+    else.
     """
 
-    # This is super-duper-secure, I promise~
     key = array.array("B", key)
     buf = array.array("B", buf)
     for i in range(len(buf)):
         buf[i] ^= key[i % 4]
     return buf.tobytes()
 
+def _mask_int(buf, key):
+    """
+    Mask a buffer by treating it and a repeated key as two huge integers and
+    XORing them together.
+    """
+
+    length = len(buf)
+    if not length:
+        return b""
+
+    stream = (key * (length // 4 + 1))[:length]
+    masked = int.from_bytes(buf, "big") ^ int.from_bytes(stream, "big")
+    return masked.to_bytes(length, "big")
+
+def _mask_numpy(buf, key):
+    """
+    Mask a buffer with NumPy, four bytes at a time.
+    """
+
+    length = len(buf)
+    words = length // 4
+
+    data = numpy.frombuffer(buf, dtype=numpy.uint8)
+    out = numpy.empty(length, dtype=numpy.uint8)
+
+    # The bulk of the buffer, as native 32-bit words against a 32-bit key.
+    # Byte order doesn't matter, since both sides are viewed the same way.
+    numpy.bitwise_xor(data[:words * 4].view(numpy.uint32),
+                      numpy.frombuffer(key, dtype=numpy.uint32)[0],
+                      out=out[:words * 4].view(numpy.uint32))
+
+    # And whatever is left over.
+    tail = length - words * 4
+    if tail:
+        numpy.bitwise_xor(data[words * 4:],
+                          numpy.frombuffer(key[:tail], dtype=numpy.uint8),
+                          out=out[words * 4:])
+
+    return out.tobytes()
+
+if hasattr(int, "from_bytes"):
+    _mask_small = _mask_int
+else:
+    _mask_small = _mask_loop
+
+if numpy is not None:
+    def _mask_engine(buf, key):
+        if len(buf) >= NUMPY_MASK_THRESHOLD:
+            return _mask_numpy(buf, key)
+        return _mask_small(buf, key)
+else:
+    _mask_engine = _mask_small
+
+def mask(buf, key, phase=0):
+    """
+    Mask or unmask a buffer of bytes with a masking key.
+
+    The key must be exactly four bytes long. The phase is the offset into the
+    key of the first byte of the buffer, which allows a payload to be unmasked
+    a piece at a time; a piece starting at payload offset n has phase n.
+    """
+
+    key = bytes(key)
+
+    # This is super-duper-secure, I promise~
+    phase %= 4
+    if phase:
+        key = key[phase:] + key[:phase]
+
+    return _mask_engine(buf, key)
+
+# Frame headers are packed with precompiled structs, and headers for small
+# payloads with the usual opcodes are looked up in a table instead of being
+# packed at all.
+
+_frame_head = Struct(">BB")
+_frame_length16 = Struct(">H")
+_frame_length64 = Struct(">Q")
+_frame_head16 = Struct(">BBH")
+_frame_head64 = Struct(">BBQ")
+_close_code = Struct(">H")
+
+_small_headers = dict(
+    (opcode, [_frame_head.pack(0x80 | opcode, length)
+              for length in range(0x7e)])
+    for opcode in opcode_types)
+
+def make_hybi07_header(length, opcode=0x1):
+    """
+    Make the header for an unmasked HyBi-07 frame with a payload of a given
+    length, using the smallest possible length encoding.
+    """
+
+    if length <= 0x7d:
+        headers = _small_headers.get(opcode)
+        if headers is not None:
+            return headers[length]
+        return _frame_head.pack(0x80 | opcode, length)
+    elif length <= 0xffff:
+        return _frame_head16.pack(0x80 | opcode, 0x7e, length)
+    else:
+        return _frame_head64.pack(0x80 | opcode, 0x7f, length)
+
 def make_hybi07_frame(buf, opcode=0x1):
     """
     Make a HyBi-07 frame.
@@ -238,19 +777,8 @@ def make_hybi07_frame(buf, opcode=0x1):
     smallest possible lengths.
     """
 
-    if len(buf) > 0xffff:
-        length = "\x7f%s" % pack(">Q", len(buf))
-    elif len(buf) > 0x7d:
-        length = "\x7e%s" % pack(">H", len(buf))
-    else:
-        length = chr(len(buf))
-
-    if isinstance(buf, six.text_type):
-        buf = buf.encode('utf-8')
-
     # Always make a normal packet.
-    header = chr(0x80 | opcode)
-    return six.b(header + length) + buf
+    return b"".join(hybi07_frame_parts(buf, opcode))
 
 def make_hybi07_frame_dwim(buf):
     """
@@ -265,47 +793,259 @@ def make_hybi07_frame_dwim(buf):
     else:
         raise TypeError("In binary support mode, frame data must be either str or unicode")
 
+def hybi07_frame_parts(buf, opcode=0x1):
+    """
+    Make a HyBi-07 frame, as a header and a payload to be written out in
+    order, without copying the data.
+    """
+
+    if isinstance(buf, six.text_type):
+        buf = buf.encode('utf-8')
+
+    return make_hybi07_header(len(buf), opcode), buf
+
+def hybi07_frame_parts_dwim(buf):
+    """
+    Make a HyBi-07 frame with binary or text data according to the type of
+    buf, as a header and a payload.
+    """
+
+    if isinstance(buf, six.binary_type):
+        return hybi07_frame_parts(buf, opcode=0x2)
+    elif isinstance(buf, six.text_type):
+        return hybi07_frame_parts(buf.encode("utf-8"), opcode=0x1)
+    else:
+        raise TypeError("In binary support mode, frame data must be either str or unicode")
+
+def frame_parts(frame, hybi00=False, codec=None, binary=False, deflate=None):
+    """
+    Encode some data and wrap it in a frame, as a sequence of byte strings,
+    for a connection with the given wire format: its flavor, codec, binary
+    mode and compression.
+    """
+
+    # Encode the frame before sending it.
+    if codec in encoders:
+        frame = encoders[codec](frame)
+
+    if hybi00:
+        return hybi00_frame_parts(frame)
+
+    if deflate is None:
+        if binary:
+            return hybi07_frame_parts_dwim(frame)
+        return hybi07_frame_parts(frame)
+
+    if isinstance(frame, six.text_type):
+        frame = frame.encode("utf-8")
+        opcode = 0x1
+    elif not binary:
+        opcode = 0x1
+    elif isinstance(frame, six.binary_type):
+        opcode = 0x2
+    else:
+        raise TypeError("In binary support mode, frame data must be either str or unicode")
+
+    if len(frame) >= deflate.min_size:
+        # Compressed messages are flagged with RSV1.
+        frame = deflate.compress(frame)
+        opcode |= 0x40
+
+    return hybi07_frame_parts(frame, opcode)
+
+def frame_opcode(parts):
+    """
+    Get the opcode of a frame made by frame_parts(). HyBi-00 frames, which
+    don't have one, are text.
+    """
+
+    if len(parts) == 3:
+        return 0x1
+    return six.indexbytes(parts[0], 0) & 0xf
+
 def parse_hybi07_frames(buf):
     """
     Parse HyBi-07 frames in a highly compliant manner.
     """
 
-    start = 0
-    frames = []
+    buf = ReceiveBuffer(buf)
+    frames = HyBi07Decoder().decode(buf)
+    return [frame[:2] for frame in frames], buf.getvalue()
 
-    while True:
-        # If there's not at least two bytes in the buffer, bail.
-        if len(buf) - start < 2:
-            break
+class HyBi07Decoder(object):
+    """
+    Incremental decoder for HyBi-07 and later frames.
+
+    The decoder remembers the header of the frame it is waiting on, so a
+    large frame which arrives over many reads has its header decoded exactly
+    once, and each read only costs a length check until the rest of the
+    payload shows up.
+
+    Decoded frames are (opcode, data, complete, fin, raw) tuples, where raw
+    is the opcode as it appeared on the wire, along with the RSV1 flag if
+    compression is in use. Normally each one is a whole
+    frame, and complete is always True. In streaming mode, data frames are
+    instead handed out a piece at a time, as their payloads arrive, and
+    complete is only True for the piece which ends the frame; this keeps the
+    buffer bounded by the size of a read rather than the size of a frame.
+    Control frames are always delivered whole.
+
+    Since every header passes through here, this is also where the rules
+    about fragmentation and sizes are enforced, before any payload is
+    buffered.
+    """
 
-        # Grab the header. This single byte holds some flags nobody cares
-        # about, and an opcode which nobody cares about.
-        header = buf[start]
+    # There's one of these per connection, so keep them small.
+    __slots__ = ("streaming", "max_frame_size", "max_message_size",
+                 "compression", "fragmented", "message_size", "opcode", "raw",
+                 "fin", "offset", "length", "key", "received")
 
-        if six.PY2:
-            header = ord(header)
+    def __init__(self, streaming=False, max_frame_size=None,
+                 max_message_size=None, compression=False):
+        self.streaming = streaming
+        self.max_frame_size = max_frame_size
+        self.max_message_size = max_message_size
+        # Whether an extension has claimed RSV1 to flag compressed messages.
+        self.compression = compression
 
-        if header & 0x70:
-            # At least one of the reserved flags is set. Pork chop sandwiches!
-            raise WSException("Reserved flag in HyBi-07 frame (%d)" % header)
-            frames.append(("", CLOSE))
-            return frames, buf
+        # Whether we're in the middle of a fragmented message, and how big
+        # it is so far.
+        self.fragmented = False
+        self.message_size = 0
+
+        self.reset()
+
+    def reset(self):
+        """
+        Forget about the current frame, and wait for the next header.
+        """
+
+        # The opcode, or None if we haven't seen a full header yet.
+        self.opcode = None
+        # The opcode as sent, and the FIN flag.
+        self.raw = None
+        self.fin = True
+        # Size of the header, including extended length and key.
+        self.offset = 0
+        # Size of the payload.
+        self.length = 0
+        # The masking key, if any.
+        self.key = None
+        # Payload bytes already handed out, when streaming.
+        self.received = 0
+
+    def decode(self, buf):
+        """
+        Decode as many frames as possible from a ReceiveBuffer, consuming
+        them.
+        """
+
+        frames = []
+
+        while True:
+            if self.opcode is None:
+                if not self.parseHeader(buf):
+                    break
+                if self.streaming and self.opcode == NORMAL:
+                    # Drop the header now; the payload will be consumed as it
+                    # comes in.
+                    buf.skip(self.offset)
+                    self.offset = 0
+
+            if self.streaming and self.opcode == NORMAL:
+                frame = self.decodePiece(buf)
+                if frame is None:
+                    break
+                frames.append(frame)
+                continue
+
+            # Payload bytes received so far are simply whatever is buffered
+            # past the header; there's nothing to do until all of it is here.
+            if len(buf) - self.offset < self.length:
+                break
+
+            buf.skip(self.offset)
+            if self.key is None:
+                data = buf.read(self.length)
+            else:
+                data = buf.unmask(self.length, self.key)
+
+            opcode = self.opcode
+            if opcode == CLOSE:
+                if len(data) >= 2:
+                    # Gotta unpack the opcode and return usable data here.
+                    data = _close_code.unpack(data[:2])[0], data[2:]
+                else:
+                    # No reason given; use generic data.
+                    data = 1000, b"No reason given"
+
+            frames.append((opcode, data, True, self.fin, self.raw))
+            self.reset()
+
+        return frames
+
+    def decodePiece(self, buf):
+        """
+        Consume whatever is buffered of the current frame's payload.
+
+        Returns a frame tuple, or None if nothing is buffered.
+        """
+
+        size = min(len(buf), self.length - self.received)
+        if not size and self.length:
+            return None
+
+        if self.key is None:
+            data = buf.read(size)
+        else:
+            # Pick the mask back up wherever the last piece left off.
+            data = buf.unmask(size, self.key, self.received)
+
+        self.received += size
+        complete = self.received == self.length
+        frame = self.opcode, data, complete, self.fin, self.raw
+        if complete:
+            self.reset()
+        return frame
+
+    def parseHeader(self, buf):
+        """
+        Try to parse a frame header from the front of a buffer, without
+        consuming it.
+
+        Returns whether a complete header was available.
+        """
+
+        size = len(buf)
+
+        # If there's not at least two bytes in the buffer, bail.
+        if size < 2:
+            return False
+
+        # Grab the header. The first byte holds the FIN flag, some reserved
+        # flags, and the opcode; the second holds the mask flag and the
+        # payload length, or a hint about where to find it.
+        header, length = buf.unpack(_frame_head)
 
         # Get the opcode, and translate it to a local enum which we actually
         # care about.
-        opcode = header & 0xf
+        raw = header & 0xf
         try:
-            opcode = opcode_types[opcode]
+            opcode = opcode_types[raw]
         except KeyError:
-            raise WSException("Unknown opcode %d in HyBi-07 frame" % opcode)
-
-        # Get the payload length and determine whether we need to look for an
-        # extra length.
-        length = buf[start + 1]
-
-        if six.PY2:
-            length = ord(length)
+            raise WSException("Unknown opcode %d in HyBi-07 frame" % raw)
 
+        if header & 0x70:
+            # At least one of the reserved flags is set. If compression is on,
+            # RSV1 marks the first frame of a compressed message; anything
+            # else is a pork chop sandwich!
+            if (header & 0x70 != 0x40 or not self.compression
+                or opcode != NORMAL or raw == 0x0):
+                raise WSException("Reserved flag in HyBi-07 frame (%d)"
+                                  % header)
+            raw |= 0x40
+
+        fin = bool(header & 0x80)
         masked = length & 0x80
         length &= 0x7f
 
@@ -316,71 +1056,578 @@ def parse_hybi07_frames(buf):
 
         # Extra length fields.
         if length == 0x7e:
-            if len(buf) - start < 4:
-                break
+            if size < 4:
+                return False
 
-            length = buf[start + 2:start + 4]
-            length = unpack(">H", length)[0]
+            length = buf.unpack(_frame_length16, 2)[0]
             offset += 2
         elif length == 0x7f:
-            if len(buf) - start < 10:
-                break
+            if size < 10:
+                return False
 
-            # Protocol bug: The top bit of this long long *must* be cleared;
-            # that is, it is expected to be interpreted as signed. That's
-            # fucking stupid, if you don't mind me saying so, and so we're
-            # interpreting it as unsigned anyway. If you wanna send exabytes
-            # of data down the wire, then go ahead!
-            length = buf[start + 2:start + 10]
-            length = unpack(">Q", length)[0]
+            # The top bit of this long long *must* be cleared. Nobody is
+            # going to send us exabytes of data, so anybody setting it is
+            # either broken or up to no good.
+            length = buf.unpack(_frame_length64, 2)[0]
+            if length & 0x8000000000000000:
+                raise WSException("Oversized length in HyBi-07 frame")
             offset += 8
 
+        key = None
         if masked:
-            if len(buf) - (start + offset) < 4:
-                break
+            if size < offset + 4:
+                return False
 
-            key = buf[start + offset:start + offset + 4]
+            key = buf.peek(4, offset)
             offset += 4
 
-        if len(buf) - (start + offset) < length:
-            break
+        # Now that the whole header is here, check it against the rules.
+        if opcode == NORMAL:
+            self.checkDataFrame(raw, fin, length)
+        elif not fin or length > 0x7d:
+            raise WSException("Invalid control frame in HyBi-07 frames")
+
+        self.opcode = opcode
+        self.raw = raw
+        self.fin = fin
+        self.offset = offset
+        self.length = length
+        self.key = key
+        return True
 
-        data = buf[start + offset:start + offset + length]
+    def checkDataFrame(self, raw, fin, length):
+        """
+        Check that a data frame fits into the current message, and that
+        neither it nor the message is too big.
+        """
 
-        if masked:
-            data = mask(data, key)
+        if raw & 0xf == 0x0:
+            if not self.fragmented:
+                raise WSException("Unexpected continuation frame")
+            self.message_size += length
+        else:
+            if self.fragmented:
+                raise WSException("Expected continuation frame")
+            self.message_size = length
 
-        if opcode == CLOSE:
-            if len(data) >= 2:
-                # Gotta unpack the opcode and return usable data here.
-                data = unpack(">H", data[:2])[0], data[2:]
-            else:
-                # No reason given; use generic data.
-                data = 1000, b"No reason given"
+        if self.max_frame_size is not None and length > self.max_frame_size:
+            raise WSException("Frame too large (%d)" % length, 1009)
+        if (self.max_message_size is not None
+            and self.message_size > self.max_message_size):
+            raise WSException("Message too large (%d)" % self.message_size,
+                              1009)
 
-        frames.append((opcode, data))
-        start += offset + length
+        self.fragmented = not fin
 
-    return frames, buf[start:]
+# Compression, as per RFC 7692.
 
-class WebSocketProtocol(ProtocolWrapper):
+def parse_extensions(s):
     """
-    Protocol which wraps another protocol to provide a WebSockets transport
-    layer.
+    Parse a Sec-WebSocket-Extensions header into a list of (name, params)
+    pairs, in order of preference.
+
+    Parameters without values get a value of None.
     """
 
-    buf = b""
-    codec = None
-    location = "/"
-    host = "example.com"
-    origin = "http://example.com"
+    extensions = []
+
+    for offer in s.split(","):
+        pieces = [piece.strip() for piece in offer.split(";")]
+        if not pieces[0]:
+            continue
+
+        params = {}
+        for piece in pieces[1:]:
+            if not piece:
+                continue
+            key, sep, value = piece.partition("=")
+            key = key.strip().lower()
+            if key in params:
+                # Duplicates aren't allowed; poison the offer.
+                params[None] = None
+            params[key] = value.strip().strip('"') if sep else None
+        extensions.append((pieces[0].lower(), params))
+
+    return extensions
+
+def _window_bits(value, default):
+    """
+    Validate a max_window_bits parameter, returning None if it's invalid.
+    """
+
+    if value is None:
+        return default
+    if not value.isdigit() or not 8 <= int(value) <= 15:
+        return None
+    return int(value)
+
+_deflate_params = frozenset(["server_no_context_takeover",
+                              "client_no_context_takeover",
+                              "server_max_window_bits",
+                              "client_max_window_bits"])
+
+def negotiate_deflate(extensions, factory):
+    """
+    Pick the first acceptable permessage-deflate offer from a list of parsed
+    extensions, and set up compression for it according to the factory's
+    options.
+
+    Returns a PerMessageDeflate, or None if nothing was acceptable.
+    """
+
+    for name, params in extensions:
+        if name != "permessage-deflate":
+            continue
+
+        if set(params) - _deflate_params:
+            continue
+
+        # These parameters don't take values.
+        if (params.get("server_no_context_takeover") is not None
+            or params.get("client_no_context_takeover") is not None):
+            continue
+
+        server_bits = factory.deflate_window_bits
+        if "server_max_window_bits" in params:
+            offered = _window_bits(params["server_max_window_bits"], None)
+            if offered is None:
+                continue
+            # zlib can't make raw deflate streams with 256-byte windows.
+            if offered == 8:
+                continue
+            server_bits = min(server_bits, offered)
+
+        client_bits = None
+        if "client_max_window_bits" in params:
+            offered = _window_bits(params["client_max_window_bits"], 15)
+            if offered is None:
+                continue
+            client_bits = min(factory.deflate_client_window_bits, offered)
+
+        server_reset = (factory.deflate_server_no_context_takeover
+                        or "server_no_context_takeover" in params)
+        client_reset = factory.deflate_client_no_context_takeover
+
+        max_size = factory.deflate_max_size
+        if factory.max_message_size is not None:
+            if max_size is None or factory.max_message_size < max_size:
+                max_size = factory.max_message_size
+
+        return PerMessageDeflate(server_reset, client_reset, server_bits,
+                                 client_bits, factory.deflate_level,
+                                 factory.deflate_mem_level,
+                                 factory.deflate_min_size, max_size)
+
+    return None
+
+class PerMessageDeflate(object):
+    """
+    The permessage-deflate extension, as negotiated for one connection.
+
+    Compression contexts are created when they're first needed. When a side
+    has agreed not to take over its context between messages, its context
+    is thrown away at the end of each message rather than reset, so that
+    idle connections don't hold on to zlib's buffers.
+    """
+
+    # Every compressed message ends with an empty stored block, which is left
+    # off on the wire.
+    tail = b"\x00\x00\xff\xff"
+
+    def __init__(self, server_no_context_takeover=False,
+                 client_no_context_takeover=False, server_max_window_bits=15,
+                 client_max_window_bits=None, level=-1, mem_level=8,
+                 min_size=0, max_size=None):
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self.level = level
+        self.mem_level = mem_level
+        self.min_size = min_size
+        self.max_size = max_size
+
+        self.compressor = None
+        self.decompressor = None
+        self.inflated = 0
+
+    def response(self):
+        """
+        Make the value of the Sec-WebSocket-Extensions response header.
+        """
+
+        params = ["permessage-deflate"]
+        if self.server_no_context_takeover:
+            params.append("server_no_context_takeover")
+        if self.client_no_context_takeover:
+            params.append("client_no_context_takeover")
+        if self.server_max_window_bits < 15:
+            params.append("server_max_window_bits=%d"
+                          % self.server_max_window_bits)
+        if self.client_max_window_bits is not None:
+            params.append("client_max_window_bits=%d"
+                          % self.client_max_window_bits)
+        return "; ".join(params)
+
+    def compress(self, data):
+        """
+        Compress a whole message.
+        """
+
+        compressor = self.compressor
+        if compressor is None:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                          -self.server_max_window_bits,
+                                          self.mem_level)
+
+        data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        if not self.server_no_context_takeover:
+            self.compressor = compressor
+
+        if data.endswith(self.tail):
+            data = data[:-4]
+        return data
+
+    def decompress(self, data, end):
+        """
+        Decompress part of a message, refusing to produce more than max_size
+        bytes for the whole message.
+        """
+
+        decompressor = self.decompressor
+        if decompressor is None:
+            # Our window has to be as big as the client's.
+            bits = self.client_max_window_bits or 15
+            decompressor = self.decompressor = zlib.decompressobj(-bits)
+
+        if end:
+            data += self.tail
+
+        if self.max_size is None:
+            inflated = decompressor.decompress(data)
+        else:
+            # Ask for one more byte than we can take, to find out whether the
+            # message is too big without inflating all of it.
+            room = self.max_size - self.inflated
+            inflated = decompressor.decompress(data, room + 1)
+            if len(inflated) > room or decompressor.unconsumed_tail:
+                raise WSException("Message too large when decompressed",
+                                  1009)
+
+        self.inflated += len(inflated)
+
+        if end:
+            self.inflated = 0
+            if self.client_no_context_takeover:
+                self.decompressor = None
+
+        return inflated
+
+# Flow control.
+
+class WriteMonitor(object):
+    """
+    Push producer which a WebSocketProtocol registers with its transport, to
+    find out when the transport's write buffer fills up and drains.
+
+    This can't be the protocol itself, since the protocol is also the
+    transport of the wrapped protocol, and its own pauseProducing() and
+    resumeProducing() are for the wrapped protocol to throttle reads.
+    """
+
+    __slots__ = ("protocol",)
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def pauseProducing(self):
+        if self.protocol is not None:
+            self.protocol.writesPaused(True)
+
+    def resumeProducing(self):
+        if self.protocol is not None:
+            self.protocol.writesPaused(False)
+
+    def stopProducing(self):
+        if self.protocol is not None and self.protocol.producer is not None:
+            self.protocol.producer.stopProducing()
+
+# Logging.
+
+class LogLimiter(object):
+    """
+    Rate limiter for log events which can come thick and fast.
+
+    Each interval, only the first burst events with the same format are
+    emitted; the next one with that format after the interval says how many
+    were held back.
+    """
+
+    def __init__(self, clock, burst=10, interval=60.0):
+        self.clock = clock
+        self.burst = burst
+        self.interval = interval
+        # Windows, as [start, count] lists, keyed by namespace and format.
+        self.windows = {}
+
+    def emit(self, log, level, format, **kwargs):
+        """
+        Emit an event on a Logger, unless too many like it have been emitted
+        lately.
+
+        Returns whether the event was emitted.
+        """
+
+        now = self.clock.seconds()
+        key = log.namespace, format
+        window = self.windows.get(key)
+
+        if window is None or now - window[0] >= self.interval:
+            if window is not None and window[1] > self.burst:
+                log.emit(level, "Suppressed {suppressed} events like: "
+                         "{suppressed_format}",
+                         suppressed=window[1] - self.burst,
+                         suppressed_format=format)
+            window = self.windows[key] = [now, 0]
+
+        window[1] += 1
+        if window[1] > self.burst:
+            return False
+        log.emit(level, format, **kwargs)
+        return True
+
+# Timers.
+
+# The clock to time things with, in seconds.
+_timer = getattr(time, "perf_counter", time.time)
+
+# The clock to measure CPU time with, in seconds: the reactor thread's own,
+# if possible, so that time spent blocked or in other threads doesn't count.
+_cpu_timer = getattr(time, "thread_time", getattr(time, "process_time",
+                                                  _timer))
+
+class LatencyHistogram(object):
+    """
+    Histogram of durations, in seconds, with fixed buckets.
+
+    Recording a duration only finds its bucket and adds to a couple of
+    integers, so this is cheap enough to do for every frame.
+    """
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    # Upper bounds of the buckets, in seconds; there's one more bucket, for
+    # everything slower.
+    buckets = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+               0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self, buckets=None):
+        self.bounds = tuple(buckets or self.buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.sum += seconds
+
+    def count(self):
+        return sum(self.counts)
+
+class TimerWheel(object):
+    """
+    A coarse-grained timer shared by all of a factory's connections.
+
+    Scheduling a reactor call per connection gets expensive with lots of
+    connections, and handshake and idle timeouts don't need to be precise.
+    Instead, time is chopped into ticks, and timers are kept in one slot per
+    tick; a single reactor call per tick sweeps the current slot, firing
+    every timer in it as a batch.
+
+    Timers are objects with a ``timer_due`` attribute, which the wheel uses
+    for bookkeeping, and a ``timerExpired()`` method, which the wheel calls.
+    """
+
+    def __init__(self, clock, resolution=1.0):
+        self.clock = clock
+        self.resolution = resolution
+        self.epoch = clock.seconds()
+        self.tick = 0
+        self.slots = {}
+        self.call = None
+
+    def ticks(self, seconds):
+        """
+        Convert a duration to a number of ticks, rounding up.
+        """
+
+        return max(1, int(math.ceil(seconds / self.resolution)))
+
+    def now(self):
+        """
+        Get the current tick.
+
+        The tick only moves while the wheel is turning, so after it's been
+        idle, catch it up with the clock first.
+        """
+
+        if self.call is None and not self.slots:
+            now = int((self.clock.seconds() - self.epoch) / self.resolution)
+            self.tick = max(self.tick, now)
+        return self.tick
+
+    def schedule(self, timer, due):
+        """
+        Schedule a timer to fire at a given tick, replacing any earlier
+        schedule for it.
+        """
+
+        self.cancel(timer)
+
+        due = max(due, self.tick + 1)
+        slot = self.slots.get(due)
+        if slot is None:
+            slot = self.slots[due] = set()
+        slot.add(timer)
+        timer.timer_due = due
+
+        if self.call is None:
+            self.call = self.clock.callLater(self.resolution, self.advance)
+
+    def cancel(self, timer):
+        """
+        Unschedule a timer, if it's scheduled.
+        """
+
+        due = timer.timer_due
+        if due is None:
+            return
+
+        timer.timer_due = None
+        slot = self.slots.get(due)
+        if slot is not None:
+            slot.discard(timer)
+            if not slot:
+                del self.slots[due]
+
+        if not self.slots and self.call is not None:
+            self.call.cancel()
+            self.call = None
+
+    def advance(self):
+        """
+        Catch up with the clock, and fire everything which is due.
+
+        Usually this moves forward a single tick, but if the reactor was
+        held up, several ticks are swept at once.
+        """
+
+        self.call = None
+        now = int((self.clock.seconds() - self.epoch) / self.resolution)
+
+        while self.tick < now:
+            self.tick += 1
+            for timer in self.slots.pop(self.tick, ()):
+                timer.timer_due = None
+                timer.timerExpired()
+
+        # Only keep ticking while there's something to wait for.
+        if self.slots and self.call is None:
+            self.call = self.clock.callLater(self.resolution, self.advance)
+
+class WebSocketProtocol(ProtocolWrapper):
+    """
+    Protocol which wraps another protocol to provide a WebSockets transport
+    layer.
+    """
+
+    codec = None
+    codec_stream = None
+    headers = None
+
+    # The factory to build the wrapped protocol with. Protocols from a
+    # RoutingWebSocketFactory don't get theirs until the handshake is done.
+    route = None
+    location = "/"
+
+    # Where the client said it was connecting to, and from; None once the
+    # handshake is forgotten, unless the factory keeps it.
+    host = None
+    origin = None
+
     state = REQUEST
     flavor = None
+
+    # Handshake parsing: how far into the buffer we've already looked for
+    # the end of the request line or headers, and the size, in bytes, of the
+    # request so far.
+    head_scan = 0
+    head_size = 0
     do_binary_frames = False
 
+    # Pieces of the fragmented message coming in, frames written by the
+    # wrapped protocol which haven't been sent yet, and writes coalesced
+    # during the current reactor turn, when coalescing. Most connections sit
+    # idle most of the time, so these are only made into lists when there's
+    # something to put in them, and go back to being empty once drained.
+    fragments = ()
+    pending_frames = ()
+    outgoing = ()
+    outgoing_size = 0
+    flush_call = None
+
+    # Flow control. Outbound, the producer registered by the wrapped
+    # protocol is paused whenever the transport is full or too much is
+    # buffered here; inbound, the wrapped protocol may pause us, and frames
+    # which were already decoded wait in undelivered.
+    monitor = None
+    producer = None
+    producer_streaming = True
+    producer_paused = False
+    writes_paused = False
+    pending_size = 0
+    reading_paused = False
+    undelivered = ()
+
+    # Whether a message is being transformed in the factory's thread pool.
+    # Reading stops until it's delivered, which keeps messages in order.
+    offloading = False
+
+    # Names of the broadcast groups we're in.
+    groups = ()
+
+    # Compression, if it was negotiated, and whether the message coming in
+    # is compressed.
+    deflate = None
+    in_message = False
+    inflating = False
+
+    # Whether the message coming in is binary, whether the underlying
+    # protocol takes whole messages through messageReceived(data, binary),
+    # and the messages waiting to go to it together, if it would rather take
+    # them in batches through messagesReceived(messages).
+    binary_message = False
+    messages = False
+    batch = None
+
+    # Timer bookkeeping, all in ticks of the factory's timer wheel.
+    timers = None
+    timer_due = None
+    handshake_due = None
+    last_active = 0
+    ping_due = None
+
+    # Keepalive bookkeeping. The round-trip time, in seconds, is measured
+    # from the latest ping which got an answer, or None before then.
+    ping_payload = None
+    ping_time = None
+    pings_sent = 0
+    rtt = None
+
     def __init__(self, *args, **kwargs):
         ProtocolWrapper.__init__(self, *args, **kwargs)
-        self.pending_frames = []
+        self.buf = ReceiveBuffer()
+        self.decoder = None
 
     def setBinaryMode(self, mode):
         """
@@ -406,273 +1653,1020 @@ class WebSocketProtocol(ProtocolWrapper):
     def writeEncodedSequence(self, sequence):
         self.transport.writeSequence([ele.encode('utf-8') for ele in sequence])
 
-    def sendCommonPreamble(self):
-        """
-        Send the preamble common to all WebSockets connections.
-
-        This might go away in the future if WebSockets continue to diverge.
-        """
-
-        self.writeEncodedSequence([
-            "HTTP/1.1 101 FYI I am not a webserver\r\n",
-            "Server: TwistedWebSocketWrapper/1.0\r\n",
-            "Date: %s\r\n" % datetimeToString(),
-            "Upgrade: WebSocket\r\n",
-            "Connection: Upgrade\r\n",
-        ])
-
-    def sendHyBi00Preamble(self):
+    def sendHyBi00Preamble(self, response=b""):
         """
-        Send a HyBi-00 preamble.
+        Send a HyBi-00 preamble, followed by the response to the client's
+        challenge.
         """
 
         protocol = "wss" if self.isSecure() else "ws"
 
-        self.sendCommonPreamble()
-
-        self.writeEncodedSequence([
-            "Sec-WebSocket-Origin: %s\r\n" % self.origin,
-            "Sec-WebSocket-Location: %s://%s%s\r\n" % (protocol, self.host,
-                                                       self.location),
-            "WebSocket-Protocol: %s\r\n" % self.codec,
-            "Sec-WebSocket-Protocol: %s\r\n" % self.codec,
-            "\r\n",
+        # HyBi-00 clients want their origin and location echoed back. Both
+        # codec headers have always been sent to them, codec or not.
+        origin = self.origin or "http://example.com"
+        host = self.host or "example.com"
+        lines = ("Sec-WebSocket-Origin: %s\r\n"
+                 "Sec-WebSocket-Location: %s://%s%s\r\n"
+                 % (origin, protocol, host, self.location))
+        codec = codec_lines(str(self.codec), True)
+
+        data = b"".join([
+            _response_head, http_date(), _response_upgrade,
+            lines.encode("utf-8"), codec, b"\r\n", response,
         ])
+        self.factory.bytes_sent += len(data)
+        self.transport.write(data)
 
     def sendHyBi07Preamble(self):
         """
         Send a HyBi-07 preamble.
         """
 
-        self.sendCommonPreamble()
+        parts = [_response_head, http_date(), _response_upgrade,
+                 codec_lines(self.codec)]
 
-        if self.codec:
-            self.writeEncoded("Sec-WebSocket-Protocol: %s\r\n" % self.codec)
+        if self.deflate is not None:
+            parts.append(("Sec-WebSocket-Extensions: %s\r\n"
+                          % self.deflate.response()).encode("utf-8"))
 
         challenge = self.headers["Sec-WebSocket-Key"]
         response = make_accept(challenge)
 
-        self.writeEncoded("Sec-WebSocket-Accept: %s\r\n\r\n" % response)
+        parts.extend([b"Sec-WebSocket-Accept: ", response.encode("ascii"),
+                      b"\r\n\r\n"])
+        data = b"".join(parts)
+        self.factory.bytes_sent += len(data)
+        self.transport.write(data)
 
     def parseFrames(self):
         """
         Find frames in incoming data and pass them to the underlying protocol.
         """
 
-        if self.flavor == HYBI00:
-            parser = parse_hybi00_frames
-        elif self.flavor in (HYBI07, HYBI10, RFC6455):
-            parser = parse_hybi07_frames
-        else:
-            raise WSException("Unknown flavor %r" % self.flavor)
+        factory = self.factory
+        decoder = self.decoder
+        if decoder is None:
+            # See whether the underlying protocol would rather have whole
+            # messages than a stream of bytes.
+            wrapped = self.wrappedProtocol
+            if hasattr(wrapped, "messagesReceived"):
+                self.messages = True
+                self.batch = []
+            elif hasattr(wrapped, "messageReceived"):
+                self.messages = True
+
+            if self.flavor == HYBI00:
+                decoder = HyBi00Decoder(factory.max_frame_size)
+            elif self.flavor in (HYBI07, HYBI10, RFC6455):
+                # Codecs need whole frames to work with, so they get in the
+                # way of streaming, unless they can decode piece by piece.
+                # Protocols which take whole messages don't stream at all.
+                streaming = factory.streaming and not self.messages
+                if self.codec in decoders:
+                    if self.codec in stream_decoders:
+                        self.codec_stream = stream_decoders[self.codec]()
+                    else:
+                        streaming = False
+                decoder = HyBi07Decoder(streaming, factory.max_frame_size,
+                                        factory.max_message_size,
+                                        self.deflate is not None)
+            else:
+                raise WSException("Unknown flavor %r" % self.flavor)
+            self.decoder = decoder
 
         try:
-            frames, self.buf = parser(self.buf)
+            frames = self.decodeFrames()
         except WSException as wse:
             # Couldn't parse all the frames, something went wrong, let's bail.
-            self.close(wse.args[0])
+            self.factory.parse_errors += 1
+            self.logError(protocol_log, "Protocol error: {error} ({code})",
+                          error=wse.args[0], code=wse.code)
+            self.close(wse.args[0], wse.code)
             return
 
-        for frame in frames:
-            opcode, data = frame
-            if opcode == NORMAL:
-                # Business as usual. Decode the frame, if we have a decoder.
-                if self.codec:
-                    data = decoders[self.codec](data)
-                # Pass the frame to the underlying protocol.
-                ProtocolWrapper.dataReceived(self, data)
-            elif opcode == CLOSE:
-                # The other side wants us to close. I wonder why?
-                reason, text = data
-                log.msg("Closing connection: %r (%d)" % (text, reason))
-
-                # Close the connection.
-                self.close()
+        self.deliverFrames(frames)
 
-    def sendFrames(self):
+    def decodeFrames(self):
         """
-        Send all pending frames.
+        Decode as many frames as have arrived.
         """
 
-        if self.state != FRAMES:
-            return
+        return self.decoder.decode(self.buf)
 
-        if self.flavor == HYBI00:
-            maker = make_hybi00_frame
-        elif self.flavor in (HYBI07, HYBI10, RFC6455):
-            if self.do_binary_frames:
-                maker = make_hybi07_frame_dwim
-            else:
-                maker = make_hybi07_frame
-        else:
-            raise WSException("Unknown flavor %r" % self.flavor)
+    def deliverFrames(self, frames):
+        """
+        Handle decoded frames, passing data to the underlying protocol.
 
-        for frame in self.pending_frames:
-            # Encode the frame before sending it.
-            if self.codec:
-                frame = encoders[self.codec](frame)
-            packet = maker(frame)
-            self.writeEncoded(packet)
-        self.pending_frames = []
+        If the underlying protocol pauses us part of the way through, the
+        rest of the frames are held back until it resumes us.
+        """
 
-    def validateHeaders(self):
+        self.dispatchFrames(frames)
+        if self.batch:
+            self.flushMessages()
+
+    def dispatchFrames(self, frames):
         """
-        Check received headers for sanity and correctness, and stash any data
-        from them which will be required later.
+        Handle decoded frames, one at a time.
         """
 
-        # Obvious but necessary.
-        if not is_websocket(self.headers):
-            log.msg("Not handling non-WS request")
-            return False
-
-        # Stash host and origin for those browsers that care about it.
-        if "Host" in self.headers:
-            self.host = self.headers["Host"]
-        if "Origin" in self.headers:
-            self.origin = self.headers["Origin"]
+        decoder = self.decoder
+        factory = self.factory
 
-        # Check whether a codec is needed. WS calls this a "protocol" for
-        # reasons I cannot fathom. Newer versions of noVNC (0.4+) sets
-        # multiple comma-separated codecs, handle this by chosing first one
-        # we can encode/decode.
-        protocols = None
-        if "WebSocket-Protocol" in self.headers:
-            protocols = self.headers["WebSocket-Protocol"]
-        elif "Sec-WebSocket-Protocol" in self.headers:
-            protocols = self.headers["Sec-WebSocket-Protocol"]
+        for i, frame in enumerate(frames):
+            if self.reading_paused or self.offloading:
+                self.undelivered = frames[i:]
+                return
 
-        if isinstance(protocols, six.string_types):
-            protocols = [p.strip() for p in protocols.split(',')]
+            opcode, data, complete, fin, raw = frame
+            if complete:
+                factory.frames_received[raw & 0xf] += 1
+            if opcode != CLOSE:
+                factory.frame_bytes_received[raw & 0xf] += len(data)
+            if opcode == NORMAL:
+                end = complete and fin
+
+                if not self.in_message:
+                    # The first frame of a message says whether the whole
+                    # message is compressed, and whether it's binary.
+                    self.in_message = True
+                    self.inflating = bool(raw & 0x40)
+                    self.binary_message = raw & 0xf == 0x2
+
+                if end:
+                    self.in_message = False
+
+                # Fragmented messages in a codec which can decode piece by
+                # piece are decoded as they arrive, like streamed ones, so
+                # that they're never held both encoded and decoded.
+                piecewise = decoder.streaming or (
+                    self.codec_stream is not None
+                    and not (end and not self.fragments))
+                if piecewise:
+                    try:
+                        data = self.transformPiece(data, end)
+                    except (WSException, zlib.error, binascii.Error) as e:
+                        factory.parse_errors += 1
+                        self.close(str(e.args[0]), getattr(e, "code", 1007))
+                        return
+
+                if decoder.streaming:
+                    if data:
+                        self.deliverMessage(data, self.binary_message)
+                    continue
+
+                # Put fragmented messages back together. The decoder has
+                # already made sure that they are in order and not too big,
+                # so all that's left is to join the pieces.
+                if not end:
+                    if self.fragments:
+                        self.fragments.append(data)
+                    else:
+                        self.fragments = [data]
+                    continue
+                elif self.fragments:
+                    self.fragments.append(data)
+                    data = b"".join(self.fragments)
+                    del self.fragments
+
+                if piecewise:
+                    self.deliverMessage(data, self.binary_message)
+                    continue
+
+                # Big messages are inflated and decoded in a thread, so that
+                # they don't hold up everybody else; the rest of the frames
+                # wait until that's done, to keep them in order.
+                threshold = factory.offload_threshold
+                if threshold is not None and len(data) >= threshold:
+                    self.offloadMessage(data, self.inflating,
+                                        self.binary_message, frames[i + 1:])
+                    return
+
+                try:
+                    data = self.transformMessage(data, self.inflating)
+                except (WSException, zlib.error, binascii.Error) as e:
+                    factory.parse_errors += 1
+                    self.close(str(e.args[0]), getattr(e, "code", 1007))
+                    return
+
+                # Pass the message to the underlying protocol.
+                self.deliverMessage(data, self.binary_message)
+            elif opcode == CLOSE:
+                # The other side wants us to close. I wonder why?
+                reason, text = data
+                factory.countClose(factory.closes_received, reason)
+                if factory.log_connections:
+                    protocol_log.debug("Closing connection: {text!r} "
+                                       "({reason})", text=text, reason=reason)
 
-            for protocol in protocols:
-                if protocol in encoders or protocol in decoders:
-                    log.msg("Using WS protocol %s!" % protocol)
-                    self.codec = protocol
-                    break
+                # Close the connection.
+                self.close()
+                return
+            elif opcode == PING:
+                # Ping? Pong!
+                self.sendControlFrame(0xa, data)
+            elif opcode == PONG:
+                self.pongReceived(data)
+
+    def transformMessage(self, data, inflating):
+        """
+        Inflate and decode a whole message.
 
-                log.msg("Couldn't handle WS protocol %s!" % protocol)
+        This may be called in a thread, so it mustn't touch anything but the
+        message and the compression context, which only one message at a
+        time uses.
+        """
 
-            if not self.codec:
-                return False
+        if inflating:
+            data = self.deflate.decompress(data, True)
+        if self.codec in decoders:
+            data = decoders[self.codec](data)
+        return data
 
-        # Start the next phase of the handshake for HyBi-00.
-        if is_hybi00(self.headers):
-            log.msg("Starting HyBi-00/Hixie-76 handshake")
-            self.flavor = HYBI00
-            self.state = CHALLENGE
+    def transformPiece(self, data, end):
+        """
+        Inflate and decode the next piece of a message, as it arrives, and
+        return as much of it as can be decoded so far.
+        """
 
-        # Start the next phase of the handshake for HyBi-07+.
-        if "Sec-WebSocket-Version" in self.headers:
-            version = self.headers["Sec-WebSocket-Version"]
-            if version == "7":
-                log.msg("Starting HyBi-07 conversation")
-                self.sendHyBi07Preamble()
-                self.flavor = HYBI07
-                self.state = FRAMES
-            elif version == "8":
-                log.msg("Starting HyBi-10 conversation")
-                self.sendHyBi07Preamble()
-                self.flavor = HYBI10
-                self.state = FRAMES
-            elif version == "13":
-                log.msg("Starting RFC 6455 conversation")
-                self.sendHyBi07Preamble()
-                self.flavor = RFC6455
-                self.state = FRAMES
-            else:
-                log.msg("Can't support protocol version %s!" % version)
-                return False
+        if self.inflating:
+            data = self.deflate.decompress(data, end)
+        if self.codec_stream is not None:
+            data = self.codec_stream.decode(data, end)
+        return data
 
-        return True
+    def deliverMessage(self, data, binary):
+        """
+        Pass a whole message to the underlying protocol, in whichever way it
+        prefers. When streaming, this gets pieces of messages, too.
+        """
 
-    def dataReceived(self, data):
-        self.buf += data
+        if self.batch is not None:
+            self.batch.append((data, binary))
+        elif self.messages:
+            self.wrappedProtocol.messageReceived(data, binary)
+        else:
+            ProtocolWrapper.dataReceived(self, data)
 
-        oldstate = None
+    def flushMessages(self):
+        """
+        Pass the messages batched up so far to the underlying protocol.
+        """
 
-        while oldstate != self.state:
-            oldstate = self.state
+        batch, self.batch = self.batch, []
+        self.wrappedProtocol.messagesReceived(batch)
 
-            # Handle initial requests. These look very much like HTTP
-            # requests, but aren't. We need to capture the request path for
-            # those browsers which want us to echo it back to them (Chrome,
-            # mainly.)
-            # These lines look like:
-            # GET /some/path/to/a/websocket/resource HTTP/1.1
-            if self.state == REQUEST:
-                separator = b"\r\n"
-                if separator in self.buf:
-                    request, chaff, self.buf = self.buf.partition(separator)
-                    request = request.decode('utf-8')
+    def offloadMessage(self, data, inflating, binary, rest):
+        """
+        Transform a message in the factory's thread pool.
 
-                    try:
-                        verb, self.location, version = request.split(" ")
-                    except ValueError:
-                        self.loseConnection()
-                    else:
-                        self.state = NEGOTIATING
+        Reading stops and the rest of the frames are held back until the
+        message has been delivered.
+        """
 
-            elif self.state == NEGOTIATING:
-                # Check to see if we've got a complete set of headers yet.
-                separator = b"\r\n\r\n"
-                if separator in self.buf:
-                    head, chaff, self.buf = self.buf.partition(separator)
-                    head = head.decode('utf-8')
+        self.offloading = True
+        self.undelivered = rest
+        self.transport.pauseProducing()
 
-                    self.headers = http_headers(head)
-                    # Validate headers. This will cause a state change.
-                    if not self.validateHeaders():
-                        self.loseConnection()
+        d = self.factory.deferToThread(self.transformMessage, data, inflating)
+        d.addCallbacks(self.offloadDone, self.offloadFailed,
+                       callbackArgs=(binary,))
 
-            elif self.state == CHALLENGE:
-                # Handle the challenge. This is completely exclusive to
-                # HyBi-00/Hixie-76.
-                if len(self.buf) >= 8:
-                    challenge, self.buf = self.buf[:8], self.buf[8:]
-                    challenge = challenge.decode('utf-8')
+    def offloadDone(self, data, binary):
+        """
+        Deliver a message which was transformed in a thread, and pick up
+        where we left off.
+        """
 
-                    response = complete_hybi00(self.headers, challenge)
-                    self.sendHyBi00Preamble()
-                    self.writeEncoded(response)
-                    log.msg("Completed HyBi-00/Hixie-76 handshake")
-                    # We're all finished here; start sending frames.
-                    self.state = FRAMES
+        self.offloading = False
+        if self.disconnecting or self.state != FRAMES:
+            return
 
-            elif self.state == FRAMES:
-                self.parseFrames()
+        self.deliverMessage(data, binary)
+        if self.batch:
+            self.flushMessages()
 
-        # Kick any pending frames. This is needed because frames might have
-        # started piling up early; we can get write()s from our protocol above
-        # when they makeConnection() immediately, before our browser client
-        # actually sends any data. In those cases, we need to manually kick
-        # pending frames.
-        if self.pending_frames:
-            self.sendFrames()
+        if not self.reading_paused:
+            self.transport.resumeProducing()
+            self.catchUp()
 
-    def write(self, data):
+    def offloadFailed(self, failure):
         """
-        Write to the transport.
+        Close the connection if a message couldn't be transformed.
 
-        This method will only be called by the underlying protocol.
+        Bad data gets the same treatment as it would have without the thread
+        pool; anything else is our fault, so it's logged, and the connection
+        is closed with 1011.
         """
 
-        self.pending_frames.append(data)
-        self.sendFrames()
+        self.offloading = False
+        if self.disconnecting or self.state != FRAMES:
+            return
 
-    def writeSequence(self, data):
+        # Don't leave the transport paused; anything else which arrives is
+        # dropped, since we're about to disconnect.
+        self.transport.resumeProducing()
+
+        if failure.check(WSException, zlib.error, binascii.Error):
+            self.factory.parse_errors += 1
+            code = getattr(failure.value, "code", 1007)
+            self.close(str(failure.value.args[0]), code)
+        else:
+            protocol_log.failure("Couldn't transform a message", failure)
+            self.close("Internal error", 1011)
+
+    def sendControlFrame(self, opcode, data=b""):
+        """
+        Send a control frame, skipping the queue of pending frames.
         """
-        Write a sequence of data to the transport.
 
-        This method will only be called by the underlying protocol.
+        if self.state == FRAMES and self.flavor in (HYBI07, HYBI10, RFC6455):
+            # Don't let the control frame jump ahead of anything coalesced.
+            self.flushWrites()
+            parts = hybi07_frame_parts(data, opcode)
+            factory = self.factory
+            factory.bytes_sent += len(parts[0]) + len(parts[1])
+            factory.frames_sent[opcode] += 1
+            factory.frame_bytes_sent[opcode] += len(data)
+            self.transport.writeSequence(parts)
+
+    def startKeepalive(self):
+        """
+        Start pinging the other side regularly, if we've been asked to.
         """
 
-        self.pending_frames.extend(data)
-        self.sendFrames()
+        interval = self.factory.ping_interval
+        if interval and self.flavor in (HYBI07, HYBI10, RFC6455):
+            self.ping_due = self.timers.now() + self.timers.ticks(interval)
 
-    def close(self, reason=""):
+    def scheduleTimer(self):
+        """
+        Schedule our timer for the earliest thing we're waiting on: the end
+        of the handshake, the idle timeout, or the next keepalive ping.
         """
-        Close the connection.
+
+        factory = self.factory
+        timers = self.timers
+        if timers is None:
+            return
+
+        due = []
+        if self.state != FRAMES:
+            if self.handshake_due is not None:
+                due.append(self.handshake_due)
+        else:
+            if factory.idle_timeout:
+                due.append(self.last_active +
+                           timers.ticks(factory.idle_timeout))
+            if self.ping_due is not None:
+                due.append(self.ping_due)
+
+        if due:
+            timers.schedule(self, min(due))
+        else:
+            timers.cancel(self)
+
+    def timerExpired(self):
+        """
+        Deal with whatever we were waiting on, now that it's due.
+        """
+
+        factory = self.factory
+        now = self.timers.now()
+
+        if self.state != FRAMES:
+            factory.handshakes_rejected["timeout"] += 1
+            if factory.log_connections:
+                handshake_log.debug("Handshake timed out")
+            self.loseConnection()
+            return
+
+        if (factory.idle_timeout and now - self.last_active >=
+            self.timers.ticks(factory.idle_timeout)):
+            if factory.log_connections:
+                protocol_log.debug("Connection idle, closing")
+            self.close("Idle timeout", 1001)
+            return
+
+        if self.ping_due is not None and now >= self.ping_due:
+            self.sendPing()
+            self.ping_due = now + self.timers.ticks(factory.ping_interval)
+
+        self.scheduleTimer()
+
+    def sendPing(self):
+        """
+        Send a ping, and start timing it.
+
+        Pings carry a counter, so that stale pongs can be told apart from the
+        one we're waiting for.
+        """
+
+        self.pings_sent += 1
+        self.ping_payload = pack(">Q", self.pings_sent)
+        self.ping_time = self.factory.getClock().seconds()
+        self.sendControlFrame(0x9, self.ping_payload)
+
+    def pongReceived(self, data):
+        """
+        Handle a pong. If it answers our latest ping, update the round-trip
+        time.
+        """
+
+        if self.ping_payload is not None and data == self.ping_payload:
+            self.rtt = self.factory.getClock().seconds() - self.ping_time
+            self.ping_payload = None
+
+    def sendFrames(self):
+        """
+        Send all pending frames.
+        """
+
+        factory = self.factory
+        if self.pending_size > factory.pending_high_water:
+            factory.pending_high_water = self.pending_size
+
+        if self.state != FRAMES:
+            self.checkBackpressure()
+            return
+
+        # Frame everything up as headers and payloads, and hand the whole
+        # lot to the transport at once, so that payloads never get copied
+        # just to stick a header on them.
+        parts = []
+        for frame in self.pending_frames:
+            frame = self.frameParts(frame)
+            self.countFrame(frame)
+            parts.extend(frame)
+        if self.pending_frames:
+            del self.pending_frames
+        self.pending_size = 0
+
+        self.writeParts(parts)
+        self.checkBackpressure()
+
+    def frameParts(self, frame):
+        """
+        Encode some data and wrap it in a frame, returning a sequence of byte
+        strings to be written out in order.
+        """
+
+        if self.flavor not in (HYBI00, HYBI07, HYBI10, RFC6455):
+            raise WSException("Unknown flavor %r" % self.flavor)
+
+        return frame_parts(frame, self.flavor == HYBI00, self.codec,
+                           self.do_binary_frames, self.deflate)
+
+    def countFrame(self, parts):
+        """
+        Count a frame, made by frameParts(), on its way out.
+        """
+
+        factory = self.factory
+        opcode = frame_opcode(parts)
+        factory.frames_sent[opcode] += 1
+        factory.frame_bytes_sent[opcode] += len(parts[1])
+
+    def frameVariant(self):
+        """
+        Describe how this connection puts data on the wire.
+
+        Connections with the same variant produce exactly the same bytes for
+        the same data, so broadcasts only need to be framed once for each
+        variant. Connections which compress with a context carried over from
+        earlier messages produce bytes nobody else can use; they have no
+        variant, and None is returned.
+        """
+
+        deflate = self.deflate
+        if deflate is None:
+            return self.flavor == HYBI00, self.codec, self.do_binary_frames
+        elif not deflate.server_no_context_takeover:
+            return None
+
+        return (False, self.codec, self.do_binary_frames,
+                deflate.server_max_window_bits, deflate.level,
+                deflate.mem_level, deflate.min_size)
+
+    def isSlow(self):
+        """
+        Whether this connection has fallen behind on its writes.
+        """
+
+        return (self.writes_paused or self.pending_size + self.outgoing_size >
+                self.factory.write_high_watermark)
+
+    def join(self, group):
+        """
+        Join a broadcast group on our factory.
+        """
+
+        self.factory.join(group, self)
+
+    def leave(self, group):
+        """
+        Leave a broadcast group on our factory.
+        """
+
+        self.factory.leave(group, self)
+
+    def writeParts(self, parts):
+        """
+        Write a sequence of byte strings to the transport, coalescing them
+        with other writes made during this reactor turn if we've been asked
+        to.
+        """
+
+        size = 0
+        for part in parts:
+            size += len(part)
+
+        factory = self.factory
+        factory.bytes_sent += size
+        if not factory.coalesce_writes:
+            self.transport.writeSequence(parts)
+            return
+
+        if self.outgoing:
+            self.outgoing.extend(parts)
+        else:
+            self.outgoing = list(parts)
+        self.outgoing_size += size
+
+        if self.outgoing_size >= factory.coalesce_max_bytes:
+            self.flushWrites()
+        elif self.flush_call is None:
+            clock = factory.getClock()
+            self.flush_call = clock.callLater(factory.coalesce_delay,
+                                              self.flushWrites)
+
+    def flushWrites(self):
+        """
+        Write out everything which has been coalesced so far.
+        """
+
+        if self.flush_call is not None:
+            if self.flush_call.active():
+                self.flush_call.cancel()
+            self.flush_call = None
+
+        if self.outgoing:
+            outgoing = self.outgoing
+            del self.outgoing
+            self.outgoing_size = 0
+            self.transport.writeSequence(outgoing)
+            self.checkBackpressure()
+
+    def readHead(self, separator):
+        """
+        Read the request up to the next separator, consuming the separator,
+        or return None if it hasn't all arrived yet.
+
+        Data which has already been searched for the separator isn't
+        searched again, so clients sending their requests a few bytes at a
+        time can't make us do quadratic work. Requests going over the
+        factory's max_header_size are refused.
+        """
+
+        buf = self.buf
+        limit = self.factory.max_header_size
+
+        index = buf.find(separator, self.head_scan)
+        if index == -1:
+            # Back up a little, in case the separator is split across reads.
+            self.head_scan = max(len(buf) - len(separator) + 1, 0)
+            if self.head_size + len(buf) > limit:
+                self.refuse(431)
+            return None
+
+        self.head_scan = 0
+        self.head_size += index + len(separator)
+        if self.head_size > limit:
+            self.refuse(431)
+            return None
+
+        head = buf.read(index)
+        buf.skip(len(separator))
+        return head
+
+    def parseHeaders(self, head):
+        """
+        Parse the request's headers, keeping the ones the handshake needs.
+
+        Returns False if the request has to be refused.
+        """
+
+        lines = head.split(b"\r\n")
+        if len(lines) > self.factory.max_headers:
+            self.refuse(431)
+            return False
+
+        names = self.factory.getHeaderNames()
+        headers = self.headers = {}
+
+        for line in lines:
+            name, colon, value = line.partition(b":")
+            name = names.get(name.strip().lower())
+            if name is None or not colon:
+                continue
+
+            try:
+                value = value.strip().decode("utf-8")
+            except UnicodeDecodeError:
+                self.refuse(400)
+                return False
+
+            if name in headers and name in list_headers:
+                value = "%s, %s" % (headers[name], value)
+            headers[name] = value
+
+        return True
+
+    def forgetHandshake(self):
+        """
+        Let go of what the handshake left behind, now that we're sending
+        frames, keeping only the headers which the factory was asked to keep
+        for the wrapped protocol.
+        """
+
+        self.head_scan = self.head_size = 0
+        self.route = None
+        if self.factory.keep_handshake:
+            return
+
+        # Drop back to the class's defaults of None.
+        state = vars(self)
+        state.pop("host", None)
+        state.pop("origin", None)
+        extra = self.factory.extra_headers
+        if extra and self.headers:
+            self.headers = dict((name, self.headers[name]) for name in extra
+                                if name in self.headers)
+        else:
+            del self.headers
+
+    def setState(self, state=None, flavor=None):
+        """
+        Move to another state, or settle on a flavor, keeping the factory's
+        count of open connections by flavor and state up to date.
+        """
+
+        counts = self.factory.connections_open
+        counts[self.flavor, self.state] -= 1
+        if state is not None:
+            self.state = state
+        if flavor is not None:
+            self.flavor = flavor
+        counts[self.flavor, self.state] += 1
+
+    def logError(self, log, format, **kwargs):
+        """
+        Log an error which the other side brought about, as a warning, rate
+        limited by the factory.
+        """
+
+        self.factory.getLogLimiter().emit(log, LogLevel.warn, format,
+                                          **kwargs)
+
+    def negotiate(self, head):
+        """
+        Parse and validate a complete set of headers, and answer them.
+        """
+
+        # Validating the headers will cause a state change.
+        if self.parseHeaders(head) and not self.validateHeaders():
+            self.loseConnection()
+
+    def refuse(self, code):
+        """
+        Refuse a request with an HTTP error, and hang up.
+        """
+
+        self.factory.handshakes_rejected[refusal_reasons[code]] += 1
+        self.logError(handshake_log, "Refusing request with HTTP {code}",
+                      code=code)
+        self.transport.write(error_responses[code])
+        self.loseConnection()
+
+    def validateHeaders(self):
+        """
+        Check received headers for sanity and correctness, and stash any data
+        from them which will be required later.
+        """
+
+        # Obvious but necessary.
+        if not is_websocket(self.headers):
+            self.factory.handshakes_rejected["not_websocket"] += 1
+            self.logError(handshake_log, "Not handling non-WS request")
+            return False
+
+        # Stash host and origin for those browsers that care about it.
+        if "Host" in self.headers:
+            self.host = self.headers["Host"]
+        if "Origin" in self.headers:
+            self.origin = self.headers["Origin"]
+
+        # Check whether a codec is needed. WS calls this a "protocol" for
+        # reasons I cannot fathom. Newer versions of noVNC (0.4+) sets
+        # multiple comma-separated codecs, handle this by chosing a binary
+        # one if we can, since HyBi-07 and newer can carry binary data
+        # without any transcoding, and otherwise the first one we can
+        # encode/decode.
+        protocols = None
+        if "WebSocket-Protocol" in self.headers:
+            protocols = self.headers["WebSocket-Protocol"]
+        elif "Sec-WebSocket-Protocol" in self.headers:
+            protocols = self.headers["Sec-WebSocket-Protocol"]
+
+        if isinstance(protocols, six.string_types):
+            self.codec = negotiate_codec(protocols,
+                                         not is_hybi00(self.headers))
+            if not self.codec:
+                self.factory.handshakes_rejected["bad_protocol"] += 1
+                self.logError(handshake_log,
+                              "Couldn't handle WS protocols {protocols}",
+                              protocols=protocols)
+                return False
+
+            if self.factory.log_connections:
+                handshake_log.debug("Using WS protocol {codec}",
+                                    codec=self.codec)
+            if self.codec in binary_codecs:
+                self.setBinaryMode(True)
+
+        # Start the next phase of the handshake for HyBi-00.
+        if is_hybi00(self.headers):
+            if self.factory.log_connections:
+                handshake_log.debug("Starting HyBi-00/Hixie-76 handshake")
+            self.setState(CHALLENGE, HYBI00)
+
+        # Start the next phase of the handshake for HyBi-07+.
+        if "Sec-WebSocket-Version" in self.headers:
+            version = self.headers["Sec-WebSocket-Version"]
+
+            # See whether we can agree on compression.
+            extensions = self.headers.get("Sec-WebSocket-Extensions")
+            if extensions and self.factory.permessage_deflate:
+                self.deflate = negotiate_deflate(parse_extensions(extensions),
+                                                 self.factory)
+            if version == "7":
+                self.setState(flavor=HYBI07)
+            elif version == "8":
+                self.setState(flavor=HYBI10)
+            elif version == "13":
+                self.setState(flavor=RFC6455)
+            else:
+                self.factory.handshakes_rejected["bad_version"] += 1
+                self.logError(handshake_log,
+                              "Can't support protocol version {version}",
+                              version=version)
+                return False
+
+            if self.factory.log_connections:
+                handshake_log.debug("Starting {flavor} conversation",
+                                    flavor=flavor_names[self.flavor])
+            self.sendHyBi07Preamble()
+            self.setState(FRAMES)
+
+            self.startKeepalive()
+            self.scheduleTimer()
+
+        return True
+
+    def dataReceived(self, data):
+        if self.disconnecting:
+            # We're on our way out; nothing more to say.
+            return
+
+        if self.timers is not None:
+            # Just note the time; the timer only gets moved when it fires.
+            self.last_active = self.timers.now()
+
+        factory = self.factory
+        factory.bytes_received += len(data)
+        self.buf.feed(data)
+        if len(self.buf) > factory.buf_high_water:
+            factory.buf_high_water = len(self.buf)
+
+        oldstate = None
+
+        while oldstate != self.state:
+            oldstate = self.state
+
+            # Handle initial requests. These look very much like HTTP
+            # requests, but aren't. We need to capture the request path for
+            # those browsers which want us to echo it back to them (Chrome,
+            # mainly.)
+            # These lines look like:
+            # GET /some/path/to/a/websocket/resource HTTP/1.1
+            if self.state == REQUEST:
+                line = self.readHead(b"\r\n")
+                if line is not None:
+                    try:
+                        verb, location, version = line.split(b" ")
+                        self.location = location.decode("utf-8")
+                    except ValueError:
+                        self.refuse(400)
+                    else:
+                        if self.wrappedProtocol is None:
+                            # Find out who we're talking to on behalf of.
+                            self.route = self.factory.route(self.location)
+                            if self.route is None:
+                                self.refuse(404)
+                                break
+                        self.setState(NEGOTIATING)
+
+            elif self.state == NEGOTIATING:
+                # Check to see if we've got a complete set of headers yet.
+                head = self.readHead(b"\r\n\r\n")
+                if head is not None:
+                    self.negotiate(head)
+
+            elif self.state == CHALLENGE:
+                # Handle the challenge. This is completely exclusive to
+                # HyBi-00/Hixie-76.
+                if len(self.buf) >= 8:
+                    challenge = self.buf.read(8)
+                    challenge = challenge.decode('utf-8')
+
+                    response = complete_hybi00(self.headers, challenge)
+                    self.sendHyBi00Preamble(response)
+                    if self.factory.log_connections:
+                        handshake_log.debug(
+                            "Completed HyBi-00/Hixie-76 handshake")
+                    # We're all finished here; start sending frames.
+                    self.setState(FRAMES)
+                    self.scheduleTimer()
+
+            elif self.state == FRAMES:
+                if self.wrappedProtocol is None:
+                    self.connectWrapped()
+                    if self.wrappedProtocol is None:
+                        # Refused; there's nobody to pass frames to.
+                        break
+                if self.head_size:
+                    self.factory.handshakes_accepted[self.flavor] += 1
+                    self.forgetHandshake()
+                if not (self.reading_paused or self.offloading):
+                    self.parseFrames()
+
+        # Kick any pending frames. This is needed because frames might have
+        # started piling up early; we can get write()s from our protocol above
+        # when they makeConnection() immediately, before our browser client
+        # actually sends any data. In those cases, we need to manually kick
+        # pending frames.
+        if self.pending_frames:
+            self.sendFrames()
+
+    def write(self, data):
+        """
+        Write to the transport.
+
+        This method will only be called by the underlying protocol.
+        """
+
+        if self.pending_frames:
+            self.pending_frames.append(data)
+        else:
+            self.pending_frames = [data]
+        self.pending_size += len(data)
+        self.sendFrames()
+
+    def writeSequence(self, data):
+        """
+        Write a sequence of data to the transport.
+
+        This method will only be called by the underlying protocol.
+        """
+
+        data = list(data)
+        if self.pending_frames:
+            self.pending_frames.extend(data)
+        else:
+            self.pending_frames = data
+        self.pending_size += sum(len(item) for item in data)
+        self.sendFrames()
+
+    # IConsumer, for the underlying protocol.
+
+    def registerProducer(self, producer, streaming):
+        """
+        Register a producer on behalf of the underlying protocol.
+
+        Push producers get paused and resumed according to how much we and
+        the transport have buffered. Pull producers are handed straight to
+        the transport, which already knows how to drive them.
+        """
+
+        if self.producer is not None:
+            raise RuntimeError("Cannot register producer %s, because "
+                               "producer %s was never unregistered."
+                               % (producer, self.producer))
+
+        if not streaming:
+            self.transport.unregisterProducer()
+            self.transport.registerProducer(producer, streaming)
+        self.producer = producer
+        self.producer_streaming = streaming
+        self.producer_paused = False
+        self.checkBackpressure()
+
+    def unregisterProducer(self):
+        """
+        Unregister the underlying protocol's producer.
+        """
+
+        if self.producer is None:
+            return
+
+        if not self.producer_streaming:
+            # It was a pull producer; put our monitor back, unless we're
+            # closing.
+            self.transport.unregisterProducer()
+            if self.monitor is not None:
+                self.transport.registerProducer(self.monitor, True)
+        self.producer = None
+        self.producer_paused = False
+
+    def writesPaused(self, paused):
+        """
+        Note whether the transport wants us to stop writing.
+        """
+
+        self.writes_paused = paused
+        self.checkBackpressure()
+
+    def checkBackpressure(self):
+        """
+        Pause or resume the underlying protocol's producer, according to how
+        full the transport is and how much we've buffered ourselves.
+        """
+
+        producer = self.producer
+        if producer is None or not self.producer_streaming:
+            return
+
+        factory = self.factory
+        buffered = self.pending_size + self.outgoing_size
+
+        if self.producer_paused:
+            if (not self.writes_paused
+                and buffered <= factory.write_low_watermark):
+                self.producer_paused = False
+                producer.resumeProducing()
+        elif self.writes_paused or buffered > factory.write_high_watermark:
+            self.producer_paused = True
+            producer.pauseProducing()
+
+    # IPushProducer, for the underlying protocol.
+
+    def pauseProducing(self):
+        """
+        Stop delivering data to the underlying protocol, and stop reading
+        from the transport.
+        """
+
+        self.reading_paused = True
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        """
+        Start delivering data again, beginning with anything which was held
+        back, and resume reading from the transport.
+        """
+
+        if not self.reading_paused:
+            return
+
+        self.reading_paused = False
+        if not self.offloading:
+            self.transport.resumeProducing()
+            self.catchUp()
+
+    def catchUp(self):
+        """
+        Deliver the frames which were held back, and parse anything which
+        arrived while we weren't reading.
+        """
+
+        if self.undelivered:
+            frames = self.undelivered
+            self.undelivered = ()
+            self.deliverFrames(frames)
+
+        if self.buf and not (self.reading_paused or self.offloading):
+            self.dataReceived(b"")
+
+    def stopProducing(self):
+        """
+        Stop reading from the transport for good.
+        """
+
+        self.transport.stopProducing()
+
+    def close(self, reason="", code=1000):
+        """
+        Close the connection.
 
         This includes telling the other side we're closing the connection.
 
@@ -682,18 +2676,1549 @@ class WebSocketProtocol(ProtocolWrapper):
         shouldn't be a problem.
         """
 
-        # Send a closing frame. It's only polite. (And might keep the browser
-        # from hanging.)
-        if self.flavor in (HYBI07, HYBI10, RFC6455):
-            frame = make_hybi07_frame(reason, opcode=0x8)
-            self.writeEncoded(frame)
+        # Send a closing frame. It's only polite. (And might keep the browser
+        # from hanging.)
+        if self.flavor in (HYBI07, HYBI10, RFC6455):
+            if isinstance(reason, six.text_type):
+                reason = reason.encode("utf-8")
+            if self.state == FRAMES:
+                self.factory.countClose(self.factory.closes_sent, code)
+            self.sendControlFrame(0x8, _close_code.pack(code) + reason)
+
+        self.loseConnection()
+
+    def loseConnection(self):
+        # Anything still coalesced goes out first.
+        self.flushWrites()
+
+        # Transports don't finish closing while a producer is registered, so
+        # stop watching the write buffer.
+        if self.monitor is not None:
+            if self.producer is None or self.producer_streaming:
+                self.transport.unregisterProducer()
+            self.monitor.protocol = None
+            self.monitor = None
+
+        ProtocolWrapper.loseConnection(self)
+
+    def connectWrapped(self):
+        """
+        Build the wrapped protocol from the factory the request was routed
+        to, now that the handshake is done, and connect it.
+        """
+
+        protocol = self.route.buildProtocol(self.transport.getPeer())
+        if protocol is None:
+            self.close("Refused", 1011)
+            return
+
+        self.wrappedProtocol = protocol
+        protocol.makeConnection(self)
+
+    def makeConnection(self, transport):
+        factory = self.factory
+        factory.connections += 1
+        factory.connections_total += 1
+        factory.connections_open[self.flavor, self.state] += 1
+
+        if (factory.handshake_timeout or factory.idle_timeout
+            or factory.ping_interval):
+            self.timers = timers = factory.getTimerWheel()
+            self.last_active = timers.now()
+            if factory.handshake_timeout:
+                self.handshake_due = (self.last_active +
+                                      timers.ticks(factory.handshake_timeout))
+                timers.schedule(self, self.handshake_due)
+
+        # Keep an eye on the transport's write buffer.
+        self.monitor = WriteMonitor(self)
+        transport.registerProducer(self.monitor, True)
+
+        if self.wrappedProtocol is None:
+            # The wrapped protocol gets connected once it's been built.
+            directlyProvides(self, providedBy(transport))
+            Protocol.makeConnection(self, transport)
+            factory.registerProtocol(self)
+        else:
+            ProtocolWrapper.makeConnection(self, transport)
+
+    def connectionLost(self, reason):
+        self.factory.connections -= 1
+        self.factory.connections_open[self.flavor, self.state] -= 1
+        if self.timers is not None:
+            self.timers.cancel(self)
+        if self.flush_call is not None:
+            self.flush_call.cancel()
+            self.flush_call = None
+        if self.monitor is not None:
+            self.monitor.protocol = None
+        self.producer = None
+        if self.groups:
+            self.factory.leaveAll(self)
+        # Anything still in the thread pool has nowhere to go now.
+        self.disconnecting = True
+
+        if self.wrappedProtocol is None:
+            self.factory.unregisterProtocol(self)
+        else:
+            ProtocolWrapper.connectionLost(self, reason)
+
+class InstrumentedMixin(object):
+    """
+    Mixin for WebSocketProtocol and its subclasses which times each stage of
+    their work, in the factory's latency histograms, and adds up the CPU
+    time spent on each connection, as cpu_time.
+
+    The stages are the handshake, parsing frames, decoding messages,
+    delivering them to the wrapped protocol, and sending frames. Whatever the
+    wrapped protocol sends straight away counts towards delivering, too.
+
+    Factories mix this into their protocol when their instrument option is
+    set.
+    """
+
+    # CPU seconds spent handling this connection in the reactor thread, and
+    # whether that's being timed at the moment, so that time spent in
+    # nested calls doesn't count twice.
+    cpu_time = 0.0
+    busy = False
+
+    def timeStage(self, stage, f, *args):
+        """
+        Call a function, recording how long it took in the histogram for a
+        stage.
+        """
+
+        start = _timer()
+        try:
+            return f(*args)
+        finally:
+            self.factory.histograms[stage].record(_timer() - start)
+
+    def timeConnection(self, f, *args):
+        """
+        Call a function, adding the CPU time it took to cpu_time.
+        """
+
+        if self.busy:
+            return f(*args)
+        self.busy = True
+        start = _cpu_timer()
+        try:
+            return f(*args)
+        finally:
+            self.busy = False
+            self.cpu_time += _cpu_timer() - start
+
+    def dataReceived(self, data):
+        self.timeConnection(super(InstrumentedMixin, self).dataReceived,
+                            data)
+
+    def negotiate(self, head):
+        self.timeStage("handshake", super(InstrumentedMixin, self).negotiate,
+                       head)
+
+    def decodeFrames(self):
+        return self.timeStage("parse",
+                              super(InstrumentedMixin, self).decodeFrames)
+
+    def transformMessage(self, data, inflating):
+        transform = super(InstrumentedMixin, self).transformMessage
+        if self.offloading:
+            # We're in the thread pool; the histograms are only for the
+            # reactor thread.
+            return transform(data, inflating)
+        return self.timeStage("decode", transform, data, inflating)
+
+    def transformPiece(self, data, end):
+        return self.timeStage("decode",
+                              super(InstrumentedMixin, self).transformPiece,
+                              data, end)
+
+    def deliverMessage(self, data, binary):
+        deliver = super(InstrumentedMixin, self).deliverMessage
+        self.timeStage("deliver", deliver, data, binary)
+
+    def flushMessages(self):
+        self.timeStage("deliver",
+                       super(InstrumentedMixin, self).flushMessages)
 
-        self.loseConnection()
+    def sendFrames(self):
+        self.timeConnection(self.timeStage, "send",
+                            super(InstrumentedMixin, self).sendFrames)
 
 class WebSocketFactory(WrappingFactory):
     """
     Factory which wraps another factory to provide WebSockets transports for
     all of its protocols.
+
+    Any of the options below may be overridden by keyword when creating the
+    factory, or in a subclass.
     """
 
     protocol = WebSocketProtocol
+
+    # Hand payloads of large frames to the wrapped protocol as they arrive,
+    # rather than waiting for the whole frame. This keeps memory per
+    # connection bounded by the size of a read, at the cost of the wrapped
+    # protocol seeing frames in several pieces.
+    streaming = False
+
+    # The largest frame, and the largest message after reassembling
+    # fragments, that a client may send, in bytes. Anything bigger is
+    # refused with close code 1009 as soon as its header arrives, before any
+    # of it is buffered. None means no limit.
+    max_frame_size = None
+    max_message_size = None
+
+    # How often to ping HyBi-07 and newer clients, in seconds, to keep
+    # intermediaries from timing out quiet connections and to measure their
+    # round-trip times. None turns keepalive pings off.
+    ping_interval = None
+
+    # Collect the frames written to each connection during a reactor turn,
+    # and write them out together, with one call to the transport. Coalesced
+    # frames are flushed after coalesce_delay seconds, or as soon as there
+    # are coalesce_max_bytes of them, whichever comes first.
+    coalesce_writes = False
+    coalesce_max_bytes = 65536
+    coalesce_delay = 0
+
+    # Watermarks, in bytes, for data buffered on the way out. Once more than
+    # write_high_watermark is buffered, or the transport itself is full, the
+    # wrapped protocol's producer is paused, until no more than
+    # write_low_watermark is left and the transport has drained.
+    write_high_watermark = 262144
+    write_low_watermark = 65536
+
+    # How long, in seconds, a client gets to finish its handshake, and how
+    # long a connection may go without receiving anything once the handshake
+    # is done, before it is disconnected. None means no limit.
+    handshake_timeout = None
+    idle_timeout = None
+
+    # The granularity, in seconds, of the timer wheel which handles timeouts
+    # and keepalive pings for all of this factory's connections.
+    timer_resolution = 1.0
+
+    # Negotiate permessage-deflate compression with clients which offer it.
+    # The window sizes, in bits, and zlib's memLevel bound the memory used
+    # by each connection's compression contexts; asking clients not to take
+    # over their context between messages lets us free our decompression
+    # context in between, too. Messages shorter than deflate_min_size are
+    # sent uncompressed, and compressed messages which would inflate to more
+    # than deflate_max_size bytes, or max_message_size if that's smaller,
+    # are refused with close code 1009.
+    permessage_deflate = False
+    deflate_level = 6
+    deflate_mem_level = 8
+    deflate_window_bits = 15
+    deflate_client_window_bits = 15
+    deflate_server_no_context_takeover = False
+    deflate_client_no_context_takeover = False
+    deflate_min_size = 32
+    deflate_max_size = 16777216
+
+    # What to do with members of a broadcast group which have fallen behind
+    # on their writes: "drop" skips them for that message, and "disconnect"
+    # closes their connection.
+    slow_consumer_policy = "drop"
+
+    # Inflate and decode messages of at least offload_threshold bytes in a
+    # pool of up to offload_threads threads, rather than in the reactor
+    # thread, so that a few big messages don't stall every other
+    # connection. Each connection has at most one message in the pool at a
+    # time. None keeps everything in the reactor thread.
+    offload_threshold = None
+    offload_threads = 4
+
+    # Limits on the request which asks for an upgrade: the most bytes, in
+    # the request line and headers together, and the most headers, which
+    # clients may send. Requests going over them are refused with HTTP 431.
+    max_header_size = 8192
+    max_headers = 64
+
+    # Headers, besides the ones the handshake needs, to keep in each
+    # protocol's headers dict for the wrapped protocol to look at. Once the
+    # handshake's done, only these are kept, and the host and origin are
+    # forgotten, unless keep_handshake is set.
+    extra_headers = ()
+    keep_handshake = False
+
+    # Log an event or two about every connection as it comes and goes. This
+    # is too much for a busy server, so it's off by default. Errors which
+    # clients bring about, such as bad frames or handshakes, are always
+    # logged, but no more than log_burst of each kind every log_interval
+    # seconds.
+    log_connections = False
+    log_burst = 10
+    log_interval = 60.0
+
+    # Time the stages of handling connections, in latency histograms, and
+    # how long is spent on each connection, by mixing InstrumentedMixin into
+    # the protocol. Off by default, to keep the overhead off the hot paths.
+    instrument = False
+
+    # The IReactorTime to use for timing; None means the global reactor.
+    clock = None
+
+    timers = None
+    log_limiter = None
+    threadpool = None
+    header_names = None
+    histograms = {}
+
+    # The MessageBus connecting this factory to its siblings in other
+    # processes, if any.
+    bus = None
+
+    def __init__(self, wrappedFactory, **options):
+        WrappingFactory.__init__(self, wrappedFactory)
+        self.groups = {}
+
+        # Counters, for keeping an eye on things. Connections are counted
+        # from when they're made, handshake or no, and bytes as they come
+        # off and go onto the wire, handshakes included.
+        self.connections = 0
+        self.connections_total = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+        # More counters, bumped by protocols on their hot paths, so they're
+        # just integers, in lists indexed by flavor or opcode, or dicts keyed
+        # by reason, close code, or flavor and state of open connections;
+        # snapshot() gives them names. Frame bytes
+        # are payload bytes, as they go over the wire. The high-water marks
+        # are the most bytes seen buffered, before parsing, on one
+        # connection, and waiting to be framed on one connection.
+        self.connections_open = dict(
+            ((flavor, state), 0)
+            for flavor in [None] + list(metric_flavors)
+            for state in metric_states)
+        self.handshakes_accepted = [0] * len(flavor_names)
+        self.handshakes_rejected = dict.fromkeys(rejection_reasons, 0)
+        self.frames_received = [0] * 16
+        self.frames_sent = [0] * 16
+        self.frame_bytes_received = [0] * 16
+        self.frame_bytes_sent = [0] * 16
+        self.parse_errors = 0
+        self.closes_received = {}
+        self.closes_sent = {}
+        self.buf_high_water = 0
+        self.pending_high_water = 0
+
+        for name, value in options.items():
+            if (name.startswith("_") or not hasattr(type(self), name)
+                or isroutine(getattr(type(self), name))):
+                raise TypeError("Unknown WebSocketFactory option %r" % name)
+            setattr(self, name, value)
+
+        if self.instrument:
+            # Instrument whichever protocol we were given, not just ours.
+            protocol = self.protocol
+            if not issubclass(protocol, InstrumentedMixin):
+                self.protocol = type("Instrumented" + protocol.__name__,
+                                     (InstrumentedMixin, protocol), {})
+            self.histograms = dict((stage, LatencyHistogram())
+                                   for stage in stages)
+
+    def snapshot(self):
+        """
+        Get the current values of this factory's counters, as a dict.
+        """
+
+        counters = {
+            "connections": self.connections,
+            "connections_total": self.connections_total,
+            "bytes_received": self.bytes_received,
+            "bytes_sent": self.bytes_sent,
+            "parse_errors": self.parse_errors,
+            "buf_high_water": self.buf_high_water,
+            "pending_high_water": self.pending_high_water,
+        }
+
+        # Labelled counters get their labels tacked on after dots.
+        for (flavor, state), count in self.connections_open.items():
+            key = "connections_open.%s.%s" % (
+                metric_flavors.get(flavor, "none"), metric_states[state])
+            counters[key] = count
+        for flavor, count in enumerate(self.handshakes_accepted):
+            counters["handshakes_accepted." + metric_flavors[flavor]] = count
+        for reason, count in self.handshakes_rejected.items():
+            counters["handshakes_rejected." + reason] = count
+        for opcode, name in metric_opcodes.items():
+            counters["frames_received." + name] = self.frames_received[opcode]
+            counters["frames_sent." + name] = self.frames_sent[opcode]
+            counters["frame_bytes_received." + name] = (
+                self.frame_bytes_received[opcode])
+            counters["frame_bytes_sent." + name] = (
+                self.frame_bytes_sent[opcode])
+        for code, count in self.closes_received.items():
+            counters["closes_received.%d" % code] = count
+        for code, count in self.closes_sent.items():
+            counters["closes_sent.%d" % code] = count
+
+        # Histograms, the way Prometheus likes them, with each bucket
+        # counting everything up to its bound.
+        for stage, histogram in self.histograms.items():
+            total = 0
+            for bound, count in zip(histogram.bounds + ("+Inf",),
+                                    histogram.counts):
+                total += count
+                counters["latency_seconds_bucket.%s.%s" % (stage, bound)] = (
+                    total)
+            counters["latency_seconds_sum." + stage] = histogram.sum
+            counters["latency_seconds_count." + stage] = total
+
+        if self.bus is not None:
+            counters.update(self.bus.snapshot())
+        return counters
+
+    def busiestConnections(self, count=10):
+        """
+        Get the protocols which have taken the most time to handle, with the
+        busiest first, when the factory is instrumented.
+        """
+
+        return nlargest(count, self.protocols,
+                        key=lambda protocol: protocol.cpu_time)
+
+    def countClose(self, closes, code):
+        """
+        Count a close code in closes_received or closes_sent.
+
+        Codes which aren't registered, or set aside for applications, are
+        all counted as 0, so that clients can't make up new ones forever.
+        """
+
+        if code not in close_codes and not 3000 <= code < 5000:
+            code = 0
+        closes[code] = closes.get(code, 0) + 1
+
+    def getHeaderNames(self):
+        """
+        Get the table of headers which protocols should keep, keyed by their
+        names in lower case.
+        """
+
+        if self.header_names is None:
+            names = dict(handshake_headers)
+            for name in self.extra_headers:
+                names[name.lower().encode("ascii")] = name
+            self.header_names = names
+        return self.header_names
+
+    def getClock(self):
+        """
+        Get the IReactorTime which protocols should use for timing.
+        """
+
+        if self.clock is None:
+            from twisted.internet import reactor
+            return reactor
+        return self.clock
+
+    def join(self, group, protocol):
+        """
+        Add a protocol to a broadcast group.
+        """
+
+        if not protocol.groups:
+            protocol.groups = set()
+        protocol.groups.add(group)
+        self.groups.setdefault(group, set()).add(protocol)
+
+    def leave(self, group, protocol):
+        """
+        Remove a protocol from a broadcast group.
+        """
+
+        if protocol.groups:
+            protocol.groups.discard(group)
+
+        members = self.groups.get(group)
+        if members is not None:
+            members.discard(protocol)
+            if not members:
+                del self.groups[group]
+
+    def leaveAll(self, protocol):
+        """
+        Remove a protocol from every broadcast group it's in.
+        """
+
+        for group in list(protocol.groups):
+            self.leave(group, protocol)
+
+    def publish(self, group, data):
+        """
+        Send some data to every member of a broadcast group.
+
+        The data is encoded and framed once for each variant of the wire
+        format in use by the group, and the resulting bytes are shared by
+        every member using that variant. Members which haven't finished
+        their handshakes get the data queued as usual, and slow members are
+        handled according to slow_consumer_policy.
+
+        If this factory is on a message bus, the data goes to the group's
+        members in the other processes on the bus, too.
+
+        Returns the number of members in this process which were sent the
+        data.
+        """
+
+        framed = {}
+        sent = self.publishLocal(group, data, framed)
+        if self.bus is not None:
+            self.bus.send(group, data, framed)
+        return sent
+
+    def publishLocal(self, group, data, framed=None):
+        """
+        Send some data to every member of a broadcast group in this process.
+
+        framed maps variants of the wire format to data which has already
+        been framed for them; variants which have to be framed here are
+        added to it.
+        """
+
+        members = self.groups.get(group)
+        if not members:
+            return 0
+
+        if framed is None:
+            framed = {}
+        sent = 0
+
+        # Copy the members, since disconnecting slow ones changes the group.
+        for protocol in list(members):
+            if protocol.state != FRAMES:
+                protocol.write(data)
+                sent += 1
+                continue
+
+            if protocol.isSlow():
+                if self.slow_consumer_policy == "disconnect":
+                    self.getLogLimiter().emit(
+                        broadcast_log, LogLevel.warn,
+                        "Disconnecting slow consumer in {group!r}",
+                        group=group)
+                    self.leaveAll(protocol)
+                    protocol.close("Slow consumer", 1008)
+                continue
+
+            variant = protocol.frameVariant()
+            if variant is None:
+                parts = protocol.frameParts(data)
+            else:
+                parts = framed.get(variant)
+                if parts is None:
+                    parts = framed[variant] = protocol.frameParts(data)
+
+            protocol.countFrame(parts)
+            protocol.writeParts(parts)
+            protocol.checkBackpressure()
+            sent += 1
+
+        return sent
+
+    def getTimerWheel(self):
+        """
+        Get the timer wheel shared by this factory's protocols.
+        """
+
+        if self.timers is None:
+            self.timers = TimerWheel(self.getClock(), self.timer_resolution)
+        return self.timers
+
+    def getLogLimiter(self):
+        """
+        Get the LogLimiter for errors logged by this factory's protocols.
+        """
+
+        if self.log_limiter is None:
+            self.log_limiter = LogLimiter(self.getClock(), self.log_burst,
+                                          self.log_interval)
+        return self.log_limiter
+
+    def deferToThread(self, f, *args, **kwargs):
+        """
+        Call a function in this factory's thread pool, starting the pool if
+        needed, and return a Deferred which fires with its result.
+        """
+
+        from twisted.internet import reactor
+
+        if self.threadpool is None:
+            self.threadpool = ThreadPool(0, self.offload_threads, "txws")
+            self.threadpool.start()
+            reactor.addSystemEventTrigger("during", "shutdown",
+                                          self.threadpool.stop)
+        return deferToThreadPool(reactor, self.threadpool, f, *args, **kwargs)
+
+class RoutingWebSocketFactory(WebSocketFactory):
+    """
+    WebSocketFactory which serves several wrapped factories, picking one for
+    each connection by the path it asks for.
+
+    Routes map paths to factories. Paths ending in a slash also match every
+    path beneath them; exact matches come first, then the longest matching
+    prefix, and then the default factory, if there is one. Requests which
+    don't match anything are refused with HTTP 404.
+
+    The wrapped protocol is only built once the handshake is done.
+    """
+
+    def __init__(self, routes, default=None, **options):
+        WebSocketFactory.__init__(self, default, **options)
+
+        self.exact = {}
+        self.prefixes = {}
+        for path, factory in routes.items():
+            self.exact[path] = factory
+            if path.endswith("/"):
+                self.prefixes[path] = factory
+
+        self.factories = []
+        for factory in list(routes.values()) + [default]:
+            if factory is not None and factory not in self.factories:
+                self.factories.append(factory)
+
+    def route(self, location):
+        """
+        Find the factory for a request, or None if there isn't one.
+        """
+
+        path = location.split("?", 1)[0]
+        factory = self.exact.get(path)
+        if factory is not None:
+            return factory
+
+        # Try each parent directory in turn, longest first.
+        index = len(path)
+        while True:
+            index = path.rfind("/", 0, index)
+            if index == -1:
+                return self.wrappedFactory
+            factory = self.prefixes.get(path[:index + 1])
+            if factory is not None:
+                return factory
+
+    def buildProtocol(self, addr):
+        return self.protocol(self, None)
+
+    def doStart(self):
+        for factory in self.factories:
+            factory.doStart()
+        ClientFactory.doStart(self)
+
+    def doStop(self):
+        for factory in self.factories:
+            factory.doStop()
+        ClientFactory.doStop(self)
+
+# Metrics. Factories keep counters which their protocols bump as they go,
+# and snapshot() flattens them into a dict, keyed by metric name, with the
+# values of any labels tacked on after dots: "frames_received.text" is the
+# number of text frames received. Worker reports are these dicts, and
+# render_metrics() turns them into the Prometheus text format.
+
+# Metric names, with their types, help, and the names of their labels.
+metrics = {
+    "connections": ("gauge", "Open connections.", ()),
+    "connections_open": ("gauge", "Open connections, by flavor and state.",
+                         ("flavor", "state")),
+    "connections_total": ("counter", "Connections made.", ()),
+    "bytes_received": ("counter", "Bytes received, handshakes included.",
+                       ()),
+    "bytes_sent": ("counter", "Bytes sent, handshakes included.", ()),
+    "handshakes_accepted": ("counter", "Handshakes completed, by flavor.",
+                            ("flavor",)),
+    "handshakes_rejected": ("counter", "Handshakes rejected, by reason.",
+                            ("reason",)),
+    "frames_received": ("counter", "Frames received, by opcode.",
+                        ("opcode",)),
+    "frames_sent": ("counter", "Frames sent, by opcode.", ("opcode",)),
+    "frame_bytes_received": ("counter",
+                             "Payload bytes received, by opcode.",
+                             ("opcode",)),
+    "frame_bytes_sent": ("counter", "Payload bytes sent, by opcode.",
+                         ("opcode",)),
+    "parse_errors": ("counter", "Connections closed over bad frames or "
+                     "messages.", ()),
+    "closes_received": ("counter", "Close frames received, by code.",
+                        ("code",)),
+    "closes_sent": ("counter", "Close frames sent, by code.", ("code",)),
+    "buf_high_water": ("gauge", "Most bytes buffered unparsed on a "
+                       "connection.", ()),
+    "pending_high_water": ("gauge", "Most bytes waiting to be framed on a "
+                           "connection.", ()),
+    "bus_peers": ("gauge", "Processes connected over the message bus.", ()),
+    "bus_slow_peers": ("gauge", "Message bus peers which are behind.", ()),
+    "bus_sent": ("counter", "Messages sent over the message bus.", ()),
+    "bus_received": ("counter", "Messages received over the message bus.",
+                     ()),
+    "bus_dropped": ("counter", "Messages dropped for slow message bus "
+                    "peers.", ()),
+    "latency_seconds": ("histogram", "Time taken by each stage of handling "
+                        "connections.", ("stage",)),
+    "workers": ("gauge", "Worker processes running.", ()),
+    "restarts": ("counter", "Worker processes restarted.", ()),
+}
+
+# Label values.
+metric_flavors = {
+    HYBI00: "hybi00",
+    HYBI07: "hybi07",
+    HYBI10: "hybi10",
+    RFC6455: "rfc6455",
+}
+
+metric_states = {
+    REQUEST: "request",
+    NEGOTIATING: "negotiating",
+    CHALLENGE: "challenge",
+    FRAMES: "frames",
+}
+
+metric_opcodes = {
+    0x0: "continuation",
+    0x1: "text",
+    0x2: "binary",
+    0x8: "close",
+    0x9: "ping",
+    0xa: "pong",
+}
+
+# The stages which are timed by InstrumentedMixin.
+stages = ("handshake", "parse", "decode", "deliver", "send")
+
+# Close codes registered with IANA, which are counted as themselves.
+close_codes = frozenset(range(1000, 1016))
+
+def _label_value(value):
+    return (value.replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+def _sort_key(labels):
+    # Numeric labels, such as histogram bounds, sort as numbers.
+    key = []
+    for label in labels:
+        try:
+            key.append((0, float(label), label))
+        except ValueError:
+            key.append((1, 0, label))
+    return key
+
+def render_metrics(counters, prefix="txws_"):
+    """
+    Render a dict of counters, as from snapshot(), in the Prometheus text
+    exposition format.
+    """
+
+    families = {}
+    for key, value in counters.items():
+        name, dot, labels = key.partition(".")
+        family = name
+        for suffix in ("_bucket", "_sum", "_count"):
+            base = name[:-len(suffix)]
+            if (name.endswith(suffix) and
+                metrics.get(base, ("untyped",))[0] == "histogram"):
+                family = base
+        families.setdefault(family, []).append((name, labels, value))
+
+    lines = []
+    for family in sorted(families):
+        kind, help, label_names = metrics.get(family, ("untyped", family, ()))
+        lines.append("# HELP %s%s %s" % (prefix, family, help))
+        lines.append("# TYPE %s%s %s" % (prefix, family, kind))
+
+        series = []
+        for name, labels, value in families[family]:
+            names = label_names
+            if name.endswith("_bucket") and name != family:
+                names += ("le",)
+            labels = labels.split(".", len(names) - 1) if labels else []
+            # Keep each histogram's buckets, sum and count together.
+            key = (_sort_key(labels[:len(label_names)]), name,
+                   _sort_key(labels))
+            series.append((key, name, list(zip(names, labels)), value))
+        series.sort()
+
+        for key, name, labels, value in series:
+            if isinstance(value, float):
+                value = repr(value)
+            else:
+                value = "%d" % value
+            if labels:
+                labels = ",".join('%s="%s"' % (label, _label_value(text))
+                                  for label, text in labels)
+                lines.append("%s%s{%s} %s" % (prefix, name, labels, value))
+            else:
+                lines.append("%s%s %s" % (prefix, name, value))
+    return "\n".join(lines) + "\n"
+
+class MetricsResource(Resource):
+    """
+    Resource which serves counters in the Prometheus text format, for
+    mounting wherever they're to be scraped from.
+
+    counters is a callable returning them, such as a factory's snapshot()
+    or a supervisor's totals().
+    """
+
+    isLeaf = True
+
+    def __init__(self, counters, prefix="txws_"):
+        Resource.__init__(self)
+        self.counters = counters
+        self.prefix = prefix
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type",
+                          b"text/plain; version=0.0.4; charset=utf-8")
+        return render_metrics(self.counters(), self.prefix).encode("utf-8")
+
+class Profiler(object):
+    """
+    Switch cProfile on and off in a running process, so that it can be
+    profiled without restarting it. Each run's stats are dumped into a
+    directory, for pstats or any other profile viewer.
+    """
+
+    def __init__(self, directory, reactor=None):
+        self.directory = directory
+        self.reactor = reactor
+        self.profile = None
+        self.runs = 0
+
+    def toggle(self):
+        """
+        Start profiling, or stop and dump the stats.
+
+        Returns the path the stats were dumped to, if any.
+        """
+
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            profile_log.info("Profiling started")
+            return None
+
+        profile, self.profile = self.profile, None
+        profile.disable()
+        self.runs += 1
+        path = os.path.join(self.directory,
+                            "txws-%d-%d.prof" % (os.getpid(), self.runs))
+        profile.dump_stats(path)
+        profile_log.info("Profiling stopped; stats are in {path}", path=path)
+        return path
+
+    def install(self, signum=None):
+        """
+        Toggle profiling whenever the process gets a signal, SIGUSR2 by
+        default.
+        """
+
+        if signum is None:
+            signum = signal.SIGUSR2
+        reactor = self.reactor
+        if reactor is None:
+            from twisted.internet import reactor
+
+        def handler(signum, frame):
+            reactor.callFromThread(self.toggle)
+        signal.signal(signum, handler)
+
+# Worker processes. A single reactor only keeps one core busy; to use more,
+# run several worker processes, each with its own reactor and factory, all
+# listening on the same port with SO_REUSEPORT, so that the kernel spreads
+# connections between them. A supervisor process starts the workers,
+# restarts them when they die, passes signals on to them, and adds up the
+# counters which they report back.
+
+# Counters which are levels rather than running totals; a dead worker's
+# totals still count, but its levels don't. Of those, high-water marks are
+# combined by taking the highest rather than adding them up.
+gauges = frozenset(name for name, (kind, help, labels) in metrics.items()
+                   if kind == "gauge")
+maxima = frozenset(["buf_high_water", "pending_high_water"])
+
+# Signals which the supervisor passes on to its workers. Stopping the
+# supervisor, with SIGINT or SIGTERM, stops the workers too.
+forwarded_signals = [getattr(signal, name) for name in
+                     ("SIGHUP", "SIGUSR1", "SIGUSR2") if hasattr(signal, name)]
+
+def listen_reuseport(port, factory, interface="", backlog=50, reactor=None):
+    """
+    Listen on a TCP port with SO_REUSEPORT, so that other processes can
+    listen on the same port, and return the IListeningPort.
+    """
+
+    if reactor is None:
+        from twisted.internet import reactor
+
+    reuseport = getattr(socket, "SO_REUSEPORT", None)
+    if reuseport is None:
+        raise RuntimeError("SO_REUSEPORT isn't available on this platform")
+
+    family = socket.AF_INET6 if ":" in interface else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, reuseport, 1)
+        sock.bind((interface, port))
+        sock.listen(backlog)
+        sock.setblocking(False)
+        return reactor.adoptStreamPort(sock.fileno(), family, factory)
+    finally:
+        # The reactor has its own copy of the socket.
+        sock.close()
+
+def load_factory(name):
+    """
+    Find a factory by its fully qualified name. The name may also be that of
+    a callable which returns a factory.
+    """
+
+    factory = namedAny(name)
+    if not IProtocolFactory.providedBy(factory):
+        factory = factory()
+    return factory
+
+def run_worker(name, port, interface="", report_interval=1.0, report_fd=3,
+               bus=None, profile_dir=None):
+    """
+    Run a worker: serve the named factory on a port shared with the other
+    workers, and report the factory's counters to the supervisor, as lines
+    of JSON on report_fd, every report_interval seconds. If bus names a
+    directory, the factory joins the message bus there. If profile_dir is
+    given, SIGUSR2 toggles profiling, with the stats dumped there.
+
+    Returns once the reactor has stopped.
+    """
+
+    from twisted.internet import reactor
+
+    factory = load_factory(name)
+    listen_reuseport(port, factory, interface, reactor=reactor)
+
+    if bus is not None:
+        MessageBus(factory, bus, reactor=reactor).start()
+
+    if profile_dir is not None:
+        Profiler(profile_dir, reactor).install()
+
+    # Signals passed on by the supervisor would kill us if nobody's
+    # listening for them.
+    for signum in forwarded_signals:
+        if signal.getsignal(signum) == signal.SIG_DFL:
+            signal.signal(signum, signal.SIG_IGN)
+
+    def report():
+        line = json.dumps(factory.snapshot(), sort_keys=True) + "\n"
+        try:
+            os.write(report_fd, line.encode("ascii"))
+        except (IOError, OSError):
+            # The supervisor is gone, and we shouldn't outlive it.
+            worker_log.info("Lost the supervisor; stopping")
+            reporter.stop()
+            if reactor.running:
+                reactor.stop()
+
+    reporter = LoopingCall(report)
+    reporter.start(report_interval)
+    reactor.run()
+
+class WorkerProcess(ProcessProtocol):
+    """
+    Process protocol for a worker, which passes its reports and its death on
+    to the supervisor.
+    """
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.pending = b""
+
+    def childDataReceived(self, fd, data):
+        if fd != 3:
+            return
+
+        lines = (self.pending + data).split(b"\n")
+        self.pending = lines.pop()
+        for line in lines:
+            try:
+                counters = json.loads(line.decode("ascii"))
+            except ValueError:
+                worker_log.warn("Bad report from worker {index}: {line!r}",
+                                index=self.index, line=line)
+                continue
+            self.supervisor.reportReceived(self.index, counters)
+
+    def processEnded(self, reason):
+        self.supervisor.workerEnded(self.index, reason)
+
+class WorkerSupervisor(object):
+    """
+    Runs a number of worker processes serving the named factory on a shared
+    port, and keeps them running.
+
+    The workers' counters are added up by totals().
+    """
+
+    # How long to wait before restarting a worker which died, in seconds, so
+    # that a worker which dies straight away doesn't eat the machine.
+    restart_delay = 1.0
+
+    # The least severe level of events which workers should log, and where
+    # they should dump their profiles, if SIGUSR2 is to toggle profiling.
+    log_level = "info"
+    profile_dir = None
+
+    def __init__(self, name, port, workers=None, interface="",
+                 report_interval=1.0, reactor=None, bus=None):
+        if workers is None:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.name = name
+        self.port = port
+        self.workers = workers
+        self.interface = interface
+        self.report_interval = report_interval
+        self.reactor = reactor
+        self.bus = bus
+
+        self.processes = {}
+        self.reports = {}
+        self.retired = {}
+        self.restarts = 0
+        self.stopping = False
+        self.stopped = None
+
+    def start(self):
+        """
+        Start the workers, and start passing signals on to them.
+        """
+
+        for index in range(self.workers):
+            self.spawn(index)
+
+        for signum in forwarded_signals:
+            signal.signal(signum, self.forwardSignal)
+
+    def spawn(self, index):
+        """
+        Start a worker.
+        """
+
+        args = [sys.executable, "-m", "txws", "--worker",
+                "--port", str(self.port),
+                "--interface", self.interface,
+                "--report-interval", str(self.report_interval),
+                "--log-level", self.log_level,
+                self.name]
+        if self.bus is not None:
+            args[-1:-1] = ["--bus", self.bus]
+        if self.profile_dir is not None:
+            args[-1:-1] = ["--profile-dir", self.profile_dir]
+        # Workers need to be able to import whatever we could.
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+
+        self.processes[index] = self.reactor.spawnProcess(
+            WorkerProcess(self, index), sys.executable, args, env=env,
+            childFDs={0: "w", 1: 1, 2: 2, 3: "r"})
+
+    def reportReceived(self, index, counters):
+        self.reports[index] = counters
+
+    def workerEnded(self, index, reason):
+        """
+        Note that a worker has died, keeping its totals, and restart it
+        unless we're stopping.
+        """
+
+        self.processes.pop(index, None)
+        counters = self.reports.pop(index, {})
+        for name, value in counters.items():
+            if name.partition(".")[0] not in gauges:
+                self.retired[name] = self.retired.get(name, 0) + value
+
+        if self.stopping:
+            if not self.processes and self.stopped is not None:
+                stopped, self.stopped = self.stopped, None
+                stopped.callback(None)
+            return
+
+        worker_log.warn("Worker {index} died ({reason}); restarting",
+                        index=index, reason=reason.getErrorMessage())
+        self.restarts += 1
+        self.reactor.callLater(self.restart_delay, self.respawn, index)
+
+    def respawn(self, index):
+        if not self.stopping and index not in self.processes:
+            self.spawn(index)
+
+    def forwardSignal(self, signum, frame=None):
+        for process in list(self.processes.values()):
+            try:
+                process.signalProcess(signum)
+            except ProcessExitedAlready:
+                pass
+
+    def stop(self):
+        """
+        Stop all of the workers, returning a Deferred which fires once
+        they've all exited.
+        """
+
+        self.stopping = True
+        if not self.processes:
+            return succeed(None)
+
+        self.stopped = Deferred()
+        self.forwardSignal(signal.SIGTERM)
+        return self.stopped
+
+    def totals(self):
+        """
+        Get the workers' counters, added up.
+        """
+
+        totals = dict(self.retired)
+        for counters in self.reports.values():
+            for name, value in counters.items():
+                if name in maxima:
+                    totals[name] = max(totals.get(name, 0), value)
+                else:
+                    totals[name] = totals.get(name, 0) + value
+        totals["workers"] = len(self.processes)
+        totals["restarts"] = self.restarts
+        return totals
+
+# Message bus. Broadcasts have to reach group members in every worker, so
+# the factories in sibling processes are connected by a mesh of Unix
+# sockets, one listening socket per process, all in one directory. Each
+# process tells the others which variants of the wire format its group
+# members use, and published messages cross the bus already framed for
+# those variants, so receiving processes only forward bytes.
+#
+# On the wire, each message is a 32-bit length, a 16-bit header length, a
+# JSON header, and any number of binary blobs, whose sizes are listed in
+# the header.
+
+_bus_head = Struct(">IH")
+
+@implementer(IPushProducer)
+class BusPeer(Protocol):
+    """
+    A connection to another process on a message bus.
+
+    Connections are one-way: each process publishes over the connections it
+    makes to the others, and hears from them over the connections they make
+    to it. Outgoing connections know the name of their peer from the start;
+    incoming ones learn it from the peer's hello.
+
+    Messages going out are batched up and written once per reactor turn.
+    When the other side isn't keeping up and the transport fills up, the
+    peer is marked slow, and messages for it are dropped until it catches
+    up.
+    """
+
+    slow = False
+    flush_call = None
+
+    def __init__(self, bus, name=None):
+        self.bus = bus
+        self.name = name
+        self.buf = ReceiveBuffer()
+        self.outgoing = []
+
+    def connectionMade(self):
+        if self.name is not None:
+            self.transport.registerProducer(self, True)
+            self.bus.peerConnected(self)
+
+    def sendMessage(self, header, blobs=()):
+        """
+        Queue a message for the peer.
+        """
+
+        sizes = header["sizes"] = [len(blob) for blob in blobs]
+        header = json.dumps(header).encode("utf-8")
+        length = len(header) + sum(sizes)
+
+        self.outgoing.append(_bus_head.pack(length, len(header)))
+        self.outgoing.append(header)
+        self.outgoing.extend(blobs)
+
+        if self.flush_call is None:
+            self.flush_call = self.bus.reactor.callLater(0, self.flush)
+
+    def flush(self):
+        self.flush_call = None
+        if self.outgoing:
+            outgoing, self.outgoing = self.outgoing, []
+            self.transport.writeSequence(outgoing)
+
+    def dataReceived(self, data):
+        buf = self.buf
+        buf.feed(data)
+
+        while len(buf) >= _bus_head.size:
+            length, header_length = buf.unpack(_bus_head)
+            if length > self.bus.max_message_size:
+                bus_log.warn("Message bus peer {peer} sent {length} bytes; "
+                             "disconnecting", peer=self.name, length=length)
+                self.transport.loseConnection()
+                return
+            if len(buf) < _bus_head.size + length:
+                break
+
+            buf.skip(_bus_head.size)
+            try:
+                header = json.loads(buf.read(header_length).decode("utf-8"))
+                blobs = [buf.read(size) for size in header["sizes"]]
+            except (ValueError, KeyError, TypeError):
+                bus_log.warn("Bad message from bus peer {peer}; "
+                             "disconnecting", peer=self.name)
+                self.transport.loseConnection()
+                return
+            self.bus.messageReceived(self, header, blobs)
+
+    def connectionLost(self, reason):
+        if self.flush_call is not None:
+            self.flush_call.cancel()
+            self.flush_call = None
+        self.bus.peerLost(self)
+
+    def pauseProducing(self):
+        self.slow = True
+        self.bus.peerSlow(self)
+
+    def resumeProducing(self):
+        self.slow = False
+        self.bus.peerSlow(self)
+
+    def stopProducing(self):
+        pass
+
+class BusClientFactory(ClientFactory):
+
+    def __init__(self, bus, name):
+        self.bus = bus
+        self.name = name
+
+    def buildProtocol(self, addr):
+        return BusPeer(self.bus, self.name)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.bus.connectionFailed(self.name)
+
+class BusServerFactory(ClientFactory):
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def buildProtocol(self, addr):
+        return BusPeer(self.bus)
+
+class MessageBus(object):
+    """
+    Connects a WebSocketFactory to its siblings in other processes, so that
+    broadcasts reach group members in all of them.
+
+    Every process on the bus listens on a Unix socket in the given
+    directory, named after the process; by default, its pid. Other sockets
+    in the directory are connected to when the bus starts, when their
+    owners say hello, and whenever the directory is scanned again.
+
+    Group names need to survive a trip through JSON.
+    """
+
+    # Seconds between looking for new sockets in the directory.
+    rescan_interval = 5.0
+
+    # The biggest message which peers may send, in bytes.
+    max_message_size = 16777216
+
+    def __init__(self, factory, directory, name=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        if name is None:
+            name = str(os.getpid())
+
+        self.factory = factory
+        self.directory = directory
+        self.name = name
+        self.reactor = reactor
+
+        self.port = None
+        self.scanner = None
+        self.peers = {}
+        self.incoming = set()
+        self.connecting = set()
+        self.peer_variants = {}
+        self.variants = set()
+        self.deflaters = {}
+
+        # Counters: messages sent to and received from peers, and messages
+        # dropped because their peer was slow.
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+        factory.bus = self
+
+    def path(self, name):
+        return os.path.join(self.directory, "%s.sock" % name)
+
+    def start(self):
+        """
+        Start listening, and connect to the rest of the bus.
+        """
+
+        path = self.path(self.name)
+        if os.path.exists(path):
+            # Left over from an earlier process with our name.
+            os.unlink(path)
+        self.port = self.reactor.listenUNIX(path, BusServerFactory(self))
+
+        self.scanner = LoopingCall(self.rescan)
+        self.scanner.clock = self.reactor
+        self.scanner.start(self.rescan_interval)
+
+    def stop(self):
+        """
+        Leave the bus.
+        """
+
+        if self.scanner is not None and self.scanner.running:
+            self.scanner.stop()
+        for peer in list(self.peers.values()) + list(self.incoming):
+            peer.transport.loseConnection()
+        if self.port is not None:
+            d = self.port.stopListening()
+            self.port = None
+            return d
+
+    def rescan(self):
+        """
+        Connect to any peers in the directory we aren't connected to yet.
+        """
+
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".sock"):
+                self.connect(filename[:-len(".sock")])
+
+    def connect(self, name):
+        if (name == self.name or name in self.peers
+            or name in self.connecting):
+            return
+        self.connecting.add(name)
+        self.reactor.connectUNIX(self.path(name), BusClientFactory(self, name))
+
+    def connectionFailed(self, name):
+        self.connecting.discard(name)
+
+    def peerConnected(self, peer):
+        self.connecting.discard(peer.name)
+        self.peers[peer.name] = peer
+        peer.sendMessage({"type": "hello", "name": self.name})
+        if self.variants:
+            peer.sendMessage({"type": "variants",
+                              "variants": sorted(self.variants, key=repr)})
+
+    def peerLost(self, peer):
+        if peer.name is not None and self.peers.get(peer.name) is peer:
+            del self.peers[peer.name]
+        if peer in self.incoming:
+            self.incoming.discard(peer)
+            self.peer_variants.pop(peer.name, None)
+
+    def peerSlow(self, peer):
+        if peer.slow:
+            bus_log.warn("Message bus peer {peer} is falling behind; "
+                         "dropping messages for it", peer=peer.name)
+        else:
+            bus_log.info("Message bus peer {peer} has caught up",
+                         peer=peer.name)
+
+    def messageReceived(self, peer, header, blobs):
+        kind = header.get("type")
+        if kind == "hello":
+            peer.name = header["name"]
+            self.incoming.add(peer)
+            # Make sure we can talk back.
+            self.connect(peer.name)
+        elif kind == "variants":
+            self.peer_variants[peer.name] = set(
+                tuple(variant) for variant in header["variants"])
+        elif kind == "publish":
+            self.received += 1
+            data = blobs[0]
+            if header["text"]:
+                data = data.decode("utf-8")
+
+            framed = {}
+            offset = 1
+            for variant, count in header["variants"]:
+                framed[tuple(variant)] = blobs[offset:offset + count]
+                offset += count
+
+            self.factory.publishLocal(header["group"], data, framed)
+            self.announce(framed)
+
+    def announce(self, framed):
+        """
+        Tell the other processes about any variants we've framed data for
+        which they don't know we need yet.
+        """
+
+        new = set(framed) - self.variants
+        if new:
+            self.variants.update(new)
+            for peer in self.peers.values():
+                peer.sendMessage({"type": "variants",
+                                  "variants": sorted(self.variants, key=repr)})
+
+    def frame(self, data, variant):
+        """
+        Frame some data for a variant of the wire format, without a
+        connection to go by.
+        """
+
+        hybi00, codec, binary = variant[:3]
+        deflate = None
+        if len(variant) > 3:
+            deflate = self.deflaters.get(variant)
+            if deflate is None:
+                bits, level, mem_level, min_size = variant[3:]
+                deflate = self.deflaters[variant] = PerMessageDeflate(
+                    True, server_max_window_bits=bits, level=level,
+                    mem_level=mem_level, min_size=min_size)
+        return frame_parts(data, hybi00, codec, binary, deflate)
+
+    def send(self, group, data, framed):
+        """
+        Send a published message to every peer, framed for the variants
+        each of them needs. framed holds what's already been framed here.
+        """
+
+        # Whatever was framed for our own members, we need, too.
+        self.announce(framed)
+
+        if not self.peers:
+            return
+
+        text = isinstance(data, six.text_type)
+        raw = data.encode("utf-8") if text else data
+
+        for name, peer in self.peers.items():
+            if peer.slow:
+                self.dropped += 1
+                continue
+
+            variants = []
+            blobs = [raw]
+            for variant in self.peer_variants.get(name, ()):
+                parts = framed.get(variant)
+                if parts is None:
+                    parts = framed[variant] = self.frame(data, variant)
+                variants.append([variant, len(parts)])
+                blobs.extend(parts)
+
+            peer.sendMessage({"type": "publish", "group": group, "text": text,
+                              "variants": variants}, blobs)
+            self.sent += 1
+
+    def snapshot(self):
+        """
+        Get the current values of the bus's counters, as a dict.
+        """
+
+        return {
+            "bus_peers": len(self.peers),
+            "bus_slow_peers": len([peer for peer in self.peers.values()
+                                   if peer.slow]),
+            "bus_sent": self.sent,
+            "bus_received": self.received,
+            "bus_dropped": self.dropped,
+        }
+
+def main(argv=None):
+    """
+    Serve a factory from several processes, or, with --worker, be one of
+    those processes.
+    """
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m txws",
+        description="Serve a factory from several worker processes.")
+    parser.add_argument("factory", help="fully qualified name of a factory, "
+                        "or of a callable returning one")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--interface", default="")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of workers; defaults to one per CPU")
+    parser.add_argument("--report-interval", type=float, default=1.0,
+                        help="seconds between counter reports from workers")
+    parser.add_argument("--stats-interval", type=float, default=60.0,
+                        help="seconds between logging the workers' totals")
+    parser.add_argument("--bus", default=None,
+                        help="directory for a message bus between workers, "
+                        "which broadcasts go over")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="port to serve the workers' totals on, in the "
+                        "Prometheus text format")
+    parser.add_argument("--profile-dir", default=None,
+                        help="directory for workers to dump profiles in; "
+                        "SIGUSR2 turns profiling on and off")
+    parser.add_argument("--log-level", default="info",
+                        choices=["debug", "info", "warn", "error"],
+                        help="least severe level of events to log")
+    parser.add_argument("--worker", action="store_true",
+                        help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+
+    observer = textFileLogObserver(sys.stderr)
+    predicate = LogLevelFilterPredicate(LogLevel.levelWithName(
+        options.log_level))
+    globalLogBeginner.beginLoggingTo([FilteringLogObserver(observer,
+                                                           [predicate])])
+
+    if options.worker:
+        run_worker(options.factory, options.port, options.interface,
+                   options.report_interval, bus=options.bus,
+                   profile_dir=options.profile_dir)
+        return
+
+    from twisted.internet import reactor
+
+    supervisor = WorkerSupervisor(options.factory, options.port,
+                                  options.workers, options.interface,
+                                  options.report_interval, bus=options.bus)
+    supervisor.log_level = options.log_level
+    supervisor.profile_dir = options.profile_dir
+    reactor.callWhenRunning(supervisor.start)
+    reactor.addSystemEventTrigger("before", "shutdown", supervisor.stop)
+
+    if options.stats_interval:
+        def stats():
+            worker_log.info("Totals: {totals}", totals=supervisor.totals())
+        LoopingCall(stats).start(options.stats_interval, now=False)
+
+    if options.metrics_port is not None:
+        from twisted.web.server import Site
+        site = Site(MetricsResource(supervisor.totals))
+        reactor.listenTCP(options.metrics_port, site,
+                          interface=options.interface)
+
+    reactor.run()
+
+if __name__ == "__main__":
+    main()